@@ -0,0 +1,38 @@
+'''Awaitable versions of the bot.db helpers used by bot.async_handlers.
+
+The blocking helpers run on a dedicated thread pool, so they keep the
+bot.db_cache caching and invalidation and the shared matching cars cache.
+A coroutine waiting on Mongo holds neither the event loop nor a dispatcher
+worker; at most MONGO_WORKERS queries run at once.
+'''
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from bot import db_cache
+from bot.db import get_watchlist as get_watchlist_db
+from bot.handlers import fetch_watchlist_cars as fetch_watchlist_cars_sync
+
+
+MONGO_WORKERS = 16
+_executor = ThreadPoolExecutor(MONGO_WORKERS, thread_name_prefix='async-db')
+
+
+async def run_in_pool(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+async def get_user(telegram_id):
+    return await run_in_pool(db_cache.get_user, telegram_id)
+
+
+async def get_watchlists(user):
+    return await run_in_pool(db_cache.get_watchlists, user)
+
+
+async def get_watchlist(watchlist_id):
+    return await run_in_pool(get_watchlist_db, watchlist_id)
+
+
+async def fetch_watchlist_cars(watchlist):
+    return await run_in_pool(fetch_watchlist_cars_sync, watchlist)
@@ -0,0 +1,160 @@
+'''asyncio versions of the conversation handlers that wait on Mongo.
+
+python-telegram-bot 12 calls handlers synchronously on its worker pool, so
+a handler waiting on Mongo or on a Telegram request holds a worker. The
+handlers here are coroutines run on one event loop thread. The callback
+registered with the dispatcher only schedules the coroutine and returns a
+Promise; ConversationHandler keeps the conversation waiting on it and moves
+to the returned state (the same states as bot.handlers) once it is done.
+Mongo calls go through bot.async_db and Telegram calls run on a separate
+thread pool, so a dispatcher worker is released as soon as the update is
+scheduled.
+
+Register them in place of their bot.handlers namesakes:
+
+    CommandHandler('list_watchlists', async_handlers.list_watchlists)
+'''
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from telegram import ParseMode
+from telegram.ext import ConversationHandler
+from telegram.utils.promise import Promise
+from bot import async_db
+from bot import handlers
+from bot.handlers import (
+    HOURGLASS_ICON,
+    LIST_MATCHING_CARS,
+    SELECT_WATCHLIST,
+    YES_NO_KEYBOARD,
+    INPUT_WATCHLIST_DETAILS_CONFIRM,
+    build_watchlist,
+    get_cars_messages,
+    get_watchlists_keyboard,
+)
+
+
+TELEGRAM_WORKERS = 8
+_telegram_executor = ThreadPoolExecutor(TELEGRAM_WORKERS, thread_name_prefix='async-telegram')
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    '''Returns the handler event loop, starting its thread on first use.'''
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='async-handlers', daemon=True).start()
+        return _loop
+
+
+class CoroutinePromise(Promise):
+    '''Promise settled by a coroutine running on the handler event loop.'''
+
+    def __init__(self, future):
+        super().__init__(None, (), {})
+        future.add_done_callback(self._settle)
+
+    def _settle(self, future):
+        try:
+            self._result = future.result()
+        except Exception as e:
+            logging.getLogger().exception('An async handler raised an error')
+            self._exception = e
+        finally:
+            self.done.set()
+
+    def run(self):
+        raise RuntimeError('CoroutinePromise is settled by its coroutine')
+
+
+def async_handler(coroutine_function):
+    @functools.wraps(coroutine_function)
+    def callback(update, context):
+        future = asyncio.run_coroutine_threadsafe(coroutine_function(update, context), get_loop())
+        return CoroutinePromise(future)
+    return callback
+
+
+async def call(func, *args, **kwargs):
+    '''Runs a blocking Telegram call on the Telegram thread pool.'''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_telegram_executor, functools.partial(func, *args, **kwargs))
+
+
+async def send_cars(query, watchlist):
+    (cars, car_count) = await async_db.fetch_watchlist_cars(watchlist)
+    # Sent one by one to keep the listing in order
+    for (text, kwargs) in get_cars_messages(cars, car_count):
+        await call(query.bot.send_message, query.message.chat_id, text, **kwargs)
+
+
+async def restart(update, context):
+    # start() writes to Mongo as well, so all of it runs on the pool
+    return await async_db.run_in_pool(handlers.restart, update, context)
+
+
+@async_handler
+async def list_watchlists(update, context):
+    user = await async_db.get_user(update.effective_user.id)
+    watchlists = await async_db.get_watchlists(user)
+
+    if not watchlists:
+        return await restart(update, context)
+
+    reply_markup = get_watchlists_keyboard(watchlists)
+    await call(update.message.reply_text, 'Your watchlists:', reply_markup=reply_markup)
+    return SELECT_WATCHLIST
+
+
+@async_handler
+async def list_matching_cars(update, context):
+    user = await async_db.get_user(update.effective_user.id)
+    watchlists = await async_db.get_watchlists(user)
+
+    if not watchlists:
+        return await restart(update, context)
+
+    reply_markup = get_watchlists_keyboard(watchlists)
+    await call(update.message.reply_text, 'Select watchlist to list matching cars:', reply_markup=reply_markup)
+    return LIST_MATCHING_CARS
+
+
+@async_handler
+async def list_cars_watchlist_selected(update, context):
+    query = update.callback_query
+    watchlist_id = query.data
+    if watchlist_id == '/cancel':
+        return await call(handlers.cancel_action, query, 'Cancelled')
+    try:
+        watchlist = await async_db.get_watchlist(watchlist_id)
+        await call(query.answer)
+        if not watchlist:
+            await call(query.edit_message_text, 'Error: such watchlist does not exist anymore')
+            return await async_db.run_in_pool(handlers.start, update, context)
+
+        await send_cars(query, watchlist)
+    except Exception:
+        await call(query.bot.send_message, query.message.chat_id, 'An error occurred when listing cars', parse_mode=ParseMode.MARKDOWN)
+    return ConversationHandler.END
+
+
+@async_handler
+async def car_query_inputted(update, context):
+    query = update.callback_query
+    try:
+        await call(query.answer)
+        await call(query.bot.send_message, query.message.chat_id, f'Searching {HOURGLASS_ICON} Please wait', parse_mode=ParseMode.MARKDOWN)
+
+        user = await async_db.get_user(update.effective_user.id)
+        watchlist = build_watchlist(user, context.user_data['watchlist'])
+
+        await send_cars(query, watchlist)
+    except Exception:
+        await call(query.bot.send_message, query.message.chat_id, 'An error occurred when finding watchlist', parse_mode=ParseMode.MARKDOWN)
+    await call(query.bot.send_message, query.message.chat_id, 'Would you like to get notifications about new such cars?', reply_markup=YES_NO_KEYBOARD)
+    return INPUT_WATCHLIST_DETAILS_CONFIRM
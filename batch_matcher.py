@@ -0,0 +1,138 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from services.matching_cache import bump_cars_version
+from services.watchlist_index import WatchlistIndex
+from services.watchlists import get_car_message
+
+
+MIN_PARALLEL_CARS = 500
+
+# Set in every pool worker by _init_worker
+_shared = None
+
+
+def _init_worker(indexes, cars):
+    global _shared
+    _shared = (indexes, cars)
+
+
+def _match_shared(args):
+    (chunk, with_messages) = args
+    (indexes, cars) = _shared
+    return match_index(indexes[chunk], cars, with_messages)
+
+
+def match_index(index, cars, with_messages):
+    matches = {}
+    messages = {}
+    for (i, car) in enumerate(cars):
+        for watchlist in index.match(car):
+            matches.setdefault(watchlist['_id'], []).append(i)
+            if with_messages and i not in messages:
+                messages[i] = get_car_message(car)[1]
+    return (matches, messages)
+
+
+def split_watchlists(watchlists, count):
+    '''Splits watchlists into count chunks of about the same size.
+
+    All watchlists of a make and model go to the same chunk, so a car is
+    only looked up in the chunk indexes that can match it.
+    '''
+    groups = {}
+    for watchlist in watchlists:
+        groups.setdefault((watchlist['make'], watchlist['model']), []).append(watchlist)
+    chunks = [[] for _ in range(count)]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(chunks, key=len).extend(group)
+    return [chunk for chunk in chunks if chunk]
+
+
+def get_fork_context():
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+class BatchMatcher:
+    '''Matches scrape batches against all watchlists on a process pool.
+
+    The watchlists are split into one chunk per worker, and the index of
+    every chunk is built once in this process. Each batch starts a pool
+    whose initializer receives the indexes and the cars; with the fork
+    start method the workers inherit both without pickling them, and a task
+    is just the number of a chunk. Batches smaller than min_parallel_cars,
+    and every batch with a single worker, are matched in this process.
+    Results are in watchlist order and cars stay in batch order, so the
+    output doesn't depend on the number of workers.
+    '''
+
+    def __init__(self, watchlists, workers=None, min_parallel_cars=MIN_PARALLEL_CARS, mp_context=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.min_parallel_cars = min_parallel_cars
+        self.mp_context = mp_context or get_fork_context()
+        self.reload(watchlists)
+
+    def reload(self, watchlists):
+        self.watchlists = list(watchlists)
+        self.indexes = [WatchlistIndex(chunk) for chunk in split_watchlists(self.watchlists, self.workers)]
+
+    def close(self):
+        '''Pools only live for one batch, so there is nothing to release.'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def match_chunks(self, cars, with_messages):
+        if len(self.indexes) == 1 or len(cars) < self.min_parallel_cars:
+            return [match_index(index, cars, with_messages) for index in self.indexes]
+        with ProcessPoolExecutor(
+            len(self.indexes),
+            mp_context=self.mp_context,
+            initializer=_init_worker,
+            initargs=(self.indexes, cars),
+        ) as executor:
+            return list(executor.map(_match_shared, [(chunk, with_messages) for chunk in range(len(self.indexes))]))
+
+    def match(self, cars, with_messages=False):
+        '''Returns [(watchlist, [car], [message])] for every matched watchlist.
+
+        Messages are only rendered when with_messages is set; a matched car
+        is rendered once per chunk however many watchlists it matches.
+        '''
+        cars = list(cars)
+        if not self.watchlists or not cars:
+            return []
+
+        matches = {}
+        messages = {}
+        for (chunk_matches, chunk_messages) in self.match_chunks(cars, with_messages):
+            matches.update(chunk_matches)
+            messages.update(chunk_messages)
+
+        results = []
+        for watchlist in self.watchlists:
+            positions = matches.get(watchlist['_id'])
+            if not positions:
+                continue
+            results.append((
+                watchlist,
+                [cars[position] for position in positions],
+                [messages[position] for position in positions] if with_messages else None,
+            ))
+        return results
+
+
+def match_batch(db, cars, workers=None, with_messages=False):
+    '''One-off match of a freshly ingested batch.
+
+    Keep a BatchMatcher around to match several batches, and call
+    bump_cars_version after writing each of them.
+    '''
+    bump_cars_version(db)
+    with BatchMatcher(db['watchlists'].find(), workers) as matcher:
+        return matcher.match(cars, with_messages)
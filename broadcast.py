@@ -0,0 +1,198 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pymongo import ASCENDING
+from telegram.error import BadRequest, RetryAfter, TelegramError, Unauthorized
+from services.notification_dispatcher import GLOBAL_MESSAGES_PER_SECOND, MAX_SEND_ATTEMPTS, TokenBucket
+
+
+BATCH_SIZE = 100
+SEND_WORKERS = 8
+BLOCKED_CHAT_ERRORS = ('chat not found', 'user is deactivated', 'bot was blocked')
+SENT = 'sent'
+BLOCKED = 'blocked'
+FAILED = 'failed'
+
+
+def is_blocked_chat_error(error):
+    return isinstance(error, (Unauthorized, BadRequest)) and any(text in error.message.lower() for text in BLOCKED_CHAT_ERRORS)
+
+
+def is_invalid_token_error(error):
+    # python-telegram-bot raises Unauthorized for both 401 and 403; only a
+    # 401 (no "Forbidden:" prefix) means the bot itself can't send anymore
+    return isinstance(error, Unauthorized) and not error.message.lower().startswith('forbidden')
+
+
+class RateLimiter:
+    '''Thread-safe TokenBucket shared by the send workers.
+
+    pause() holds every worker until the deadline, since Telegram flood
+    control applies to the bot rather than to a single request.
+    '''
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.bucket = TokenBucket(rate, clock=clock)
+        self.clock = clock
+        self.sleep = sleep
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                delay = self.paused_until - self.clock()
+                if delay <= 0:
+                    delay = self.bucket.delay()
+                if not delay:
+                    self.bucket.consume()
+                    return
+            self.sleep(delay)
+
+
+class Broadcast:
+    '''Sends a message to every user, resuming after a crash.
+
+    Users are streamed in _id order and sent to in batches by a pool of
+    workers sharing the global Telegram rate limit. Progress is stored in
+    the broadcasts collection after every batch, so a restarted broadcast
+    with the same id skips the finished batches; users of an interrupted
+    batch may get the message twice. Chats that blocked the bot or no longer
+    exist are marked with telegram.blockedAt and skipped by later broadcasts
+    until the user sends /start again (see unblock_chat). An invalid bot token
+    aborts the broadcast before the batch is saved, so it resumes from there.
+    '''
+
+    def __init__(
+        self,
+        bot,
+        db,
+        broadcast_id,
+        text,
+        parse_mode=None,
+        rate=GLOBAL_MESSAGES_PER_SECOND,
+        workers=SEND_WORKERS,
+        batch_size=BATCH_SIZE,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.bot = bot
+        self.db = db
+        self.broadcast_id = broadcast_id
+        self.text = text
+        self.parse_mode = parse_mode
+        self.workers = workers
+        self.batch_size = batch_size
+        self.limiter = RateLimiter(rate, clock=clock, sleep=sleep)
+        self.aborted = threading.Event()
+
+    def load_state(self):
+        self.db['broadcasts'].update_one(
+            {'_id': self.broadcast_id},
+            {'$setOnInsert': {
+                'text': self.text,
+                'status': 'running',
+                'lastUserId': None,
+                SENT: 0,
+                BLOCKED: 0,
+                FAILED: 0,
+                'startedAt': datetime.utcnow(),
+            }},
+            upsert=True
+        )
+        return self.db['broadcasts'].find_one({'_id': self.broadcast_id})
+
+    def save_progress(self, last_user_id, counts):
+        self.db['broadcasts'].update_one(
+            {'_id': self.broadcast_id},
+            {
+                '$set': {'lastUserId': last_user_id, 'updatedAt': datetime.utcnow()},
+                '$inc': counts,
+            }
+        )
+
+    def iter_batches(self, last_user_id):
+        query = {'telegram.id': {'$exists': True}, 'telegram.blockedAt': {'$exists': False}}
+        if last_user_id:
+            query['_id'] = {'$gt': last_user_id}
+        users = self.db['users'].find(query, {'telegram.id': True}).sort('_id', ASCENDING).batch_size(self.batch_size)
+        batch = []
+        for user in users:
+            batch.append(user)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def send(self, user):
+        chat_id = user['telegram']['id']
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            if self.aborted.is_set():
+                return FAILED
+            self.limiter.acquire()
+            try:
+                self.bot.send_message(chat_id, self.text, parse_mode=self.parse_mode)
+                return SENT
+            except RetryAfter as e:
+                logging.getLogger().warning(f'Flood control while broadcasting, retrying in {e.retry_after}s')
+                self.limiter.pause(e.retry_after)
+            except TelegramError as e:
+                if is_blocked_chat_error(e):
+                    self.db['users'].update_one(
+                        {'_id': user['_id']},
+                        {'$set': {'telegram.blockedAt': datetime.utcnow()}}
+                    )
+                    return BLOCKED
+                if is_invalid_token_error(e):
+                    self.aborted.set()
+                    raise
+                logging.getLogger().warning(f'Failed to broadcast to chat {chat_id}: {e}')
+                return FAILED
+        return FAILED
+
+    def run(self):
+        state = self.load_state()
+        if state['status'] == 'done':
+            return state
+        try:
+            with ThreadPoolExecutor(self.workers) as executor:
+                for batch in self.iter_batches(state['lastUserId']):
+                    counts = {SENT: 0, BLOCKED: 0, FAILED: 0}
+                    for result in executor.map(self.send, batch):
+                        counts[result] += 1
+                    self.save_progress(batch[-1]['_id'], counts)
+        except Unauthorized as e:
+            logging.getLogger().error(f'Broadcast {self.broadcast_id} aborted: {e}')
+            self.db['broadcasts'].update_one(
+                {'_id': self.broadcast_id},
+                {'$set': {'status': 'aborted', 'error': str(e), 'updatedAt': datetime.utcnow()}}
+            )
+            raise
+        self.db['broadcasts'].update_one(
+            {'_id': self.broadcast_id},
+            {'$set': {'status': 'done', 'updatedAt': datetime.utcnow()}}
+        )
+        state = self.db['broadcasts'].find_one({'_id': self.broadcast_id})
+        logging.getLogger().info(
+            f'Broadcast {self.broadcast_id} done: {state[SENT]} sent, {state[BLOCKED]} blocked, {state[FAILED]} failed'
+        )
+        return state
+
+
+def unblock_chat(db, chat_id):
+    '''Lets broadcasts reach a user again once they talk to the bot.'''
+    db['users'].update_one(
+        {'telegram.id': chat_id, 'telegram.blockedAt': {'$exists': True}},
+        {'$unset': {'telegram.blockedAt': ''}}
+    )
+
+
+def send_broadcast(bot, db, broadcast_id, text, **kwargs):
+    return Broadcast(bot, db, broadcast_id, text, **kwargs).run()
@@ -0,0 +1,112 @@
+import json
+import time
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from models.watchlist_types import CarSummary
+
+
+COUNT_CACHE_TTL_SECONDS = 60
+COUNT_CAP = 1000
+MAX_CACHED_COUNTS = 10000
+_count_cache = {}
+CAR_PROJECTIONS = {
+    'summary': CarSummary.PROJECTION,
+    'full': None,
+}
+
+
+def build_car_filter(watchlist):
+    car_filter = {
+        'carInfo.make': watchlist['make'],
+        'carInfo.model': watchlist['model'],
+    }
+    year = watchlist.get('year') or {}
+    year_filter = {}
+    if year.get('min') is not None:
+        year_filter['$gte'] = int(year['min'])
+    if year.get('max') is not None:
+        year_filter['$lte'] = int(year['max'])
+    if year_filter:
+        car_filter['carInfo.year'] = year_filter
+    if (watchlist.get('mileage') or {}).get('max') is not None:
+        car_filter['mileage'] = {
+            '$lte': int(watchlist['mileage']['max']),
+        }
+    if (watchlist.get('price') or {}).get('max') is not None:
+        car_filter['price.amount'] = {
+            '$lte': int(watchlist['price']['max']),
+        }
+    return car_filter
+
+
+def fetch_cars_page(db, watchlist, limit, after=None, fields='full'):
+    '''Returns a cursor over matching cars in _id order.
+
+    after is the _id of the last car of the previous page.
+    '''
+    car_filter = build_car_filter(watchlist)
+    if after:
+        car_filter['_id'] = {'$gt': ObjectId(after)}
+    return db['cars'].find(car_filter, CAR_PROJECTIONS[fields]).sort('_id', ASCENDING).limit(limit)
+
+
+def get_count_key(watchlist):
+    return json.dumps(build_car_filter(watchlist), sort_keys=True)
+
+
+def count_matching_cars(db, watchlist, count_cap=None, cached=False):
+    '''Counts matching cars, stopping at count_cap + 1 when a cap is given.'''
+    car_filter = build_car_filter(watchlist)
+    options = {'limit': count_cap + 1} if count_cap else {}
+    if not cached:
+        return db['cars'].count_documents(car_filter, **options)
+
+    key = (get_count_key(watchlist), count_cap)
+    now = time.monotonic()
+    item = _count_cache.get(key)
+    if item and item[0] > now:
+        return item[1]
+    count = db['cars'].count_documents(car_filter, **options)
+    if len(_count_cache) >= MAX_CACHED_COUNTS:
+        _count_cache.clear()
+    _count_cache[key] = (now + COUNT_CACHE_TTL_SECONDS, count)
+    return count
+
+
+def build_matching_cars_pipeline(watchlist, limit, count_cap=None, fields='full'):
+    pipeline = [
+        {'$match': build_car_filter(watchlist)},
+        {'$sort': {'_id': ASCENDING}},
+    ]
+    if count_cap:
+        pipeline.append({'$limit': max(limit, count_cap + 1)})
+    cars_stages = [{'$limit': limit}]
+    if CAR_PROJECTIONS[fields]:
+        cars_stages.append({'$project': CAR_PROJECTIONS[fields]})
+    pipeline.append({
+        '$facet': {
+            'cars': cars_stages,
+            'count': [{'$count': 'count'}],
+        }
+    })
+    return pipeline
+
+
+def parse_matching_cars_result(result):
+    count = result['count'][0]['count'] if result['count'] else 0
+    return (result['cars'], count)
+
+
+def fetch_matching_cars_page(db, watchlist, limit, count_cap=None, fields='full'):
+    '''Returns the first matching cars and their count in one aggregation.
+
+    With count_cap, at most max(limit, count_cap + 1) cars are counted.
+    '''
+    pipeline = build_matching_cars_pipeline(watchlist, limit, count_cap=count_cap, fields=fields)
+    return parse_matching_cars_result(next(db['cars'].aggregate(pipeline)))
+
+
+def format_car_count(count, count_cap=None):
+    if count_cap and count > count_cap:
+        return f'{count_cap}+'
+    return str(count)
@@ -0,0 +1,135 @@
+import math
+from decimal import Decimal
+import numpy as np
+from bson.decimal128 import Decimal128
+from pymongo import ASCENDING
+from services.car_queries import CAR_PROJECTIONS
+from services.watchlist_index import get_car_key, get_watchlist_bounds
+
+
+PRICE_SCALE = 100
+# Missing values and open upper bounds share the largest int64, so a missing
+# value only passes a bound that isn't set
+MISSING = np.iinfo(np.int64).max
+NO_MIN = np.iinfo(np.int64).min
+# Watchlists of one make/model are matched together while their masks stay
+# under this many cells
+MAX_MASK_CELLS = 1 << 22
+
+
+def to_column_value(value, scale=1):
+    # Mongo range operators only match numbers, so anything else is missing
+    if isinstance(value, bool):
+        return MISSING
+    if isinstance(value, int):
+        value *= scale
+        return value if NO_MIN < value < MISSING else MISSING
+    if isinstance(value, Decimal128):
+        value = value.to_decimal()
+    elif isinstance(value, float):
+        value = Decimal(repr(value))
+    else:
+        return MISSING
+    if not value.is_finite():
+        return MISSING
+    # Rounding up keeps value <= bound exact for integer bounds
+    return to_column_value(math.ceil(value * scale))
+
+
+def to_bound(value, scale=1, unbounded=MISSING):
+    if math.isinf(value):
+        return unbounded
+    return min(max(int(value) * scale, NO_MIN + 1), MISSING - 1)
+
+
+def get_bounds(watchlist):
+    (min_year, max_year, max_mileage, max_price) = get_watchlist_bounds(watchlist)
+    return (
+        to_bound(min_year, unbounded=NO_MIN),
+        to_bound(max_year),
+        to_bound(max_mileage),
+        to_bound(max_price, PRICE_SCALE),
+    )
+
+
+class CarSnapshot:
+    '''Columnar in-memory copy of the cars collection.
+
+    Year, mileage and price are kept in int64 arrays, prices in cents.
+    Fractional values are rounded up, which is exact for the integer upper
+    bounds of watchlists; only a fractional year can match a year.min it is
+    just below. Rows are grouped by make/model in _id order, so a watchlist
+    is evaluated with NumPy masks over one contiguous slice. Results match
+    fetch_matching_cars_page: cars in _id order and the number of matches.
+    '''
+
+    def __init__(self, cars):
+        cars = sorted(cars, key=lambda car: car['_id'])
+        self.key_codes = {}
+        codes = np.empty(len(cars), dtype=np.int32)
+        years = np.empty(len(cars), dtype=np.int64)
+        mileages = np.empty(len(cars), dtype=np.int64)
+        prices = np.empty(len(cars), dtype=np.int64)
+        for (i, car) in enumerate(cars):
+            codes[i] = self.key_codes.setdefault(get_car_key(car), len(self.key_codes))
+            years[i] = to_column_value((car.get('carInfo') or {}).get('year'))
+            mileages[i] = to_column_value(car.get('mileage'))
+            prices[i] = to_column_value((car.get('price') or {}).get('amount'), PRICE_SCALE)
+
+        order = np.argsort(codes, kind='stable')
+        self.cars = [cars[row] for row in order]
+        self.years = years[order]
+        self.mileages = mileages[order]
+        self.prices = prices[order]
+        bounds = np.searchsorted(codes[order], np.arange(len(self.key_codes) + 1))
+        self.ranges = [(bounds[code], bounds[code + 1]) for code in range(len(self.key_codes))]
+
+    def get_range(self, watchlist):
+        code = self.key_codes.get((watchlist['make'], watchlist['model']))
+        return (0, 0) if code is None else self.ranges[code]
+
+    def get_masks(self, start, end, bounds):
+        '''Returns a (watchlists, cars) mask of the rows start:end for the bounds.'''
+        bounds = np.array(bounds, dtype=np.int64).reshape(-1, 4)
+        (min_year, max_year, max_mileage, max_price) = (bounds[:, i:i + 1] for i in range(4))
+        years = self.years[start:end]
+        year_set = (min_year != NO_MIN) | (max_year != MISSING)
+        masks = (years >= min_year) & (years <= max_year) & ((years != MISSING) | ~year_set)
+        masks &= self.mileages[start:end] <= max_mileage
+        masks &= self.prices[start:end] <= max_price
+        return masks
+
+    def get_matching_rows(self, watchlist):
+        (start, end) = self.get_range(watchlist)
+        return start + np.flatnonzero(self.get_masks(start, end, get_bounds(watchlist))[0])
+
+    def get_result(self, rows, limit, count_cap=None):
+        count = len(rows)
+        if count_cap:
+            count = min(count, max(limit, count_cap + 1))
+        return ([self.cars[row] for row in rows[:limit]], count)
+
+    def match(self, watchlist, limit, count_cap=None):
+        return self.get_result(self.get_matching_rows(watchlist), limit, count_cap)
+
+    def match_many(self, watchlists, limit, count_cap=None):
+        by_range = {}
+        for watchlist in watchlists:
+            by_range.setdefault(self.get_range(watchlist), []).append(watchlist)
+
+        results = {}
+        for ((start, end), range_watchlists) in by_range.items():
+            size = max(1, MAX_MASK_CELLS // max(1, end - start))
+            for i in range(0, len(range_watchlists), size):
+                group = range_watchlists[i:i + size]
+                masks = self.get_masks(start, end, [get_bounds(watchlist) for watchlist in group])
+                for (watchlist, mask) in zip(group, masks):
+                    results[watchlist['_id']] = self.get_result(start + np.flatnonzero(mask), limit, count_cap)
+        return results
+
+    def __len__(self):
+        return len(self.cars)
+
+
+def load_car_snapshot(db, fields='summary'):
+    return CarSnapshot(db['cars'].find({}, CAR_PROJECTIONS[fields]).sort('_id', ASCENDING))
@@ -0,0 +1,157 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from bot.db import (
+    get_user as get_user_db,
+    get_watchlists as get_watchlists_db,
+    insert_watchlist as insert_watchlist_db,
+    update_watchlist as update_watchlist_db,
+    delete_watchlist as delete_watchlist_db,
+)
+from utils.instrumentation import track
+
+
+MAX_CACHED_USERS = 10000
+CACHE_TTL_SECONDS = 300
+MISSING = object()
+
+
+class LRUCache:
+    '''Thread-safe LRU cache with a TTL.
+
+    Values are copied in and out, so callers may mutate what they get
+    without touching the cached value.
+    '''
+
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] > self.clock():
+                self._items.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(item[1])
+            if item is not None:
+                del self._items[key]
+            self.misses += 1
+            return MISSING
+
+    def set(self, key, value):
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._items[key] = (self.clock() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+        return MISSING if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._items),
+            }
+
+    def __len__(self):
+        return len(self._items)
+
+
+user_cache = LRUCache(MAX_CACHED_USERS, CACHE_TTL_SECONDS)
+watchlists_cache = LRUCache(MAX_CACHED_USERS, CACHE_TTL_SECONDS)
+_watchlist_owners = {}
+
+
+def get_user(telegram_id):
+    user = user_cache.get(telegram_id)
+    if user is MISSING:
+        with track('mongo'):
+            user = get_user_db(telegram_id)
+        if user:
+            user_cache.set(telegram_id, user)
+    return user
+
+
+def get_watchlists(user):
+    if not user:
+        with track('mongo'):
+            return get_watchlists_db(user)
+    user_id = user['_id']
+    watchlists = watchlists_cache.get(user_id)
+    if watchlists is MISSING:
+        with track('mongo'):
+            watchlists = list(get_watchlists_db(user))
+        watchlists_cache.set(user_id, watchlists)
+        for watchlist in watchlists:
+            _watchlist_owners[str(watchlist['_id'])] = user_id
+    return watchlists
+
+
+def invalidate_watchlists(user_id):
+    watchlists = watchlists_cache.pop(user_id)
+    if watchlists is not MISSING:
+        for watchlist in watchlists:
+            _watchlist_owners.pop(str(watchlist['_id']), None)
+
+
+def invalidate_watchlist(watchlist_id):
+    user_id = _watchlist_owners.get(str(watchlist_id), MISSING)
+    if user_id is MISSING:
+        # Owner unknown, so any cached list may contain the watchlist
+        watchlists_cache.clear()
+        _watchlist_owners.clear()
+    else:
+        invalidate_watchlists(user_id)
+
+
+def insert_watchlist(watchlist):
+    with track('mongo'):
+        result = insert_watchlist_db(watchlist)
+    invalidate_watchlists(watchlist['userId'])
+    return result
+
+
+def update_watchlist(watchlist_id, watchlist):
+    with track('mongo'):
+        result = update_watchlist_db(watchlist_id, watchlist)
+    invalidate_watchlist(watchlist_id)
+    if watchlist.get('userId'):
+        invalidate_watchlists(watchlist['userId'])
+    return result
+
+
+def delete_watchlist(watchlist_id):
+    with track('mongo'):
+        result = delete_watchlist_db(watchlist_id)
+    invalidate_watchlist(watchlist_id)
+    return result
+
+
+def clear_caches():
+    user_cache.clear()
+    watchlists_cache.clear()
+    _watchlist_owners.clear()
+
+
+def get_cache_stats():
+    return {
+        'users': user_cache.stats(),
+        'watchlists': watchlists_cache.stats(),
+    }
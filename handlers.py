@@ -2,28 +2,51 @@ from telegram import (
     KeyboardButton,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
     ReplyKeyboardMarkup,
     ParseMode,
 )
 from telegram.ext import (
+    CommandHandler,
     ConversationHandler,
+    Filters,
 )
+import base64
+import binascii
 import logging
 import re
 from services.watchlists import get_car_message
+from services.matching_cache import matching_cars_cache
+from services.model_counts import ModelCounts
+from services.car_queries import COUNT_CAP, fetch_matching_cars_page, format_car_count
+from bot import db as bot_db
+from bot.broadcast import unblock_chat
 from bot.db import (
+    get_watchlist,
+    insert_feedback,
+)
+from bot.db_cache import (
     get_user,
     get_watchlists,
-    get_watchlist,
-    get_cars,
     insert_watchlist as insert_watchlist_db,
     update_watchlist as update_watchlist_db,
     delete_watchlist as remove_watchlist_db,
-    insert_feedback,
 )
-from bot.telegram_utils import create_buttons, create_menu
-from bot.letter_makes_utils import LETTER_MAKE_MODEL
-from utils.list_utils import chunks
+from bot.telegram_utils import create_buttons
+from models.watchlist_types import CarSummary, Watchlist
+from utils.instrumentation import instrument_handler, start_metrics_dump, track
+from bot.keyboards import (
+    LETTER_KEYBOARD,
+    MAKE_KEYBOARDS,
+    MODEL_KEYBOARDS,
+    parse_more_models,
+    YEARS_KEYBOARD,
+    CONFIRM_DETAILS_KEYBOARDS,
+    CAR_PARAMETERS_KEYBOARD,
+    YES_NO_KEYBOARD,
+)
+from utils.make_model_index import MAKE_MODEL_INDEX
 
 
 (
@@ -45,15 +68,22 @@ from utils.list_utils import chunks
     INPUT_FEEDBACK,
     CANCEL,
 ) = range(17)
-MODEL_PAGE_SIZE = 39
 INVALID_INPUT_MESSAGE = 'Sorry, I don\'t understand :( Please try again'
 
-RE_WATCHLIST = re.compile(r'(?P<make>\w+) (?P<model>\w+) (?P<min_year>\d+) (?P<max_year>\d+) (?P<max_mileage>\d+) (?P<max_price>\d+)', flags=re.IGNORECASE)
+RE_WATCHLIST = re.compile(r'^(?P<make_model>.+?)(?: (?P<min_year>\d{4}) (?P<max_year>\d{4}) (?P<max_mileage>\d+) (?P<max_price>\d+))?$', flags=re.IGNORECASE)
 RE_YEAR = re.compile(r'(?P<year>19\d{2}|20\d{2})$', flags=re.IGNORECASE)
 RE_NUMBER = re.compile(r'(?P<number>\d+)', flags=re.IGNORECASE)
 HOURGLASS_ICON = u'\U000023F3'
 ROCKET_ICON = u'\U0001F680'
 MAX_TOTAL_CARS = 30
+MAX_INLINE_RESULTS = 20
+# Deep-link /start payloads are at most 64 characters of [A-Za-z0-9_-]
+FIND_CAR_LINK_PREFIX = 'car-'
+MAX_START_PAYLOAD_LENGTH = 64
+INLINE_CACHE_SECONDS = 60
+model_counts = ModelCounts(lambda: bot_db.db)
+model_counts.load()
+start_metrics_dump()
 
 
 def build_watchlist(user, raw_watchlist):
@@ -82,7 +112,12 @@ def build_watchlist(user, raw_watchlist):
     return watchlist_doc
 
 
+@instrument_handler
 def start(update, context):
+    args = getattr(context, 'args', None)
+    if args and args[0].startswith(FIND_CAR_LINK_PREFIX):
+        # A deep link that reached the plain /start handler
+        return find_car(update, context)
     menu_options = [
         [KeyboardButton('/find_car')],
         [KeyboardButton('/list_watchlists')],
@@ -95,6 +130,8 @@ def start(update, context):
 
     keyboard = ReplyKeyboardMarkup(menu_options)
 
+    with track('mongo'):
+        unblock_chat(bot_db.db, update.effective_user.id)
     update.message.reply_text('Please choose:', reply_markup=keyboard)
 
 
@@ -104,11 +141,13 @@ def cancel_action(query, message):
     return ConversationHandler.END
 
 
+@instrument_handler
 def restart(update, context):
     update.message.reply_text('You don\'t have any watchlists')
     return start(update, context)
 
 
+@instrument_handler
 def list_watchlists(update, context):
     user = get_user(update.effective_user.id)
     watchlists = get_watchlists(user)
@@ -121,6 +160,7 @@ def list_watchlists(update, context):
     return SELECT_WATCHLIST
 
 
+@instrument_handler
 def show_watchlist_actions(update, context):
     query = update.callback_query
     watchlist_id = query.data
@@ -143,6 +183,7 @@ def show_watchlist_actions(update, context):
     return SELECT_WATCHLIST_ACTION
 
 
+@instrument_handler
 def perform_watchlist_action(update, context):
     query = update.callback_query
     option = query.data
@@ -163,6 +204,7 @@ def perform_watchlist_action(update, context):
         return ConversationHandler.END
 
 
+@instrument_handler
 def list_matching_cars(update, context):
     user = get_user(update.effective_user.id)
     watchlists = get_watchlists(user)
@@ -175,6 +217,7 @@ def list_matching_cars(update, context):
     return LIST_MATCHING_CARS
 
 
+@instrument_handler
 def list_cars_watchlist_selected(update, context):
     query = update.callback_query
     watchlist_id = query.data
@@ -186,7 +229,8 @@ def list_cars_watchlist_selected(update, context):
 
 def show_matching_car(query, watchlist_id, update, context):
     try:
-        watchlist = get_watchlist(watchlist_id)
+        with track('mongo'):
+            watchlist = get_watchlist(watchlist_id)
         query.answer()
         if not watchlist:
             query.edit_message_text('Error: such watchlist does not exist anymore')
@@ -198,22 +242,40 @@ def show_matching_car(query, watchlist_id, update, context):
     return ConversationHandler.END
 
 
-def find_and_print_cars(update, query, watchlist):
-    (cars, car_count) = get_cars(watchlist, MAX_TOTAL_CARS)
-    if not cars:
-        query.bot.send_message(query.message.chat_id, 'No cars found', parse_mode=ParseMode.MARKDOWN)
-    else:
-        query.bot.send_message(query.message.chat_id, f'Found {car_count} matching cars', parse_mode=ParseMode.MARKDOWN)
-        print_cars(update, cars, car_count)
+def fetch_car_summaries(watchlist):
+    (cars, car_count) = fetch_matching_cars_page(bot_db.db, watchlist, MAX_TOTAL_CARS, count_cap=COUNT_CAP, fields='summary')
+    return ([CarSummary.from_doc(car) for car in cars], car_count)
 
 
-def print_cars(update, cars, count):
-    query = update.callback_query
+def fetch_watchlist_cars(watchlist):
+    with track('mongo'):
+        return matching_cars_cache.get_or_fetch(
+            watchlist,
+            MAX_TOTAL_CARS,
+            lambda: fetch_car_summaries(watchlist),
+            db=bot_db.db,
+            extra=('summary',),
+        )
+
+
+def get_cars_messages(cars, car_count):
+    '''Returns the (text, send_message kwargs) messages listing the cars.'''
+    markdown = {'parse_mode': ParseMode.MARKDOWN}
+    if not cars:
+        return [('No cars found', markdown)]
+    messages = [(f'Found {format_car_count(car_count, COUNT_CAP)} matching cars', markdown)]
     for i, car in enumerate(cars):
         (url, message) = get_car_message(car)
-        query.bot.send_message(query.message.chat_id, f'{i + 1}.\n{message}')
-    if count > len(cars):
-        query.bot.send_message(query.message.chat_id, f'Displayed first {MAX_TOTAL_CARS} of out {count} cars.\n\nDue to Telegram limitations we can\'t display more.\n\nBut it\'ll be possible in our website that\'s coming soon {ROCKET_ICON}\n\nStay tuned!', parse_mode=ParseMode.MARKDOWN)
+        messages.append((f'{i + 1}.\n{message}', {}))
+    if car_count > len(cars):
+        messages.append((f'Displayed first {MAX_TOTAL_CARS} of out {format_car_count(car_count, COUNT_CAP)} cars.\n\nDue to Telegram limitations we can\'t display more.\n\nBut it\'ll be possible in our website that\'s coming soon {ROCKET_ICON}\n\nStay tuned!', markdown))
+    return messages
+
+
+def find_and_print_cars(update, query, watchlist):
+    (cars, car_count) = fetch_watchlist_cars(watchlist)
+    for (text, kwargs) in get_cars_messages(cars, car_count):
+        query.bot.send_message(query.message.chat_id, text, **kwargs)
 
 
 def print_watchlists(update, watchlists):
@@ -227,8 +289,8 @@ def print_watchlist(watchlist):
     model = watchlist['model']
     printing_watchlist = f'Make: *{make}*\nModel: *{model}*'
     if watchlist.get('year'):
-        min_year = watchlist['year']['min']
-        max_year = watchlist['year']['max']
+        min_year = watchlist['year'].get('min', '')
+        max_year = watchlist['year'].get('max', '')
         printing_watchlist += f'\nYears: *{min_year}-{max_year}*'
     if watchlist.get('mileage'):
         max_mileage = watchlist['mileage']['max']
@@ -240,20 +302,12 @@ def print_watchlist(watchlist):
 
 
 def print_watchlist_short(watchlist):
-    make = watchlist['make']
-    model = watchlist['model']
-    watchlist_str = f'{make} {model}'
-    if watchlist.get('year'):
-        min_year = int(watchlist['year']['min'])
-        max_year = int(watchlist['year']['max'])
-        watchlist_str += f' {min_year}-{max_year}'
-    if watchlist.get('mileage'):
-        max_mileage = int(watchlist['mileage']['max'])
-        watchlist_str += f' {max_mileage}mi'
-    if watchlist.get('price'):
-        max_price = int(watchlist['price']['max'])
-        watchlist_str += f' {max_price}'
-    return watchlist_str
+    if isinstance(watchlist, Watchlist):
+        return watchlist.short_label
+    try:
+        return Watchlist.from_doc(watchlist).short_label
+    except ValueError:
+        return f'{watchlist.get("make")} {watchlist.get("model")}'
 
 
 def get_watchlists_keyboard(watchlists):
@@ -267,6 +321,7 @@ def get_watchlists_keyboard(watchlists):
     return InlineKeyboardMarkup(keyboard)
 
 
+@instrument_handler
 def add_watchlist(update, context):
     context.user_data.pop('watchlist_id', None)
     context.user_data.pop('find_car', None)
@@ -281,16 +336,14 @@ def get_reply_func(update):
     return update.message.reply_text
 
 
+@instrument_handler
 def input_watchlist(update, context):
-    buttons = create_buttons(list(LETTER_MAKE_MODEL.keys()))
-    buttons.append(InlineKeyboardButton(text='/cancel', callback_data='/cancel'))
-
-    letter_keyboard = create_menu(buttons, n_cols=4)
     reply_func = get_reply_func(update)
-    reply_func('Select make first letter:', reply_markup=letter_keyboard)
+    reply_func('Select make first letter:', reply_markup=LETTER_KEYBOARD)
     return INPUT_WATCHLIST_LETTER
 
 
+@instrument_handler
 def watchlist_letter_inputted(update, context):
     query = update.callback_query
     letter = query.data
@@ -298,14 +351,11 @@ def watchlist_letter_inputted(update, context):
         return cancel_action(query, 'Adding watchlist cancelled')
     query.answer()
 
-    context.user_data['letter'] = letter
-    buttons = create_buttons(list(LETTER_MAKE_MODEL[letter].keys()))
-    buttons.append(InlineKeyboardButton(text='/cancel', callback_data='/cancel'))
-    make_keyboard = create_menu(buttons, n_cols=2)
-    query.bot.send_message(query.message.chat_id, 'Select make:', reply_markup=make_keyboard)
+    query.bot.send_message(query.message.chat_id, 'Select make:', reply_markup=MAKE_KEYBOARDS[letter])
     return INPUT_WATCHLIST_MAKE
 
 
+@instrument_handler
 def watchlist_make_inputted(update, context):
     query = update.callback_query
     make = query.data
@@ -314,55 +364,36 @@ def watchlist_make_inputted(update, context):
 
     query.answer()
     context.user_data['watchlist'] = {'make': make}
-    letter = context.user_data['letter']
-    models = [
-        model['title']
-        for model in LETTER_MAKE_MODEL[letter][make]['models']
-    ]
-
-    if len(models) > MODEL_PAGE_SIZE:
-        model_page = 0
-        model_pages = list(chunks(models, MODEL_PAGE_SIZE))
-        models = model_pages[model_page]
-        model_page += 1
-        context.user_data['model_pages'] = model_pages
-        context.user_data['model_page'] = model_page
-        return list_models(query, models, has_more_models=True)
+    model_pages = MODEL_KEYBOARDS[make]
+    return list_models(query, model_pages[0], has_more_models=len(model_pages) > 1)
 
-    return list_models(query, models, has_more_models=False)
 
-
-def list_models(query, models, has_more_models=False):
-    buttons = create_buttons(models)
+def list_models(query, model_keyboard, has_more_models=False):
     if has_more_models:
-        buttons.append(InlineKeyboardButton(text='more...', callback_data='more'))
         result = INPUT_WATCHLIST_MORE_MODELS
     else:
-        buttons.append(InlineKeyboardButton(text='/cancel', callback_data='/cancel'))
         result = INPUT_WATCHLIST_MODEL
 
-    model_keyboard = create_menu(buttons, n_cols=2)
     query.bot.send_message(query.message.chat_id, 'Select model:', reply_markup=model_keyboard)
     return result
 
 
+@instrument_handler
 def watchlist_more_models_selected(update, context):
     query = update.callback_query
-    model = query.data
-    if model != 'more':
+    more_models = parse_more_models(query.data)
+    if not more_models:
         return watchlist_model_inputted(update, context)
     query.answer()
 
-    model_pages = context.user_data['model_pages']
-    model_page = context.user_data['model_page']
-    models = model_pages[model_page]
-    model_page += 1
-    context.user_data['model_page'] = model_page
-
-    has_more_models = model_page < len(model_pages)
-    return list_models(query, models, has_more_models)
+    (make, model_page) = more_models
+    context.user_data.setdefault('watchlist', {})['make'] = make
+    model_pages = MODEL_KEYBOARDS[make]
+    has_more_models = model_page + 1 < len(model_pages)
+    return list_models(query, model_pages[model_page], has_more_models)
 
 
+@instrument_handler
 def watchlist_model_inputted(update, context):
     query = update.callback_query
     model = query.data
@@ -384,14 +415,51 @@ def watchlist_model_inputted(update, context):
     return INPUT_WATCHLIST_DETAILS_CONFIRM
 
 
+def parse_watchlist_text(text):
+    match = RE_WATCHLIST.match(' '.join(text.split()))
+    if not match:
+        return None
+    make_model = MAKE_MODEL_INDEX.resolve_text(match.group('make_model'))
+    if not make_model:
+        return None
+    (make, model) = make_model
+    raw_watchlist = {
+        key: value
+        for (key, value) in match.groupdict().items()
+        if key != 'make_model' and value
+    }
+    return {'make': make, 'model': model, **raw_watchlist}
+
+
+@instrument_handler
+def watchlist_text_inputted(update, context):
+    raw_watchlist = parse_watchlist_text(update.message.text)
+    if not raw_watchlist:
+        update.message.reply_text(INVALID_INPUT_MESSAGE)
+        return INPUT_WATCHLIST_LETTER
+    return show_parsed_watchlist(update, context, raw_watchlist)
+
+
+def show_parsed_watchlist(update, context, raw_watchlist):
+    context.user_data['watchlist'] = raw_watchlist
+    user = get_user(update.effective_user.id)
+    watchlist = build_watchlist(user, raw_watchlist)
+
+    if context.user_data.get('find_car'):
+        confirm_details_keyboard = get_confirm_details_keyboard('Find car')
+    else:
+        confirm_details_keyboard = get_confirm_details_keyboard('Save watchlist')
+
+    update.message.reply_text(print_watchlist(watchlist), parse_mode=ParseMode.MARKDOWN)
+    update.message.reply_text('Please choose:', reply_markup=confirm_details_keyboard)
+    return INPUT_WATCHLIST_DETAILS_CONFIRM
+
+
 def get_confirm_details_keyboard(first_button):
-    options = [first_button, 'Add more details']
-    buttons = create_buttons(options)
-    buttons.append(InlineKeyboardButton(text='/cancel', callback_data='/cancel'))
-    confirm_details_keyboard = create_menu(buttons, n_cols=2)
-    return confirm_details_keyboard
+    return CONFIRM_DETAILS_KEYBOARDS[first_button]
 
 
+@instrument_handler
 def save_watchlist(update, context):
     query = update.callback_query
     try:
@@ -408,6 +476,7 @@ def save_watchlist(update, context):
     return result
 
 
+@instrument_handler
 def confirm_watchlist_details(update, context):
     query = update.callback_query
     user_answer = query.data
@@ -420,21 +489,14 @@ def confirm_watchlist_details(update, context):
 
     try:
         query.answer()
-        options = [
-            'Add year',
-            'Add max mileage',
-            'Add max price'
-        ]
-        buttons = create_buttons(options)
-        buttons.append(InlineKeyboardButton(text='/cancel', callback_data='/cancel'))
-        options_keyboard = create_menu(buttons, n_cols=3)
-        query.bot.send_message(query.message.chat_id, 'Please choose:', reply_markup=options_keyboard)
+        query.bot.send_message(query.message.chat_id, 'Please choose:', reply_markup=CAR_PARAMETERS_KEYBOARD)
     except:
         query.bot.send_message(query.message.chat_id, 'An error occurred when listing cars', parse_mode=ParseMode.MARKDOWN)
 
     return INPUT_CAR_PARAMETERS
 
 
+@instrument_handler
 def input_car_parameters(update, context):
     query = update.callback_query
     option = query.data
@@ -458,6 +520,7 @@ def input_car_parameters(update, context):
         return INPUT_WATCHLIST_PRICE
 
 
+@instrument_handler
 def back_confirm_watchlist_details(update, context):
     query = update.callback_query
     user = get_user(update.effective_user.id)
@@ -477,12 +540,10 @@ def back_confirm_watchlist_details(update, context):
 
 
 def get_years_keyboard():
-    years = [x for x in range(2000, 2021)]
-    buttons = create_buttons(years)
-    buttons.append(InlineKeyboardButton(text='/cancel', callback_data='/cancel'))
-    return create_menu(buttons, n_cols=3)
+    return YEARS_KEYBOARD
 
 
+@instrument_handler
 def watchlist_from_year_inputted(update, context):
     query = update.callback_query
     from_year = query.data
@@ -495,6 +556,7 @@ def watchlist_from_year_inputted(update, context):
     return INPUT_WATCHLIST_TO_YEAR
 
 
+@instrument_handler
 def watchlist_to_year_inputted(update, context):
     query = update.callback_query
     to_year = query.data
@@ -504,6 +566,7 @@ def watchlist_to_year_inputted(update, context):
     return back_confirm_watchlist_details(update, context)
 
 
+@instrument_handler
 def watchlist_miles_inputted(update, context):
     match = RE_NUMBER.search(update.message.text)
     if not match:
@@ -515,6 +578,7 @@ def watchlist_miles_inputted(update, context):
     return back_confirm_watchlist_details(update, context)
 
 
+@instrument_handler
 def watchlist_price_inputted(update, context):
     match = RE_NUMBER.search(update.message.text)
     if not match:
@@ -526,11 +590,76 @@ def watchlist_price_inputted(update, context):
     return back_confirm_watchlist_details(update, context)
 
 
+def get_find_car_payload(make, model):
+    encoded = base64.urlsafe_b64encode(f'{make}\n{model}'.encode()).decode().rstrip('=')
+    payload = FIND_CAR_LINK_PREFIX + encoded
+    return payload if len(payload) <= MAX_START_PAYLOAD_LENGTH else None
+
+
+def parse_find_car_payload(payload):
+    if not payload.startswith(FIND_CAR_LINK_PREFIX):
+        return None
+    encoded = payload[len(FIND_CAR_LINK_PREFIX):]
+    try:
+        (make, model) = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)).decode().split('\n')
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    make_model = MAKE_MODEL_INDEX.resolve_exact(make, model)
+    return {'make': make_model[0], 'model': make_model[1]} if make_model else None
+
+
+@instrument_handler
 def find_car(update, context):
+    '''Also handles the "/start car-..." deep links of the inline query results.'''
     context.user_data['find_car'] = True
+    args = getattr(context, 'args', None)
+    if args:
+        raw_watchlist = parse_find_car_payload(args[0]) or parse_watchlist_text(' '.join(args))
+        if raw_watchlist:
+            return show_parsed_watchlist(update, context, raw_watchlist)
     return input_watchlist(update, context)
 
 
+# Entry point of the find_car conversation for the "/start car-..." deep
+# links, registered before the plain /start handler
+FIND_CAR_START_HANDLER = CommandHandler('start', find_car, filters=Filters.regex(f'^/start {FIND_CAR_LINK_PREFIX}'))
+
+
+def get_find_car_markup(bot, make, model):
+    payload = get_find_car_payload(make, model)
+    if not payload:
+        return None
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(f'Find {make} {model}', url=f'https://t.me/{bot.username}?start={payload}'),
+    ]])
+
+
+@instrument_handler
+def inline_car_query(update, context):
+    inline_query = update.inline_query
+    with track('mongo'):
+        counts = model_counts.get_counts()
+    make_models = MAKE_MODEL_INDEX.complete(
+        inline_query.query,
+        limit=MAX_INLINE_RESULTS,
+        rank=lambda make_model: -counts.get(make_model, 0),
+    )
+    results = [
+        InlineQueryResultArticle(
+            id=str(i),
+            title=f'{make} {model}',
+            description=f'{counts.get((make, model), 0)} cars',
+            # The message may be sent to any chat, so the search itself runs
+            # in a private chat with the bot through a deep link
+            input_message_content=InputTextMessageContent(f'{make} {model}: {counts.get((make, model), 0)} cars'),
+            reply_markup=get_find_car_markup(inline_query.bot, make, model),
+        )
+        for (i, (make, model)) in enumerate(make_models)
+    ]
+    inline_query.answer(results, cache_time=INLINE_CACHE_SECONDS)
+
+
+@instrument_handler
 def car_query_inputted(update, context):
     query = update.callback_query
     try:
@@ -547,11 +676,10 @@ def car_query_inputted(update, context):
     return offer_save_watchlist(update, context)
 
 
+@instrument_handler
 def offer_save_watchlist(update, context):
     query = update.callback_query
-    buttons = create_buttons(['Yes', 'No'])
-    answers_keyboard = create_menu(buttons, n_cols=2)
-    query.bot.send_message(query.message.chat_id, 'Would you like to get notifications about new such cars?', reply_markup=answers_keyboard)
+    query.bot.send_message(query.message.chat_id, 'Would you like to get notifications about new such cars?', reply_markup=YES_NO_KEYBOARD)
     return INPUT_WATCHLIST_DETAILS_CONFIRM
 
 
@@ -569,6 +697,7 @@ def watchlist_edited(query, watchlist, context):
     return ConversationHandler.END
 
 
+@instrument_handler
 def edit_watchlist(update, context):
     context.user_data.pop('find_car', None)
     user = get_user(update.effective_user.id)
@@ -582,6 +711,7 @@ def edit_watchlist(update, context):
     return SELECT_WATCHLIST_FOR_EDITING
 
 
+@instrument_handler
 def watchlist_selected_for_edit(update, context):
     query = update.callback_query
     watchlist_id = query.data
@@ -593,6 +723,7 @@ def watchlist_selected_for_edit(update, context):
     return input_watchlist(update, context)
 
 
+@instrument_handler
 def remove_watchlist(update, context):
     user = get_user(update.effective_user.id)
     watchlists = get_watchlists(user)
@@ -605,6 +736,7 @@ def remove_watchlist(update, context):
     return SELECT_WATCHLIST_FOR_REMOVAL
 
 
+@instrument_handler
 def watchlist_selected_for_removal(update, context):
     query = update.callback_query
     watchlist_id = query.data
@@ -624,23 +756,28 @@ def perform_watchlist_removal(query, watchlist_id):
         query.bot.send_message(query.message.chat_id, 'An error occurred when removing watchlist', parse_mode=ParseMode.MARKDOWN)
 
 
+@instrument_handler
 def contact_us(update, context):
     update.message.reply_text('What can we do for you?\nPlease input your message')
     return INPUT_FEEDBACK
 
 
+@instrument_handler
 def feedback_inputted(update, context):
     user = get_user(update.effective_user.id)
-    insert_feedback(user, update.message.text)
+    with track('mongo'):
+        insert_feedback(user, update.message.text)
     update.message.reply_text('Thank you! We\'re on it.')
     return ConversationHandler.END
 
 
+@instrument_handler
 def cancel_conversation(update, context):
     start(update, context)
     return ConversationHandler.END
 
 
+@instrument_handler
 def help(update, context):
     update.message.reply_text('Use /start to test this bot.')
 
@@ -0,0 +1,67 @@
+from pymongo import ASCENDING, IndexModel
+
+
+INDEXES = {
+    'watchlists': [
+        IndexModel([('userId', ASCENDING), ('_id', ASCENDING)], name='userId_id'),
+    ],
+    'cars': [
+        IndexModel(
+            [
+                ('carInfo.make', ASCENDING),
+                ('carInfo.model', ASCENDING),
+                ('carInfo.year', ASCENDING),
+                ('price.amount', ASCENDING),
+                ('mileage', ASCENDING),
+            ],
+            name='make_model_year_price_mileage',
+        ),
+        IndexModel(
+            [
+                ('carInfo.make', ASCENDING),
+                ('carInfo.model', ASCENDING),
+                ('_id', ASCENDING),
+            ],
+            name='make_model_id',
+        ),
+    ],
+}
+
+
+def ensure_indexes(db):
+    '''Creates the declared indexes. Run on deploy with python -m models.indexes.'''
+    for (collection, indexes) in INDEXES.items():
+        db[collection].create_indexes(indexes)
+
+
+def get_plan_stages(plan):
+    stages = [plan['stage']]
+    if plan.get('inputStage'):
+        stages += get_plan_stages(plan['inputStage'])
+    for input_stage in plan.get('inputStages', []):
+        stages += get_plan_stages(input_stage)
+    return stages
+
+
+def get_winning_plan(explain):
+    query_planner = explain.get('queryPlanner')
+    if not query_planner:
+        # Aggregations report the planner of their first $cursor stage
+        query_planner = explain['stages'][0]['$cursor']['queryPlanner']
+    winning_plan = query_planner['winningPlan']
+    return winning_plan.get('queryPlan', winning_plan)
+
+
+def uses_collection_scan(explain):
+    return 'COLLSCAN' in get_plan_stages(get_winning_plan(explain))
+
+
+def main():
+    from models import db
+    ensure_indexes(db)
+    for (collection, indexes) in INDEXES.items():
+        print(f'{collection}: {", ".join(index.document["name"] for index in indexes)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COMPONENTS = ('total', 'mongo', 'telegram', 'cpu')
+METRIC_NAME = 'carbot_latency_seconds'
+DUMP_INTERVAL_SECONDS = 60
+_local = threading.local()
+_bot_lock = threading.Lock()
+_dump_lock = threading.Lock()
+_dump_started = False
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+    def to_dict(self):
+        return {
+            'buckets': dict(zip([*map(str, self.buckets), '+Inf'], self.cumulative_counts())),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class Metrics:
+    '''Latency histograms per (kind, stage, component).
+
+    kind is 'handler' or 'route', stage the handler or endpoint name and
+    component one of COMPONENTS: total time split in Mongo, Telegram and
+    the remainder spent in our own code. Routes only report their total.
+    '''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, kind, stage, timings):
+        with self._lock:
+            for (component, seconds) in timings.items():
+                key = (kind, stage, component)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(self.buckets)
+                self.histograms[key].observe(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                f'{kind}:{stage}:{component}': histogram.to_dict()
+                for ((kind, stage, component), histogram) in sorted(self.histograms.items())
+            }
+
+    def render_prometheus(self):
+        lines = [
+            f'# HELP {METRIC_NAME} Latency of bot handlers and API routes by component.',
+            f'# TYPE {METRIC_NAME} histogram',
+        ]
+        with self._lock:
+            for ((kind, stage, component), histogram) in sorted(self.histograms.items()):
+                labels = f'kind="{kind}",stage="{stage}",component="{component}"'
+                for (bound, count) in zip([*map(str, histogram.buckets), '+Inf'], histogram.cumulative_counts()):
+                    lines.append(f'{METRIC_NAME}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{METRIC_NAME}_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'{METRIC_NAME}_count{{{labels}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        # Written next to the target and renamed, so readers never see half a file
+        partial_path = f'{path}.tmp'
+        with open(partial_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+        os.replace(partial_path, path)
+
+
+metrics = Metrics()
+
+
+def _get_frames():
+    if not hasattr(_local, 'frames'):
+        _local.frames = []
+    return _local.frames
+
+
+class track:
+    '''Adds the time spent in the block to a component of the current stage.'''
+
+    def __init__(self, component):
+        self.component = component
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        frames = _get_frames()
+        if frames:
+            frames[-1][self.component] += time.perf_counter() - self.started
+
+
+def timed(component):
+    '''Decorator version of track.'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track(component):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_stage():
+    _get_frames().append({'mongo': 0, 'telegram': 0, 'started': time.perf_counter()})
+
+
+def finish_stage(kind, stage, components=True):
+    frames = _get_frames()
+    if not frames:
+        return
+    frame = frames.pop()
+    total = time.perf_counter() - frame['started']
+    if not components:
+        metrics.observe(kind, stage, {'total': total})
+        return
+    metrics.observe(kind, stage, {
+        'total': total,
+        'mongo': frame['mongo'],
+        'telegram': frame['telegram'],
+        'cpu': max(0, total - frame['mongo'] - frame['telegram']),
+    })
+
+
+def instrument_bot(bot):
+    '''Times the Bot API requests of bot as telegram.
+
+    Every send, reply, answer and edit goes through bot.request. Bots without
+    one (like ptbtest's Mockbot) are left alone.
+    '''
+    request = getattr(bot, 'request', None)
+    if request is None:
+        return
+    with _bot_lock:
+        if getattr(request, 'instrumented', False):
+            return
+        request.post = timed('telegram')(request.post)
+        request.get = timed('telegram')(request.get)
+        request.instrumented = True
+
+
+def instrument_handler(handler):
+    '''Records the latency of a conversation callback.
+
+    A handler called by another one (restart calling start) is part of the
+    outer stage and isn't recorded on its own.
+    '''
+    @functools.wraps(handler)
+    def wrapper(update, context, *args, **kwargs):
+        if _get_frames():
+            return handler(update, context, *args, **kwargs)
+        instrument_bot(getattr(context, 'bot', None))
+        start_stage()
+        try:
+            return handler(update, context, *args, **kwargs)
+        finally:
+            finish_stage('handler', handler.__name__)
+    return wrapper
+
+
+def init_app(app):
+    from flask import request
+
+    @app.before_request
+    def start_request_stage():
+        start_stage()
+
+    @app.teardown_request
+    def finish_request_stage(exception):
+        # Routes query Mongo directly, so only their total is known
+        finish_stage('route', request.endpoint or 'unknown', components=False)
+
+    start_metrics_dump()
+
+
+def start_metrics_dump(path=None, interval=None):
+    '''Dumps the metrics as JSON to path every interval seconds and at exit.
+
+    path and interval default to the METRICS_DUMP_PATH and
+    METRICS_DUMP_INTERVAL environment variables; without a path nothing is
+    dumped. Only the first call starts the dump.
+    '''
+    global _dump_started
+    path = path or os.environ.get('METRICS_DUMP_PATH')
+    if not path:
+        return False
+    interval = interval or float(os.environ.get('METRICS_DUMP_INTERVAL', DUMP_INTERVAL_SECONDS))
+    with _dump_lock:
+        if _dump_started:
+            return False
+        _dump_started = True
+
+    def dump_periodically():
+        while True:
+            time.sleep(interval)
+            metrics.dump(path)
+
+    threading.Thread(target=dump_periodically, name='metrics-dump', daemon=True).start()
+    atexit.register(metrics.dump, path)
+    return True
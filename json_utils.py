@@ -0,0 +1,51 @@
+'''JSON encoding for REST responses.
+
+The default json encoder writes exactly what json.dumps(obj, default=str)
+wrote before: default separators, non-ASCII escaped, NaN as NaN, and
+ObjectIds, datetimes ("2020-05-01 12:30:00") and Decimal128s as str().
+
+orjson can't write the default separators, and re-spacing its output costs
+more than the json C encoder saves, so it is opt-in (set_encoder('orjson'))
+for clients that accept compact JSON. It encodes datetimes with str() too,
+and payloads with non-ASCII text or a null (which may have been a NaN) go
+through the json encoder, so only whitespace differs.
+'''
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps_json(obj):
+    return json.dumps(obj, default=str)
+
+
+def dumps_orjson(obj):
+    try:
+        encoded = orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+    except TypeError:
+        # e.g. integers wider than 64 bits
+        return dumps_json(obj)
+    if not encoded.isascii() or b'null' in encoded:
+        return dumps_json(obj)
+    return encoded.decode('ascii')
+
+
+ENCODERS = {
+    'json': dumps_json,
+}
+if orjson:
+    ENCODERS['orjson'] = dumps_orjson
+
+_encoder = ENCODERS['json']
+
+
+def set_encoder(name):
+    global _encoder
+    _encoder = ENCODERS[name]
+
+
+def dumps(obj):
+    return _encoder(obj)
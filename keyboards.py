@@ -0,0 +1,134 @@
+import hashlib
+import re
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from bot.telegram_utils import create_buttons, create_menu
+from bot.letter_makes_utils import LETTER_MAKE_MODEL
+from utils.list_utils import chunks
+
+
+MODEL_PAGE_SIZE = 39
+MORE_MODELS = 'more'
+# Telegram limits callback data to 64 bytes, leaving room for 'more:' and the page
+MAX_MAKE_KEY_BYTES = 48
+YEARS = range(2000, 2021)
+CAR_PARAMETER_OPTIONS = [
+    'Add year',
+    'Add max mileage',
+    'Add max price'
+]
+
+
+class FrozenInlineKeyboardMarkup(InlineKeyboardMarkup):
+    '''Inline keyboard that is serialized once and shared between users.'''
+
+    def __init__(self, inline_keyboard):
+        super().__init__(tuple(tuple(row) for row in inline_keyboard))
+        self._dict = super().to_dict()
+        self._json = super().to_json()
+
+    def to_dict(self):
+        return self._dict
+
+    def to_json(self):
+        return self._json
+
+
+def freeze(markup):
+    return FrozenInlineKeyboardMarkup(markup.inline_keyboard)
+
+
+def cancel_button():
+    return InlineKeyboardButton(text='/cancel', callback_data='/cancel')
+
+
+def build_menu(options, n_cols, last_button=None):
+    buttons = create_buttons(options)
+    if last_button:
+        buttons.append(last_button)
+    return freeze(create_menu(buttons, n_cols=n_cols))
+
+
+def get_models(letter, make):
+    return [
+        model['title']
+        for model in LETTER_MAKE_MODEL[letter][make]['models']
+    ]
+
+
+def get_make_key(make, taken=()):
+    '''Returns the callback data key of a make.
+
+    The key is the normalized make name, so buttons sent before the makes
+    change still resolve to the same make. Names too long for the callback
+    data, or colliding with a taken key, use a short hash of the name.
+    '''
+    key = re.sub('[^a-z0-9]+', '-', make.lower()).strip('-')
+    if not key or len(key.encode()) > MAX_MAKE_KEY_BYTES or key in taken:
+        key = hashlib.sha1(make.encode()).hexdigest()[:10]
+    return key
+
+
+def get_make_keys(makes):
+    make_keys = {}
+    for make in makes:
+        make_keys[make] = get_make_key(make, taken=make_keys.values())
+    return make_keys
+
+
+def more_models_button(make_key, page):
+    return InlineKeyboardButton(text='more...', callback_data=f'{MORE_MODELS}:{make_key}:{page}')
+
+
+def parse_more_models(data):
+    parts = data.split(':')
+    if len(parts) != 3 or parts[0] != MORE_MODELS:
+        return None
+    make = MAKES_BY_KEY.get(parts[1])
+    try:
+        page = int(parts[2])
+    except ValueError:
+        return None
+    if make is None or not 0 < page < len(MODEL_KEYBOARDS[make]):
+        return None
+    return (make, page)
+
+
+def build_model_pages(make_key, models):
+    pages = list(chunks(models, MODEL_PAGE_SIZE)) or [[]]
+    return tuple(
+        build_menu(
+            page,
+            n_cols=2,
+            last_button=(
+                more_models_button(make_key, i + 1)
+                if i + 1 < len(pages)
+                else cancel_button()
+            ),
+        )
+        for (i, page) in enumerate(pages)
+    )
+
+
+LETTER_KEYBOARD = build_menu(list(LETTER_MAKE_MODEL.keys()), n_cols=4, last_button=cancel_button())
+MAKE_KEYBOARDS = {
+    letter: build_menu(list(makes.keys()), n_cols=2, last_button=cancel_button())
+    for (letter, makes) in LETTER_MAKE_MODEL.items()
+}
+MAKES = tuple(
+    (letter, make)
+    for (letter, makes) in LETTER_MAKE_MODEL.items()
+    for make in makes
+)
+MAKE_KEYS = get_make_keys(make for (_, make) in MAKES)
+MAKES_BY_KEY = {key: make for (make, key) in MAKE_KEYS.items()}
+MODEL_KEYBOARDS = {
+    make: build_model_pages(MAKE_KEYS[make], get_models(letter, make))
+    for (letter, make) in MAKES
+}
+YEARS_KEYBOARD = build_menu(list(YEARS), n_cols=3, last_button=cancel_button())
+CONFIRM_DETAILS_KEYBOARDS = {
+    first_button: build_menu([first_button, 'Add more details'], n_cols=2, last_button=cancel_button())
+    for first_button in ['Find car', 'Save watchlist']
+}
+CAR_PARAMETERS_KEYBOARD = build_menu(CAR_PARAMETER_OPTIONS, n_cols=3, last_button=cancel_button())
+YES_NO_KEYBOARD = build_menu(['Yes', 'No'], n_cols=2)
@@ -0,0 +1,229 @@
+import heapq
+import re
+import unicodedata
+from bisect import bisect_left
+from bot.letter_makes_utils import LETTER_MAKE_MODEL
+from utils.make_model_utils import MAKE_WITH_MODEL_NAMES
+
+
+RE_NOT_ALPHANUMERIC = re.compile(r'[^a-z0-9]')
+MIN_PREFIX_LENGTH = 3
+MIN_FUZZY_SCORE = 0.5
+PREFIX_SCORE = 0.9
+MAX_COMPLETIONS = 20
+MAKE_ALIASES = {
+    'chevy': 'Chevrolet',
+    'vw': 'Volkswagen',
+    'volks': 'Volkswagen',
+    'mercedes': 'Mercedes-Benz',
+    'merc': 'Mercedes-Benz',
+    'benz': 'Mercedes-Benz',
+    'mb': 'Mercedes-Benz',
+    'bimmer': 'BMW',
+    'beemer': 'BMW',
+    'landy': 'Land Rover',
+    'alfa': 'Alfa Romeo',
+    'caddy': 'Cadillac',
+}
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', str(text)).encode('ascii', 'ignore').decode('ascii')
+    return RE_NOT_ALPHANUMERIC.sub('', text.lower())
+
+
+def get_trigrams(key):
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    '''Resolves free-text names to canonical ones.
+
+    Tries, in order, the exact normalized name or alias, a unique prefix of
+    a normalized name and the closest name by trigram similarity. Returns
+    (name, score) with score 1 for exact matches, or None.
+    '''
+
+    def __init__(self, names, aliases=None):
+        self.names = {}
+        for name in names:
+            self.names.setdefault(normalize(name), name)
+        self.aliases = {
+            normalize(alias): name
+            for (alias, name) in (aliases or {}).items()
+            if normalize(name) in self.names
+        }
+        self.keys = sorted(self.names)
+        self.trigrams = {}
+        for key in self.keys:
+            for trigram in get_trigrams(key):
+                self.trigrams.setdefault(trigram, []).append(key)
+
+    def find_prefix(self, key):
+        i = bisect_left(self.keys, key)
+        matches = []
+        while i < len(self.keys) and self.keys[i].startswith(key) and len(matches) < 2:
+            matches.append(self.keys[i])
+            i += 1
+        return matches
+
+    def find_fuzzy(self, key):
+        trigrams = get_trigrams(key)
+        shared = {}
+        for trigram in trigrams:
+            for candidate in self.trigrams.get(trigram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        best = None
+        for (candidate, count) in shared.items():
+            score = count / (len(trigrams) + len(get_trigrams(candidate)) - count)
+            if score < MIN_FUZZY_SCORE:
+                continue
+            if not best or score > best[1] or (score == best[1] and candidate < best[0]):
+                best = (candidate, score)
+        return best
+
+    def resolve(self, text):
+        key = normalize(text) if text else None
+        if not key:
+            return None
+        if key in self.names:
+            return (self.names[key], 1)
+        if key in self.aliases:
+            return (self.aliases[key], 1)
+        if len(key) >= MIN_PREFIX_LENGTH:
+            prefixed = self.find_prefix(key)
+            if len(prefixed) == 1:
+                return (self.names[prefixed[0]], PREFIX_SCORE)
+        fuzzy = self.find_fuzzy(key)
+        if fuzzy:
+            return (self.names[fuzzy[0]], fuzzy[1])
+        return None
+
+    def __contains__(self, name):
+        return normalize(name) in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+
+class MakeModelIndex:
+    '''Canonical makes with their models for resolving user input.'''
+
+    def __init__(self, make_models, aliases=MAKE_ALIASES):
+        self.make_models = {}
+        for (make, models) in make_models.items():
+            self.make_models.setdefault(make, []).extend(models)
+        self.makes = NameIndex(self.make_models, aliases)
+        self.models = {make: NameIndex(models) for (make, models) in self.make_models.items()}
+        self.completions = self.build_completions()
+        self.completion_keys = [key for (key, _, _) in self.completions]
+
+    def build_completions(self):
+        # Every model is reachable by its own name and by its make or any make
+        # alias followed by its name, e.g. "golf", "volkswagengolf", "vwgolf"
+        make_keys = {}
+        for (alias, make) in self.makes.aliases.items():
+            make_keys.setdefault(make, set()).add(alias)
+        completions = set()
+        for (make, models) in self.make_models.items():
+            keys = {normalize(make)} | make_keys.get(make, set())
+            for model in models:
+                model_key = normalize(model)
+                completions.add((model_key, make, model))
+                completions.update((key + model_key, make, model) for key in keys)
+        return sorted(completions)
+
+    @classmethod
+    def from_letter_make_model(cls, letter_make_model, aliases=MAKE_ALIASES):
+        return cls({
+            make: [model['title'] for model in details['models']]
+            for makes in letter_make_model.values()
+            for (make, details) in makes.items()
+        }, aliases)
+
+    @classmethod
+    def from_make_model_names(cls, make_model_names, aliases=MAKE_ALIASES):
+        return cls({
+            make: [model['title'] if isinstance(model, dict) else model for model in models]
+            for (make, models) in make_model_names.items()
+        }, aliases)
+
+    @classmethod
+    def merge(cls, *indexes, aliases=MAKE_ALIASES):
+        make_models = {}
+        for index in indexes:
+            for (make, models) in index.make_models.items():
+                merged = make_models.setdefault(make, [])
+                merged.extend(model for model in models if model not in merged)
+        return cls(make_models, aliases)
+
+    def resolve_make(self, text):
+        resolved = self.makes.resolve(text)
+        return resolved[0] if resolved else None
+
+    def resolve_model(self, make, text):
+        models = self.models.get(make)
+        resolved = models.resolve(text) if models else None
+        return resolved[0] if resolved else None
+
+    def resolve(self, make, model):
+        '''Returns the canonical (make, model) or None when either is unknown.'''
+        make = self.resolve_make(make)
+        if not make:
+            return None
+        model = self.resolve_model(make, model)
+        return (make, model) if model else None
+
+    def resolve_exact(self, make, model):
+        '''Like resolve, but only accepts exact names and aliases.'''
+        make = self.makes.resolve(make)
+        if not make or make[1] != 1:
+            return None
+        model = self.models[make[0]].resolve(model)
+        return (make[0], model[0]) if model and model[1] == 1 else None
+
+    def complete(self, text, limit=MAX_COMPLETIONS, rank=None):
+        '''Returns up to limit (make, model) pairs starting with text.
+
+        Pairs are in key order unless rank is given, a sort key for the
+        pairs; every pair starting with text is ranked before truncating.
+        Falls back to resolve_text for input that isn't a prefix.
+        '''
+        key = normalize(text) if text else None
+        if not key:
+            return []
+        i = bisect_left(self.completion_keys, key)
+        matches = {}
+        while i < len(self.completions) and self.completion_keys[i].startswith(key):
+            if not rank and len(matches) == limit:
+                break
+            (_, make, model) = self.completions[i]
+            matches.setdefault((make, model), None)
+            i += 1
+        if not matches:
+            resolved = self.resolve_text(text)
+            return [resolved] if resolved else []
+        if rank:
+            return heapq.nsmallest(limit, matches, key=rank)
+        return list(matches)
+
+    def resolve_text(self, text):
+        '''Splits free text like "chevy camaro" into a canonical (make, model).'''
+        words = text.split()
+        best = None
+        for i in range(1, len(words)):
+            make = self.makes.resolve(' '.join(words[:i]))
+            if not make:
+                continue
+            model = self.models[make[0]].resolve(' '.join(words[i:]))
+            if model and (not best or make[1] * model[1] > best[0]):
+                best = (make[1] * model[1], make[0], model[0])
+        return best[1:] if best else None
+
+
+# The bot keyboards and the REST API both store these canonical names
+MAKE_MODEL_INDEX = MakeModelIndex.merge(
+    MakeModelIndex.from_letter_make_model(LETTER_MAKE_MODEL),
+    MakeModelIndex.from_make_model_names(MAKE_WITH_MODEL_NAMES),
+)
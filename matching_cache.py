@@ -0,0 +1,180 @@
+import threading
+import time
+from collections import OrderedDict
+import bson
+
+
+CACHE_TTL_SECONDS = 60
+MAX_CACHED_BYTES = 64 * 1024 * 1024
+MAX_CACHED_ENTRIES = 10000
+# Key, list and bookkeeping of an entry, so empty results count too
+ENTRY_OVERHEAD_BYTES = 512
+VERSION_CHECK_SECONDS = 5
+CARS_VERSION_ID = 'cars'
+
+
+def get_criteria_key(watchlist, limit, *extra):
+    year = watchlist.get('year') or {}
+    mileage = watchlist.get('mileage') or {}
+    price = watchlist.get('price') or {}
+
+    def to_int(value):
+        return None if value is None else int(value)
+
+    return (
+        watchlist['make'],
+        watchlist['model'],
+        to_int(year.get('min')),
+        to_int(year.get('max')),
+        to_int(mileage.get('max')),
+        to_int(price.get('max')),
+        limit,
+    ) + extra
+
+
+def bump_cars_version(db):
+    '''Called by the ingestion job after new cars are written.'''
+    db['meta'].update_one({'_id': CARS_VERSION_ID}, {'$inc': {'version': 1}}, upsert=True)
+
+
+def get_cars_version(db):
+    meta = db['meta'].find_one({'_id': CARS_VERSION_ID})
+    return meta['version'] if meta else 0
+
+
+def estimate_car_size(car):
+    # The BSON size tracks the size of the decoded dict closely enough
+    if not isinstance(car, dict):
+        car = car.to_doc()
+    return len(bson.encode(car))
+
+
+def estimate_size(result):
+    cars = result[0] if isinstance(result, tuple) else result
+    return ENTRY_OVERHEAD_BYTES + sum(estimate_car_size(car) for car in cars)
+
+
+class MatchingCarsCache:
+    '''Caches matching car results by normalized watchlist criteria.
+
+    Entries expire after a TTL and are dropped as soon as the cars version in
+    Mongo changes. A result fetched while the version changed is not stored.
+    The cache is bounded by the estimated size of the cached cars and by the
+    number of entries, evicting least recently used entries first. Cached
+    lists are shared, so callers must not mutate them.
+    '''
+
+    def __init__(self, ttl=CACHE_TTL_SECONDS, max_bytes=MAX_CACHED_BYTES, max_entries=MAX_CACHED_ENTRIES, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.clock = clock
+        self.version = None
+        self.version_checked = None
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def sync_version(self, db):
+        '''Returns the cars version, read from Mongo at most every few seconds.'''
+        now = self.clock()
+        if self.version_checked is None or now - self.version_checked >= VERSION_CHECK_SECONDS:
+            self.version_checked = now
+            self.set_version(get_cars_version(db))
+        return self.version
+
+    def set_version(self, version):
+        with self._lock:
+            if version != self.version:
+                self.version = version
+                self._items.clear()
+                self._size = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item and item[0] > self.clock():
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def set(self, key, result, version=None, size=None):
+        '''Stores result unless the cars version moved past version.'''
+        if size is None:
+            size = estimate_size(result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (self.clock() + self.ttl, result, size)
+            self._size += size
+            while self._size > self.max_bytes or len(self._items) > self.max_entries:
+                (_, (_, _, evicted_size)) = self._items.popitem(last=False)
+                self._size -= evicted_size
+
+    def _remove(self, key):
+        (_, _, size) = self._items.pop(key)
+        self._size -= size
+
+    def get_or_fetch(self, watchlist, limit, fetch, db=None, extra=()):
+        version = self.sync_version(db) if db is not None else None
+        key = get_criteria_key(watchlist, limit, *extra)
+        result = self.get(key)
+        if result is None:
+            result = fetch()
+            self.set(key, result, version)
+        return result
+
+    def get_or_stream(self, watchlist, limit, fetch, db=None, extra=()):
+        '''Like get_or_fetch, but a miss streams the fetched cursor.
+
+        The cars are cached once the cursor is exhausted, so a client that
+        disconnects early leaves nothing behind.
+        '''
+        version = self.sync_version(db) if db is not None else None
+        key = get_criteria_key(watchlist, limit, *extra)
+        result = self.get(key)
+        if result is not None:
+            return result
+        return self._stream(key, fetch(), version)
+
+    def _stream(self, key, cursor, version):
+        cars = []
+        size = ENTRY_OVERHEAD_BYTES
+        for car in cursor:
+            if cars is not None:
+                cars.append(car)
+                size += estimate_car_size(car)
+                if size > self.max_bytes:
+                    cars = None
+            yield car
+        if cars is not None:
+            # The version may have changed while the client read the stream
+            self.set(key, cars, version, size=size)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._items),
+                'bytes': self._size,
+                'version': self.version,
+            }
+
+
+matching_cars_cache = MatchingCarsCache()
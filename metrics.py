@@ -0,0 +1,21 @@
+from flask import Response
+from flask_jwt_extended import jwt_required
+from app import app
+from utils.instrumentation import init_app, metrics
+from utils.json_utils import dumps
+from routes.processes import create_response
+
+
+init_app(app)
+
+
+@app.route('/metrics', methods=['GET'])
+@jwt_required
+def get_metrics():
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/metrics.json', methods=['GET'])
+@jwt_required
+def get_metrics_json():
+    return create_response(dumps(metrics.to_dict()))
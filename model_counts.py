@@ -0,0 +1,77 @@
+import logging
+import threading
+import time
+from utils.make_model_index import MAKE_MODEL_INDEX
+
+
+MODEL_COUNTS_TTL_SECONDS = 300
+MODEL_COUNTS_PIPELINE = [
+    {
+        '$group': {
+            '_id': {'make': '$carInfo.make', 'model': '$carInfo.model'},
+            'count': {'$sum': 1},
+        }
+    }
+]
+
+
+class ModelCounts:
+    '''Number of listed cars per canonical (make, model).
+
+    load() reads the counts once at startup. After that get_counts() never
+    waits for Mongo: it returns the last loaded counts and starts a refresh
+    in the background when they are older than ttl. Only a call before any
+    load has finished waits for one.
+    '''
+
+    def __init__(self, get_db, ttl=MODEL_COUNTS_TTL_SECONDS, clock=time.monotonic):
+        self.get_db = get_db
+        self.ttl = ttl
+        self.clock = clock
+        self.counts = {}
+        self.loaded_at = None
+        self._refreshing = threading.Lock()
+
+    def refresh(self):
+        results = self.get_db()['cars'].aggregate(MODEL_COUNTS_PIPELINE)
+        counts = {}
+        for result in results:
+            # Listings spell makes and models in many ways, the index ranks
+            # canonical names
+            make_model = MAKE_MODEL_INDEX.resolve_exact(result['_id'].get('make'), result['_id'].get('model'))
+            if make_model:
+                counts[make_model] = counts.get(make_model, 0) + result['count']
+        self.counts = counts
+        self.loaded_at = self.clock()
+
+    def load(self):
+        '''Loads the counts unless they were loaded already, waiting for Mongo.'''
+        with self._refreshing:
+            if self.loaded_at is not None:
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.getLogger().warning(f'Failed to load model counts: {e}')
+                # Retried in the background after the ttl
+                self.loaded_at = self.clock()
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logging.getLogger().warning(f'Failed to refresh model counts: {e}')
+            # Retry after the ttl instead of on every call
+            self.loaded_at = self.clock()
+        finally:
+            self._refreshing.release()
+
+    def is_stale(self):
+        return self.loaded_at is None or self.clock() - self.loaded_at > self.ttl
+
+    def get_counts(self):
+        if self.loaded_at is None:
+            self.load()
+        elif self.is_stale() and self._refreshing.acquire(blocking=False):
+            threading.Thread(target=self._refresh_in_background, name='model-counts', daemon=True).start()
+        return self.counts
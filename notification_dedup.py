@@ -0,0 +1,180 @@
+import re
+import threading
+import time
+from array import array
+from hashlib import blake2b
+from bson.objectid import ObjectId
+
+
+DEDUP_TTL_SECONDS = 30 * 24 * 60 * 60
+DEDUP_STATE_ID = 'notified'
+# 8 bytes per hash, so a shard document stays at 4 MB
+HASHES_PER_SHARD = 500000
+RE_NOT_ALPHANUMERIC = re.compile(r'[^a-z0-9]')
+
+
+def normalize(value):
+    return RE_NOT_ALPHANUMERIC.sub('', str(value).lower())
+
+
+def get_car_location(car):
+    posts = car.get('post') or []
+    if posts and posts[0].get('city'):
+        return normalize(posts[0]['city'])
+    return normalize((car.get('address') or {}).get('line1') or '')
+
+
+def get_car_identity(car):
+    car_info = car.get('carInfo') or {}
+    vin = normalize(car_info.get('vin') or '')
+    if vin:
+        return f'vin:{vin}'
+
+    # Reposts get a new postId, possibly on another platform, but keep the
+    # car details, the price and the location
+    details = [
+        car_info.get('make'),
+        car_info.get('model'),
+        car_info.get('year'),
+        car.get('mileage'),
+        (car.get('price') or {}).get('amount'),
+    ]
+    location = get_car_location(car)
+    if location and all(detail is not None for detail in details):
+        return 'car:' + ':'.join(normalize(detail) for detail in details) + f':{location}'
+
+    posts = car.get('post') or []
+    if posts and posts[0].get('postId'):
+        platform = normalize(posts[0].get('platform') or '')
+        return f'post:{platform}:{normalize(posts[0]["postId"])}'
+    return None
+
+
+def get_pair_digest(watchlist_id, identity):
+    digest = blake2b(f'{watchlist_id}:{identity}'.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class NotifiedStore:
+    '''Remembers which (watchlist, car) pairs were already notified.
+
+    Pairs are stored as 64-bit hashes in two generations; the older one is
+    dropped every ttl / 2, so a pair is remembered for between half and the
+    full ttl. filter_new marks the pairs it returns as pending until add()
+    records them as sent, so a car matched twice before its message goes
+    out is only queued once; pending pairs are dropped on rotation. Cars
+    without a VIN, full details or post key can't be identified and are
+    always reported as new. Saved state is split over shard documents of
+    HASHES_PER_SHARD hashes to stay under the Mongo document size limit.
+    '''
+
+    def __init__(self, ttl=DEDUP_TTL_SECONDS, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.current = set()
+        self.previous = set()
+        self.pending = set()
+        self.rotated_at = clock()
+        self._lock = threading.Lock()
+
+    def _rotate(self):
+        now = self.clock()
+        elapsed = now - self.rotated_at
+        if elapsed < self.ttl / 2:
+            return
+        if elapsed >= self.ttl:
+            self.previous = set()
+        else:
+            self.previous = self.current
+        self.current = set()
+        self.pending = set()
+        self.rotated_at = now
+
+    def _get_digest(self, watchlist_id, car):
+        identity = get_car_identity(car)
+        return None if identity is None else get_pair_digest(watchlist_id, identity)
+
+    def check_and_add(self, watchlist_id, car):
+        digest = self._get_digest(watchlist_id, car)
+        if digest is None:
+            return True
+        with self._lock:
+            self._rotate()
+            if digest in self.current or digest in self.previous:
+                return False
+            self.current.add(digest)
+            return True
+
+    def is_new(self, watchlist_id, car):
+        digest = self._get_digest(watchlist_id, car)
+        if digest is None:
+            return True
+        with self._lock:
+            self._rotate()
+            return digest not in self.current and digest not in self.previous
+
+    def add(self, watchlist_id, car):
+        digest = self._get_digest(watchlist_id, car)
+        if digest is None:
+            return
+        with self._lock:
+            self._rotate()
+            self.pending.discard(digest)
+            self.current.add(digest)
+
+    def filter_new(self, watchlist_id, cars):
+        '''Returns the cars neither notified nor pending, marking them pending.'''
+        new_cars = []
+        with self._lock:
+            self._rotate()
+            for car in cars:
+                digest = self._get_digest(watchlist_id, car)
+                if digest is None:
+                    new_cars.append(car)
+                elif digest not in self.current and digest not in self.previous and digest not in self.pending:
+                    self.pending.add(digest)
+                    new_cars.append(car)
+        return new_cars
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+    def save(self, db, state_id=DEDUP_STATE_ID):
+        with self._lock:
+            generations = {'current': sorted(self.current), 'previous': sorted(self.previous)}
+            rotated_at = self.rotated_at
+
+        # Shards of a new version are written before the state points to
+        # them, so a crash mid-save leaves the previous version loadable
+        version = ObjectId()
+        shards = [
+            {
+                'stateId': state_id,
+                'version': version,
+                'generation': generation,
+                'hashes': array('Q', digests[i:i + HASHES_PER_SHARD]).tobytes(),
+            }
+            for (generation, digests) in generations.items()
+            for i in range(0, len(digests), HASHES_PER_SHARD)
+        ]
+        if shards:
+            db['notification_dedup_shards'].insert_many(shards)
+        db['notification_dedup'].replace_one(
+            {'_id': state_id},
+            {'version': version, 'rotatedAt': rotated_at},
+            upsert=True
+        )
+        db['notification_dedup_shards'].delete_many({'stateId': state_id, 'version': {'$ne': version}})
+
+    def load(self, db, state_id=DEDUP_STATE_ID):
+        state = db['notification_dedup'].find_one({'_id': state_id})
+        if not state:
+            return
+        generations = {'current': array('Q'), 'previous': array('Q')}
+        shards = db['notification_dedup_shards'].find({'stateId': state_id, 'version': state['version']})
+        for shard in shards:
+            generations[shard['generation']].frombytes(shard['hashes'])
+        with self._lock:
+            self.current = set(generations['current'])
+            self.previous = set(generations['previous'])
+            self.rotated_at = state['rotatedAt']
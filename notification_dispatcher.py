@@ -0,0 +1,234 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from telegram.error import RetryAfter, TelegramError
+from services.watchlists import get_car_message
+
+
+MAX_MESSAGE_LENGTH = 4096
+MAX_CARS_PER_MESSAGE = 10
+GLOBAL_MESSAGES_PER_SECOND = 30
+CHAT_MESSAGES_PER_SECOND = 1
+MAX_SEND_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 1
+CAR_SEPARATOR = '\n\n'
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+
+def group_car_messages(items, get_text=lambda item: item):
+    '''Splits items into runs whose car messages fit in one Telegram message.'''
+    groups = []
+    current = []
+    length = 0
+    for item in items:
+        car_message = get_text(item)
+        extra = len(car_message) + (len(CAR_SEPARATOR) if current else 0)
+        if current and (len(current) == MAX_CARS_PER_MESSAGE or length + extra > MAX_MESSAGE_LENGTH):
+            groups.append(current)
+            current = []
+            extra = len(car_message)
+            length = 0
+        current.append(item)
+        length += extra
+    if current:
+        groups.append(current)
+    return groups
+
+
+def merge_car_messages(car_messages):
+    return [CAR_SEPARATOR.join(group) for group in group_car_messages(car_messages)]
+
+
+class NotificationDispatcher:
+    '''Groups matched cars per chat and sends them within Telegram rate limits.
+
+    Cars queued for the same chat are merged into as few messages as
+    possible, chats are served round-robin, and sends are paced with a global
+    and a per-chat token bucket. A chat hit by flood control is deferred for
+    the delay requested by Telegram while the other chats are served, and a
+    failed send is requeued with exponential backoff; after MAX_SEND_ATTEMPTS
+    failures in a row the message is dropped.
+
+    queued counts the add_matches calls so far and flushed how many of them
+    have all their messages sent or dropped, so callers can tell when their
+    matches are done. on_sent(car) is called for every car once the message
+    holding it was delivered.
+    '''
+
+    def __init__(
+        self,
+        bot,
+        global_rate=GLOBAL_MESSAGES_PER_SECOND,
+        chat_rate=CHAT_MESSAGES_PER_SECOND,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.clock = clock
+        self.sleep = sleep
+        self.global_bucket = TokenBucket(global_rate, clock=clock)
+        self.chat_buckets = {}
+        self.queued = 0
+        self.flushed = 0
+        self._pending = OrderedDict()
+        # chat_id -> (failed attempts, monotonic time of the next attempt)
+        self._retries = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def add_matches(self, chat_id, cars, on_sent=None):
+        with self._lock:
+            self.queued += 1
+            car_messages = [(get_car_message(car)[1], car, on_sent, self.queued) for car in cars]
+            if car_messages:
+                self._pending.setdefault(chat_id, []).extend(car_messages)
+            return self.queued
+
+    def pending_chats(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _take_pending(self):
+        now = self.clock()
+        with self._lock:
+            queues = OrderedDict()
+            for chat_id in list(self._pending):
+                retry = self._retries.get(chat_id)
+                if retry and retry[1] > now:
+                    continue
+                queues[chat_id] = deque(group_car_messages(self._pending.pop(chat_id), lambda item: item[0]))
+            return (self.queued, queues)
+
+    def _requeue(self, chat_id, groups):
+        with self._lock:
+            items = [item for group in groups for item in group]
+            self._pending[chat_id] = items + self._pending.get(chat_id, [])
+
+    def _update_flushed(self, queued):
+        with self._lock:
+            seqs = [items[0][3] for items in self._pending.values() if items]
+            self.flushed = max(self.flushed, min([queued, *(seq - 1 for seq in seqs)]))
+
+    def _get_chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if not bucket:
+            bucket = TokenBucket(self.chat_rate, clock=self.clock)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _evict_idle_buckets(self):
+        # A full bucket behaves like a new one, so it can be dropped
+        with self._lock:
+            for (chat_id, bucket) in list(self.chat_buckets.items()):
+                if chat_id not in self._pending and bucket.delay() == 0 and bucket.tokens >= bucket.capacity:
+                    del self.chat_buckets[chat_id]
+
+    def _send(self, chat_id, text):
+        '''Returns None once sent, otherwise the seconds to wait before retrying.'''
+        attempts = self._retries.get(chat_id, (0, 0))[0]
+        try:
+            self.bot.send_message(chat_id, text)
+            return None
+        except RetryAfter as e:
+            logging.getLogger().warning(f'Flood control for chat {chat_id}, retrying in {e.retry_after}s')
+            return e.retry_after
+        except TelegramError as e:
+            logging.getLogger().warning(f'Failed to notify chat {chat_id}: {e}')
+            return RETRY_BACKOFF_SECONDS * 2 ** attempts
+
+    def flush(self):
+        with self._flush_lock:
+            (queued, queues) = self._take_pending()
+            sent = self._send_queues(queues)
+            self._update_flushed(queued)
+            self._evict_idle_buckets()
+        return sent
+
+    def _send_queues(self, queues):
+        sent = 0
+        while queues:
+            global_delay = self.global_bucket.delay()
+            if global_delay:
+                self.sleep(global_delay)
+                continue
+
+            ready_chat_id = None
+            min_delay = None
+            for chat_id in queues:
+                delay = self._get_chat_bucket(chat_id).delay()
+                if not delay:
+                    ready_chat_id = chat_id
+                    break
+                min_delay = delay if min_delay is None else min(min_delay, delay)
+            if ready_chat_id is None:
+                self.sleep(min_delay)
+                continue
+
+            messages = queues.pop(ready_chat_id)
+            self.global_bucket.consume()
+            self._get_chat_bucket(ready_chat_id).consume()
+            group = messages[0]
+            retry_in = self._send(ready_chat_id, CAR_SEPARATOR.join(car_message for (car_message, _, _, _) in group))
+            if retry_in is None:
+                sent += 1
+                self._retries.pop(ready_chat_id, None)
+                messages.popleft()
+                for (_, car, on_sent, _) in group:
+                    if on_sent:
+                        on_sent(car)
+            else:
+                attempts = self._retries.get(ready_chat_id, (0, 0))[0] + 1
+                if attempts < MAX_SEND_ATTEMPTS:
+                    # The chat waits for its next attempt in the pending queue
+                    self._retries[ready_chat_id] = (attempts, self.clock() + retry_in)
+                    self._requeue(ready_chat_id, messages)
+                    continue
+                logging.getLogger().warning(f'Dropping a message to chat {ready_chat_id} after {attempts} attempts')
+                self._retries.pop(ready_chat_id, None)
+                messages.popleft()
+            if messages:
+                queues[ready_chat_id] = messages
+        return sent
+
+    def start(self, interval=1):
+        def run():
+            while not self._stopped.wait(interval):
+                self.flush()
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=run, name='notification-dispatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
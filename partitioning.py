@@ -0,0 +1,256 @@
+import logging
+import math
+import threading
+import zlib
+from datetime import datetime, timedelta
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+from models.watchlist_types import parse_watchlists
+from services.watchlist_index import WatchlistIndex
+from services.notification_dedup import DEDUP_STATE_ID
+from services.notification_dispatcher import NotificationDispatcher
+from services.streaming_matcher import StreamingMatcher, create_dispatcher_notifier
+
+
+PARTITION_COUNT = 64
+LEASE_SECONDS = 30
+REBALANCE_SECONDS = 10
+
+
+def get_partition(user_id, partition_count=PARTITION_COUNT):
+    return zlib.crc32(str(user_id).encode('utf-8')) % partition_count
+
+
+class PartitionLeases:
+    '''Spreads watchlist partitions over the live workers with Mongo leases.
+
+    Every worker heartbeats into worker_heartbeats and holds leases on its
+    partitions in partition_leases. On each rebalance it renews its leases,
+    gives up partitions above its fair share and takes over free or expired
+    ones, so workers can join and leave at any time. Each lease also keeps
+    matchedThrough, the newest car _id its owner has matched and notified,
+    so the next owner knows where to catch up from.
+    '''
+
+    def __init__(self, db, worker_id, partition_count=PARTITION_COUNT, lease_seconds=LEASE_SECONDS, clock=datetime.utcnow):
+        self.db = db
+        self.worker_id = worker_id
+        self.partition_count = partition_count
+        self.lease_seconds = lease_seconds
+        self.clock = clock
+
+    def _expires_at(self):
+        return self.clock() + timedelta(seconds=self.lease_seconds)
+
+    def heartbeat(self):
+        self.db['worker_heartbeats'].update_one(
+            {'_id': self.worker_id},
+            {'$set': {'expiresAt': self._expires_at()}},
+            upsert=True
+        )
+
+    def count_live_workers(self):
+        return self.db['worker_heartbeats'].count_documents({'expiresAt': {'$gt': self.clock()}})
+
+    def get_owned(self):
+        leases = self.db['partition_leases'].find(
+            {'owner': self.worker_id, 'expiresAt': {'$gt': self.clock()}},
+            {'_id': True}
+        )
+        return {lease['_id'] for lease in leases}
+
+    def renew(self):
+        self.db['partition_leases'].update_many(
+            {'owner': self.worker_id, 'expiresAt': {'$gt': self.clock()}},
+            {'$set': {'expiresAt': self._expires_at()}}
+        )
+
+    def acquire(self, partition):
+        try:
+            self.db['partition_leases'].update_one(
+                {
+                    '_id': partition,
+                    '$or': [
+                        {'owner': self.worker_id},
+                        {'expiresAt': {'$lte': self.clock()}},
+                    ],
+                },
+                {'$set': {'owner': self.worker_id, 'expiresAt': self._expires_at()}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def get_marks(self, partitions):
+        leases = self.db['partition_leases'].find(
+            {'_id': {'$in': list(partitions)}},
+            {'matchedThrough': True}
+        )
+        return {lease['_id']: lease.get('matchedThrough') for lease in leases}
+
+    def mark(self, partitions, car_id):
+        self.db['partition_leases'].update_many(
+            {'_id': {'$in': list(partitions)}, 'owner': self.worker_id},
+            {'$max': {'matchedThrough': car_id}}
+        )
+
+    def release(self, partition):
+        # Expire instead of deleting, so matchedThrough survives the handover
+        self.db['partition_leases'].update_one(
+            {'_id': partition, 'owner': self.worker_id},
+            {'$set': {'expiresAt': self.clock()}}
+        )
+
+    def release_all(self):
+        self.db['partition_leases'].update_many(
+            {'owner': self.worker_id},
+            {'$set': {'expiresAt': self.clock()}}
+        )
+        self.db['worker_heartbeats'].delete_one({'_id': self.worker_id})
+
+    def rebalance(self):
+        self.heartbeat()
+        self.renew()
+        owned = self.get_owned()
+        target = math.ceil(self.partition_count / max(1, self.count_live_workers()))
+
+        for partition in sorted(owned, reverse=True)[:max(0, len(owned) - target)]:
+            self.release(partition)
+            owned.discard(partition)
+
+        # Start probing at a worker specific offset to avoid racing for the
+        # same free partitions
+        offset = get_partition(self.worker_id, self.partition_count)
+        for i in range(self.partition_count):
+            if len(owned) >= target:
+                break
+            partition = (offset + i) % self.partition_count
+            if partition not in owned and self.acquire(partition):
+                owned.add(partition)
+        return owned
+
+
+class PartitionedMatcher(StreamingMatcher):
+    '''StreamingMatcher that only indexes watchlists of its owned partitions.
+
+    set_partitions may be called from any thread; the new partitions are
+    applied by the matcher thread between changes. Cars of a taken over
+    partition that its previous owner hadn't matched yet are matched from
+    the lease's matchedThrough mark.
+    '''
+
+    def __init__(self, db, notify, partition_count=PARTITION_COUNT, leases=None, **kwargs):
+        super().__init__(db, notify, **kwargs)
+        self.partition_count = partition_count
+        self.leases = leases
+        self.partitions = set()
+        self._next_partitions = None
+        self._lock = threading.Lock()
+
+    def owns(self, watchlist, partitions=None):
+        return get_partition(watchlist['userId'], self.partition_count) in (partitions or self.partitions)
+
+    def load_watchlists(self):
+        watchlists = self.db['watchlists'].find()
+        self.index = WatchlistIndex(parse_watchlists(watchlist for watchlist in watchlists if self.owns(watchlist)))
+        self.index_loaded = self.clock()
+
+    def set_partitions(self, partitions):
+        with self._lock:
+            self._next_partitions = set(partitions)
+
+    def apply_updates(self):
+        with self._lock:
+            (partitions, self._next_partitions) = (self._next_partitions, None)
+        if partitions is None or partitions == self.partitions:
+            return
+        taken_over = partitions - self.partitions
+        self.partitions = partitions
+        self.load_watchlists()
+        if taken_over and self.leases:
+            self.catch_up(taken_over)
+
+    def catch_up(self, partitions):
+        marks = {partition: mark for (partition, mark) in self.leases.get_marks(partitions).items() if mark}
+        if not marks:
+            return
+        car_filter = {'_id': {'$gt': min(marks.values())}}
+        if self.last_car_id:
+            # Later cars still come through this matcher's own feed
+            car_filter['_id']['$lte'] = self.last_car_id
+        for car in self.db['cars'].find(car_filter).sort('_id', ASCENDING):
+            for watchlist in self.index.match(car):
+                mark = marks.get(get_partition(watchlist['userId'], self.partition_count))
+                if mark and car['_id'] > mark:
+                    self.notify(watchlist, [car])
+
+    def save_checkpoint(self, resume_token, last_car_id):
+        super().save_checkpoint(resume_token, last_car_id)
+        if self.leases and last_car_id:
+            self.leases.mark(self.partitions, last_car_id)
+
+    def handle_change(self, change):
+        document = change.get('fullDocument')
+        if change['ns']['coll'] == 'watchlists' and document and not self.owns(document):
+            self.index.remove(document['_id'])
+            return 0
+        return super().handle_change(change)
+
+
+class ShardWorker:
+    '''Matches the watchlists of its partitions and sends their notifications.
+
+    Every worker has its own NotificationDispatcher, so the send queue and
+    the resume token stay with the partitions being matched. A notified
+    store is loaded when the worker starts and saved once its dispatcher
+    has stopped, under a state id of its own.
+    '''
+
+    def __init__(self, db, worker_id, bot, notified=None, partition_count=PARTITION_COUNT):
+        self.db = db
+        self.notified = notified
+        self.notified_state_id = f'{DEDUP_STATE_ID}:{worker_id}'
+        self.leases = PartitionLeases(db, worker_id, partition_count=partition_count)
+        self.dispatcher = NotificationDispatcher(bot)
+        self.matcher = PartitionedMatcher(
+            db,
+            create_dispatcher_notifier(db, self.dispatcher, notified),
+            partition_count=partition_count,
+            leases=self.leases,
+            dispatcher=self.dispatcher,
+            state_id=f'streaming_matcher:{worker_id}',
+        )
+        self._stopped = threading.Event()
+
+    def rebalance(self):
+        partitions = self.leases.rebalance()
+        if partitions != self.matcher.partitions:
+            logging.getLogger().info(f'Worker {self.leases.worker_id} owns {len(partitions)} partitions')
+        self.matcher.set_partitions(partitions)
+
+    def run(self):
+        if self.notified is not None:
+            self.notified.load(self.db, self.notified_state_id)
+        self.rebalance()
+
+        def rebalance_periodically():
+            while not self._stopped.wait(REBALANCE_SECONDS):
+                self.rebalance()
+
+        thread = threading.Thread(target=rebalance_periodically, name='partition-rebalance', daemon=True)
+        thread.start()
+        self.dispatcher.start()
+        try:
+            self.matcher.run()
+        finally:
+            self._stopped.set()
+            thread.join()
+            self.dispatcher.stop()
+            self.leases.release_all()
+            if self.notified is not None:
+                self.notified.save(self.db, self.notified_state_id)
+
+    def stop(self):
+        self._stopped.set()
+        self.matcher.stop()
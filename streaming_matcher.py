@@ -0,0 +1,323 @@
+import functools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import timedelta
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+from models.watchlist_types import parse_watchlists
+from services.matching_cache import bump_cars_version
+from services.watchlist_index import WatchlistIndex, load_watchlist_index
+
+
+STREAM_STATE_ID = 'streaming_matcher'
+SAVE_RESUME_TOKEN_EVERY = 100
+POLL_INTERVAL_SECONDS = 2
+POLL_BATCH_SIZE = 500
+# Inserts with an _id older than the newest seen car by up to this much are
+# still picked up by the polling feed
+POLL_LOOKBACK_SECONDS = 60
+WATCHLIST_RELOAD_SECONDS = 60
+MAX_CACHED_CHAT_IDS = 10000
+CAR_MATCH_FIELDS = ('carInfo', 'mileage', 'price')
+CHANGE_STREAM_PIPELINE = [
+    {
+        '$match': {
+            'ns.coll': {'$in': ['cars', 'watchlists']},
+            'operationType': {'$in': ['insert', 'update', 'replace', 'delete']},
+        }
+    }
+]
+
+
+class ChangeStreamFeed:
+    '''Changes of the cars and watchlists collections from a Mongo change stream.'''
+
+    name = 'change_stream'
+    tracks_watchlists = True
+
+    def __init__(self, db, resume_token=None):
+        self.stream = db.watch(
+            CHANGE_STREAM_PIPELINE,
+            full_document='updateLookup',
+            resume_after=resume_token,
+        )
+
+    def next_change(self):
+        return self.stream.try_next()
+
+    @property
+    def resume_token(self):
+        return self.stream.resume_token
+
+    def close(self):
+        self.stream.close()
+
+
+class PollingFeed:
+    '''Stand-in for deployments without change streams (standalone Mongo).
+
+    Reports inserted cars by scanning the cars collection in _id order. An
+    _id is generated by the client, so a car can be inserted after cars with
+    larger _ids; every pass therefore starts POLL_LOOKBACK_SECONDS before
+    the newest car seen and skips the cars it already reported. A feed
+    starts, or resumes, after the cars up to its start position; a car with
+    an older _id inserted around a restart is missed. The feed doesn't see
+    watchlist changes, so the matcher reloads watchlists periodically
+    instead.
+    '''
+
+    name = 'polling'
+    tracks_watchlists = False
+
+    def __init__(self, db, resume_token=None, interval=POLL_INTERVAL_SECONDS, lookback=POLL_LOOKBACK_SECONDS, sleep=time.sleep):
+        self.db = db
+        self.interval = interval
+        self.lookback = timedelta(seconds=lookback)
+        self.sleep = sleep
+        self.buffer = []
+        self.seen = set()
+        if resume_token:
+            self.last_car_id = resume_token['lastCarId']
+        else:
+            # Like a change stream, a fresh feed starts at the current end
+            last_car = self.db['cars'].find_one({}, {'_id': True}, sort=[('_id', -1)])
+            self.last_car_id = last_car['_id'] if last_car else None
+        self.scan_after = self.get_window_start()
+        if self.scan_after:
+            # Cars up to the start position count as reported
+            window = {'_id': {'$gt': self.scan_after, '$lte': self.last_car_id}}
+            self.seen = {car['_id'] for car in self.db['cars'].find(window, {'_id': True})}
+
+    def get_window_start(self):
+        if not self.last_car_id:
+            return None
+        return ObjectId.from_datetime(self.last_car_id.generation_time - self.lookback)
+
+    def fill_buffer(self):
+        '''Reads the next page of the pass, returning False once the pass is done.'''
+        query = {'_id': {'$gt': self.scan_after}} if self.scan_after else {}
+        cars = list(self.db['cars'].find(query).sort('_id', ASCENDING).limit(POLL_BATCH_SIZE))
+        self.buffer = [car for car in reversed(cars) if car['_id'] not in self.seen]
+        if len(cars) == POLL_BATCH_SIZE:
+            self.scan_after = cars[-1]['_id']
+            return True
+        # The next pass rescans the lookback window for late inserts
+        self.scan_after = self.get_window_start()
+        if self.scan_after:
+            self.seen = {car_id for car_id in self.seen if car_id > self.scan_after}
+        return False
+
+    def next_change(self):
+        if not self.buffer:
+            more = self.fill_buffer()
+            if not self.buffer:
+                if not more:
+                    self.sleep(self.interval)
+                return None
+        car = self.buffer.pop()
+        self.seen.add(car['_id'])
+        if not self.last_car_id or car['_id'] > self.last_car_id:
+            self.last_car_id = car['_id']
+        return {
+            'operationType': 'insert',
+            'ns': {'coll': 'cars'},
+            'documentKey': {'_id': car['_id']},
+            'fullDocument': car,
+        }
+
+    @property
+    def resume_token(self):
+        return {'lastCarId': self.last_car_id} if self.last_car_id else None
+
+    def close(self):
+        pass
+
+
+def is_car_match_update(change):
+    if change['operationType'] != 'update':
+        return True
+    updated_fields = change.get('updateDescription', {}).get('updatedFields', {})
+    return any(
+        field.split('.')[0] in CAR_MATCH_FIELDS
+        for field in updated_fields
+    )
+
+
+class StreamingMatcher:
+    '''Matches cars against watchlists as they change instead of in batches.
+
+    notify(watchlist, cars) is called for every watchlist matched by an
+    inserted car, or by a car whose make, model, year, mileage or price
+    changed. The feed position is stored in the stream_state collection so
+    a restarted matcher continues where it stopped; the position is stored
+    with the feed type and ignored by the other feed. When notify queues into
+    a NotificationDispatcher, pass it as dispatcher: a position is then only
+    stored once the matches queued before it have been flushed. Car changes
+    bump the cars version at every checkpoint, which drops the cached
+    matching cars results.
+    '''
+
+    def __init__(self, db, notify, state_id=STREAM_STATE_ID, dispatcher=None, clock=time.monotonic):
+        self.db = db
+        self.notify = notify
+        self.state_id = state_id
+        self.dispatcher = dispatcher
+        self.clock = clock
+        self.index = WatchlistIndex()
+        self.index_loaded = None
+        self.last_car_id = None
+        self.cars_changed = False
+        self.feed_name = None
+        self._checkpoints = deque()
+        self._stopped = threading.Event()
+
+    def load_watchlists(self):
+        self.index = load_watchlist_index(self.db)
+        self.index_loaded = self.clock()
+
+    def load_resume_token(self, feed_name=None):
+        '''Returns the saved position, or None when it was saved by another feed.'''
+        state = self.db['stream_state'].find_one({'_id': self.state_id})
+        if not state or not state.get('resumeToken'):
+            return None
+        if feed_name and state.get('feed') != feed_name:
+            logging.getLogger().warning(f'Ignoring the {state.get("feed")} resume token for the {feed_name} feed')
+            return None
+        return state['resumeToken']
+
+    def save_resume_token(self, resume_token):
+        if resume_token is None:
+            return
+        self.db['stream_state'].update_one(
+            {'_id': self.state_id},
+            {'$set': {'resumeToken': resume_token, 'feed': self.feed_name}},
+            upsert=True
+        )
+
+    def save_checkpoint(self, resume_token, last_car_id):
+        self.save_resume_token(resume_token)
+
+    def checkpoint(self, resume_token):
+        if self.cars_changed:
+            bump_cars_version(self.db)
+            self.cars_changed = False
+        if self.dispatcher is None:
+            self.save_checkpoint(resume_token, self.last_car_id)
+            return
+        self._checkpoints.append((self.dispatcher.queued, resume_token, self.last_car_id))
+        self.save_flushed_checkpoint()
+
+    def save_flushed_checkpoint(self):
+        flushed = None
+        while self._checkpoints and self._checkpoints[0][0] <= self.dispatcher.flushed:
+            flushed = self._checkpoints.popleft()
+        if flushed:
+            self.save_checkpoint(flushed[1], flushed[2])
+
+    def apply_updates(self):
+        '''Called on the matcher thread between changes.'''
+
+    def handle_change(self, change):
+        collection = change['ns']['coll']
+        operation = change['operationType']
+        document = change.get('fullDocument')
+
+        if collection == 'watchlists':
+            # An edit that makes a watchlist invalid also drops it from the index
+            self.index.remove(change['documentKey']['_id'])
+            if operation != 'delete' and document:
+                for watchlist in parse_watchlists([document]):
+                    self.index.add(watchlist)
+            return 0
+
+        if collection != 'cars':
+            return 0
+        self.cars_changed = True
+        if operation == 'delete' or not document:
+            return 0
+        if self.last_car_id is None or document['_id'] > self.last_car_id:
+            self.last_car_id = document['_id']
+        if not is_car_match_update(change):
+            return 0
+        watchlists = self.index.match(document)
+        for watchlist in watchlists:
+            self.notify(watchlist, [document])
+        return len(watchlists)
+
+    def create_feed(self):
+        try:
+            return ChangeStreamFeed(self.db, self.load_resume_token(ChangeStreamFeed.name))
+        except PyMongoError as e:
+            logging.getLogger().warning(f'Change streams unavailable ({e}), polling cars instead')
+            return PollingFeed(self.db, self.load_resume_token(PollingFeed.name))
+
+    def run(self, feed=None):
+        self._stopped.clear()
+        self._checkpoints.clear()
+        self.load_watchlists()
+        feed = feed or self.create_feed()
+        self.feed_name = feed.name
+        unsaved = 0
+        try:
+            while not self._stopped.is_set():
+                self.apply_updates()
+                if not feed.tracks_watchlists and self.clock() - self.index_loaded > WATCHLIST_RELOAD_SECONDS:
+                    self.load_watchlists()
+                change = feed.next_change()
+                if change is None:
+                    if unsaved:
+                        self.checkpoint(feed.resume_token)
+                        unsaved = 0
+                    elif self._checkpoints:
+                        self.save_flushed_checkpoint()
+                    continue
+                self.handle_change(change)
+                unsaved += 1
+                if unsaved >= SAVE_RESUME_TOKEN_EVERY:
+                    self.checkpoint(feed.resume_token)
+                    unsaved = 0
+        finally:
+            if unsaved:
+                self.checkpoint(feed.resume_token)
+            if self._checkpoints:
+                self.dispatcher.flush()
+                self.save_flushed_checkpoint()
+            feed.close()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def create_dispatcher_notifier(db, dispatcher, notified=None, max_chat_ids=MAX_CACHED_CHAT_IDS):
+    # Only found users are cached, so a user who signs up later is notified
+    chat_ids = OrderedDict()
+
+    def get_chat_id(user_id):
+        if user_id in chat_ids:
+            chat_ids.move_to_end(user_id)
+            return chat_ids[user_id]
+        user = db['users'].find_one({'_id': user_id}, {'telegram.id': True})
+        chat_id = (user or {}).get('telegram', {}).get('id')
+        if chat_id is None:
+            return None
+        chat_ids[user_id] = chat_id
+        if len(chat_ids) > max_chat_ids:
+            chat_ids.popitem(last=False)
+        return chat_ids[user_id]
+
+    def notify(watchlist, cars):
+        on_sent = None
+        if notified is not None:
+            cars = notified.filter_new(watchlist['_id'], cars)
+            if not cars:
+                return
+            # Pairs are remembered only once the message went out
+            on_sent = functools.partial(notified.add, watchlist['_id'])
+        chat_id = get_chat_id(watchlist['userId'])
+        if chat_id is not None:
+            dispatcher.add_matches(chat_id, cars, on_sent=on_sent)
+
+    return notify
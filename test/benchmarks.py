@@ -0,0 +1,279 @@
+'''Benchmarks of the car queries, matching, formatting and conversation hot paths.
+
+Runs against generated data in mongomock, so results are comparable
+between runs of the same machine rather than with production numbers.
+With --real-mongo the queries run on the indexed REAL_TEST_MONGODB_DB
+database of REAL_TEST_MONGODB_URI instead, which is dropped first.
+
+    python test/benchmarks.py --save baseline.json
+    python test/benchmarks.py --compare baseline.json
+    python test/benchmarks.py --real-mongo --save real-baseline.json
+'''
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import mongomock
+import pymongo
+import ptbtest
+from bson.objectid import ObjectId
+from telegram import Message
+from telegram.ext import Dispatcher
+
+from bot import db as bot_db
+from bot.db_cache import clear_caches
+from bot.handlers import (
+    MAX_TOTAL_CARS,
+    add_watchlist,
+    build_watchlist,
+    confirm_watchlist_details,
+    watchlist_letter_inputted,
+    watchlist_make_inputted,
+    watchlist_model_inputted,
+)
+from bot.keyboards import MAKE_KEYS, MAKES, build_model_pages, get_models
+from bot.letter_makes_utils import LETTER_MAKE_MODEL
+from models.indexes import ensure_indexes
+from models.watchlist_types import parse_watchlists
+from services.car_queries import COUNT_CAP, count_matching_cars, fetch_cars_page, fetch_matching_cars_page
+from services.car_snapshot import CarSnapshot
+from services.matching_cache import matching_cars_cache
+from services.watchlist_index import WatchlistIndex
+from services.watchlists import get_car_message
+
+
+DEFAULT_SEED = 42
+DEFAULT_CARS = 5000
+DEFAULT_WATCHLISTS = 500
+DEFAULT_REPEAT = 5
+API_PAGE_SIZE = 10
+REGRESSION_THRESHOLD = 0.2
+PLATFORMS = ('craigslist', 'facebook', 'autotrader')
+
+
+def get_make_models():
+    return [
+        (letter, make, model['title'])
+        for (letter, makes) in LETTER_MAKE_MODEL.items()
+        for (make, details) in makes.items()
+        for model in details['models']
+    ]
+
+
+def get_skewed_picker(rng):
+    # A few popular models take most of the listings and watchlists
+    make_models = get_make_models()
+    rng.shuffle(make_models)
+    weights = [1 / (rank + 1) for rank in range(len(make_models))]
+    return lambda: rng.choices(make_models, weights)[0]
+
+
+def generate_cars(count, seed=DEFAULT_SEED):
+    rng = random.Random(seed)
+    pick = get_skewed_picker(rng)
+    cars = []
+    for i in range(count):
+        (_, make, model) = pick()
+        platform = rng.choice(PLATFORMS)
+        cars.append({
+            '_id': ObjectId(f'{i:024x}'),
+            'post': [{
+                'platform': platform,
+                'postId': str(i),
+                'postUrl': f'https://{platform}.example.com/{i}',
+                'title': f'{make} {model}',
+            }],
+            'carInfo': {
+                'year': rng.randint(1995, 2020),
+                'make': make,
+                'model': model,
+            },
+            'price': {
+                'amount': rng.randrange(500, 40000, 50),
+                'currency': 'USD'
+            },
+            'mileage': rng.randrange(0, 300000, 1000),
+        })
+    return cars
+
+
+def generate_watchlists(count, seed=DEFAULT_SEED):
+    rng = random.Random(seed + 1)
+    pick = get_skewed_picker(rng)
+    watchlists = []
+    for i in range(count):
+        (_, make, model) = pick()
+        raw_watchlist = {'make': make, 'model': model}
+        if rng.random() < 0.5:
+            raw_watchlist['min_year'] = rng.randint(1995, 2015)
+            raw_watchlist['max_year'] = rng.randint(raw_watchlist['min_year'], 2020)
+        if rng.random() < 0.5:
+            raw_watchlist['max_mileage'] = rng.randrange(50000, 300000, 10000)
+        if rng.random() < 0.7:
+            raw_watchlist['max_price'] = rng.randrange(2000, 40000, 500)
+        watchlist = build_watchlist({'_id': ObjectId(f'{i % 100:024x}')}, raw_watchlist)
+        watchlist['_id'] = ObjectId(f'{i + 1:024x}')
+        watchlists.append(watchlist)
+    return watchlists
+
+
+def measure(func, repeat, number=1):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - started) / number)
+    return {'best': min(timings), 'median': statistics.median(timings)}
+
+
+def run_conversation(mock_bot, update):
+    user = update.effective_user
+    message = Message(message_id='1', from_user=user, date=datetime.today(), chat=update.effective_chat)
+    queries = ptbtest.callbackquerygenerator.CallbackQueryGenerator(bot=mock_bot)
+    context = Dispatcher(bot=mock_bot, update_queue=update)
+
+    add_watchlist(update, context)
+    for (handler, data) in [
+        (watchlist_letter_inputted, 'T'),
+        (watchlist_make_inputted, 'Toyota'),
+        (watchlist_model_inputted, 'Aqua'),
+        (confirm_watchlist_details, 'Save watchlist'),
+    ]:
+        handler(queries.get_callback_query(user=user, message=message, data=data), context)
+    mock_bot.reset()
+
+
+def get_database(real_mongo=False):
+    if not real_mongo:
+        return mongomock.MongoClient().db
+    client = pymongo.MongoClient(os.environ['REAL_TEST_MONGODB_URI'])
+    client.drop_database(os.environ['REAL_TEST_MONGODB_DB'])
+    db = client[os.environ['REAL_TEST_MONGODB_DB']]
+    ensure_indexes(db)
+    return db
+
+
+def run_benchmarks(cars_count, watchlists_count, repeat, seed=DEFAULT_SEED, real_mongo=False):
+    cars = generate_cars(cars_count, seed)
+    watchlists = generate_watchlists(watchlists_count, seed)
+    db = get_database(real_mongo)
+    db['cars'].insert_many(cars)
+    bot_db._set_db(db)
+    sample = watchlists[:20]
+    results = {}
+
+    def fetch_bot_sample():
+        for watchlist in sample:
+            fetch_matching_cars_page(db, watchlist, MAX_TOTAL_CARS, count_cap=COUNT_CAP, fields='summary')
+    results['fetch_matching_cars_page'] = measure(fetch_bot_sample, repeat)
+    results['fetch_matching_cars_page']['per'] = len(sample)
+
+    def fetch_api_sample():
+        for watchlist in sample:
+            list(fetch_cars_page(db, watchlist, API_PAGE_SIZE))
+            count_matching_cars(db, watchlist)
+    results['fetch_cars_page'] = measure(fetch_api_sample, repeat)
+    results['fetch_cars_page']['per'] = len(sample)
+
+    index = WatchlistIndex(parse_watchlists(watchlists))
+    results['watchlist_index_match_cars'] = measure(lambda: index.match_cars(cars), repeat)
+    results['watchlist_index_match_cars']['per'] = len(cars)
+
+    snapshot = CarSnapshot(cars)
+    results['car_snapshot_match_many'] = measure(
+        lambda: snapshot.match_many(watchlists, MAX_TOTAL_CARS, count_cap=COUNT_CAP), repeat)
+    results['car_snapshot_match_many']['per'] = len(watchlists)
+
+    results['get_car_message'] = measure(lambda: [get_car_message(car) for car in cars], repeat)
+    results['get_car_message']['per'] = len(cars)
+
+    results['build_model_pages'] = measure(
+        lambda: [build_model_pages(MAKE_KEYS[make], get_models(letter, make)) for (letter, make) in MAKES], repeat)
+    results['build_model_pages']['per'] = len(MAKES)
+
+    raw_watchlist = {'make': 'Toyota', 'model': 'Aqua', 'min_year': '2010', 'max_year': '2020', 'max_mileage': '200000', 'max_price': '15500'}
+    results['build_watchlist'] = measure(lambda: build_watchlist({'_id': ObjectId()}, raw_watchlist), repeat, number=1000)
+
+    mock_bot = ptbtest.Mockbot()
+    update = ptbtest.MessageGenerator(bot=mock_bot).get_message(text='/add_watchlist')
+    db['users'].insert_one({'telegram': {'id': update.effective_user.id}})
+
+    def converse():
+        clear_caches()
+        matching_cars_cache.invalidate()
+        run_conversation(mock_bot, update)
+    results['add_watchlist_conversation'] = measure(converse, repeat, number=10)
+    return results
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        if name not in baseline:
+            continue
+        change = result['best'] / baseline[name]['best'] - 1
+        if change > threshold:
+            regressions.append((name, change))
+    return regressions
+
+
+def print_results(results, baseline=None, output=sys.stdout):
+    for (name, result) in sorted(results.items()):
+        line = f'{name:30} best {result["best"] * 1000:10.3f} ms  median {result["median"] * 1000:10.3f} ms'
+        if result.get('per'):
+            line += f'  ({result["per"]} items)'
+        if baseline and name in baseline:
+            line += f'  {(result["best"] / baseline[name]["best"] - 1) * 100:+.1f}%'
+        print(line, file=output)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the matching, formatting and conversation hot paths.')
+    parser.add_argument('--cars', type=int, default=DEFAULT_CARS)
+    parser.add_argument('--watchlists', type=int, default=DEFAULT_WATCHLISTS)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--real-mongo', action='store_true', help='query REAL_TEST_MONGODB_URI instead of mongomock')
+    parser.add_argument('--save', help='write the results as a baseline JSON file')
+    parser.add_argument('--compare', help='compare with a baseline JSON file and fail on regressions')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args(args)
+
+    params = {
+        'cars': args.cars,
+        'watchlists': args.watchlists,
+        'seed': args.seed,
+        'mongo': 'real' if args.real_mongo else 'mongomock',
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        if saved.get('params') != params:
+            print(f'Baseline was run with {saved.get("params")}, not {params}; rerun with the same parameters', file=sys.stderr)
+            return 2
+        baseline = saved['results']
+
+    results = run_benchmarks(args.cars, args.watchlists, args.repeat, args.seed, args.real_mongo)
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'params': params, 'results': results}, f, indent=2, sort_keys=True)
+
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        for (name, change) in regressions:
+            print(f'Regression: {name} is {change * 100:.1f}% slower than the baseline', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
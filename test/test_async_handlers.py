@@ -0,0 +1,84 @@
+import ptbtest
+import pytest
+from datetime import datetime
+from telegram import Message
+from telegram.ext import CallbackContext, ConversationHandler, Dispatcher, Filters, MessageHandler
+from bot import async_handlers
+from bot.db import db
+from bot.db_cache import clear_caches
+from bot.handlers import LIST_MATCHING_CARS, SELECT_WATCHLIST
+from services.matching_cache import matching_cars_cache
+
+
+CAR = {
+    'post': [{'platform': 'craigslist', 'postId': 'postId1', 'postUrl': 'postUrl'}],
+    'mileage': 96202,
+    'price': {'amount': 5000, 'currency': 'USD'},
+    'carInfo': {'year': 2015, 'make': 'Honda', 'model': 'Saber'},
+}
+
+
+@pytest.fixture(autouse=True)
+def clear_db():
+    clear_caches()
+    matching_cars_cache.invalidate()
+    for collection in ('users', 'watchlists', 'cars'):
+        db[collection].delete_many({})
+
+
+def create_user(update):
+    user_id = db.users.insert_one({'telegram': {'id': update.effective_user.id}}).inserted_id
+    return db.watchlists.insert_one({'userId': user_id, 'make': 'Honda', 'model': 'Saber'}).inserted_id
+
+
+def test_handler_returns_promise_of_the_state():
+    mock_bot = ptbtest.Mockbot()
+    update = ptbtest.MessageGenerator(bot=mock_bot).get_message(text='/list_watchlists')
+    create_user(update)
+
+    promise = async_handlers.list_watchlists(update, context={})
+
+    assert promise.result(timeout=5) == SELECT_WATCHLIST
+    assert [message['text'] for message in mock_bot.sent_messages] == ['Your watchlists:']
+
+
+def test_conversation_waits_for_the_promise():
+    mock_bot = ptbtest.Mockbot()
+    update = ptbtest.MessageGenerator(bot=mock_bot).get_message(text='/list_watchlists')
+    create_user(update)
+    conversation = ConversationHandler(
+        entry_points=[MessageHandler(Filters.text, async_handlers.list_watchlists)],
+        states={SELECT_WATCHLIST: []},
+        fallbacks=[],
+    )
+    dispatcher = Dispatcher(bot=mock_bot, update_queue=None, use_context=True)
+
+    context = CallbackContext.from_update(update, dispatcher)
+    conversation.handle_update(update, dispatcher, conversation.check_update(update), context)
+    (_, promise) = conversation.conversations[(update.effective_chat.id, update.effective_user.id)]
+    promise.result(timeout=5)
+    conversation.check_update(update)
+
+    assert conversation.conversations[(update.effective_chat.id, update.effective_user.id)] == SELECT_WATCHLIST
+
+
+def test_list_cars_watchlist_selected():
+    mock_bot = ptbtest.Mockbot()
+    update = ptbtest.MessageGenerator(bot=mock_bot).get_message(text='/list_matching_cars')
+    watchlist_id = create_user(update)
+    db.cars.insert_many([{**CAR}, {**CAR, 'carInfo': {**CAR['carInfo'], 'model': 'Civic'}}])
+    message = Message(message_id='1', from_user=update.effective_user, date=datetime.today(), chat=update.effective_chat)
+    query = ptbtest.callbackquerygenerator.CallbackQueryGenerator(bot=mock_bot).get_callback_query(
+        user=update.effective_user,
+        message=message,
+        data=str(watchlist_id),
+    )
+
+    assert async_handlers.list_matching_cars(update, context={}).result(timeout=5) == LIST_MATCHING_CARS
+    assert async_handlers.list_cars_watchlist_selected(query, context={}).result(timeout=5) == ConversationHandler.END
+
+    sent_messages = [message['text'] for message in mock_bot.sent_messages if message['method'] == 'sendMessage']
+    assert sent_messages[1:] == [
+        'Found 1 matching cars',
+        '1.\n2015 Honda Saber\n96202 miles\n$5000\npostUrl',
+    ]
@@ -0,0 +1,82 @@
+import multiprocessing
+import pytest
+from bson.objectid import ObjectId
+from services.batch_matcher import BatchMatcher, split_watchlists
+from services.watchlist_index import WatchlistIndex
+
+
+def create_car(make, model, year, price):
+    return {
+        '_id': ObjectId(),
+        'carInfo': {
+            'year': year,
+            'make': make,
+            'model': model,
+        },
+        'price': {
+            'amount': price,
+            'currency': 'USD'
+        },
+        'mileage': 96202,
+        'post': [{'platform': 'craigslist', 'postUrl': 'https://example.com'}],
+    }
+
+
+def create_watchlists():
+    watchlists = []
+    for (make, model) in [('Honda', 'Saber'), ('Toyota', 'Aqua')]:
+        for max_price in range(1000, 10000, 1000):
+            watchlists.append({
+                '_id': ObjectId(),
+                'userId': ObjectId(),
+                'make': make,
+                'model': model,
+                'year': {'min': 2010, 'max': 2016},
+                'price': {'max': max_price},
+            })
+    return watchlists
+
+
+@pytest.mark.parametrize('start_method', ['fork', 'spawn'])
+def test_pool_matches_like_index(start_method):
+    watchlists = create_watchlists()
+    cars = [
+        create_car(make, model, year, price)
+        for (make, model) in [('Honda', 'Saber'), ('Toyota', 'Aqua'), ('Ford', 'Focus')]
+        for year in (2009, 2012, 2015)
+        for price in (2500, 7500)
+    ]
+    expected = WatchlistIndex(watchlists).match_cars(cars)
+
+    mp_context = multiprocessing.get_context(start_method)
+    with BatchMatcher(watchlists, workers=2, min_parallel_cars=3, mp_context=mp_context) as matcher:
+        results = matcher.match(cars, with_messages=True)
+        # The chunk indexes are reused by later batches
+        later_results = matcher.match(cars[:6])
+
+    assert [watchlist['_id'] for (watchlist, _, _) in results] == [
+        watchlist['_id'] for watchlist in watchlists if watchlist['_id'] in expected
+    ]
+    for (watchlist, matched_cars, messages) in results:
+        assert matched_cars == expected[watchlist['_id']][1]
+        assert len(messages) == len(matched_cars)
+    assert results == BatchMatcher(watchlists, workers=1).match(cars, with_messages=True)
+    assert later_results == BatchMatcher(watchlists, workers=1).match(cars[:6])
+
+
+def test_split_watchlists_keeps_make_models_together():
+    watchlists = create_watchlists()
+    chunks = split_watchlists(watchlists, 4)
+
+    assert len(chunks) == 2
+    assert [{(w['make'], w['model']) for w in chunk} for chunk in chunks] == [{('Honda', 'Saber')}, {('Toyota', 'Aqua')}]
+
+
+def test_single_worker_keeps_its_own_index():
+    watchlists = create_watchlists()
+    car = create_car('Honda', 'Saber', 2012, 2500)
+    matcher = BatchMatcher(watchlists, workers=1)
+    toyota_matcher = BatchMatcher([w for w in watchlists if w['make'] == 'Toyota'], workers=1)
+
+    assert len(matcher.match([car])) == len(WatchlistIndex(watchlists).match(car)) > 0
+    assert toyota_matcher.match([car]) == []
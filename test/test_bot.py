@@ -9,6 +9,7 @@ from bot.handlers import (
     watchlist_letter_inputted,
     watchlist_make_inputted,
     watchlist_model_inputted,
+    watchlist_text_inputted,
     watchlist_more_models_selected,
     watchlist_from_year_inputted,
     watchlist_to_year_inputted,
@@ -26,14 +27,23 @@ from bot.handlers import (
     watchlist_selected_for_removal,
     list_matching_cars,
     list_cars_watchlist_selected,
-    find_car
+    find_car,
+    get_find_car_payload,
+    FIND_CAR_START_HANDLER,
+    start,
+    inline_car_query,
+    parse_find_car_payload,
+    model_counts,
 )
 from bot.release import send_new_release_message
+from services.model_counts import ModelCounts
 from bot.db import _set_db
+from bot.db_cache import clear_caches
+from services.matching_cache import matching_cars_cache
 import mongomock
 import json
 from telegram.ext import Dispatcher
-from telegram import Message
+from telegram import Message, MessageEntity, Update
 from datetime import datetime
 from services import notification
 from freezegun import freeze_time
@@ -76,6 +86,12 @@ DEFAULT_CAR_ITEM = {
 }
 
 
+@pytest.fixture(autouse=True)
+def clear_db_caches():
+    clear_caches()
+    matching_cars_cache.invalidate()
+
+
 def init_telegram():
     mock_bot = ptbtest.Mockbot()
     update = ptbtest.MessageGenerator(bot=mock_bot).get_message()
@@ -223,6 +239,35 @@ def test_add_min_watchlist():
     assert watchlist.get('price') == None
 
 
+def test_add_watchlist_from_text():
+    (mock_bot, update, telegram_user_id) = init_telegram()
+    from bot.db import db
+    user = {
+        'telegram': {
+            'id': telegram_user_id
+        }
+    }
+    user_id = db.users.insert(user)
+    context = Dispatcher(bot=mock_bot, update_queue=update)
+
+    add_watchlist(update, context)
+    update = get_mock_message(mock_bot, update, text='toyota  aqua 2010 2020 200000 15500')
+    watchlist_text_inputted(update, context)
+    update = get_mock_callback_query(mock_bot, update, data='Save watchlist')
+    confirm_watchlist_details(update, context)
+
+    watchlist = db.watchlists.find_one({'userId': user_id})
+
+    assert watchlist['make'] == 'Toyota'
+    assert watchlist['model'] == 'Aqua'
+    assert watchlist['year'] == {
+        'min': 2010,
+        'max': 2020
+    }
+    assert watchlist['mileage']['max'] == 200000
+    assert watchlist['price']['max'] == 15500
+
+
 def test_add_half_watchlist():
     (mock_bot, update, telegram_user_id) = init_telegram()
     from bot.db import db
@@ -660,3 +705,128 @@ def test_find_car():
         'parse_mode': 'Markdown',
         'text': 'Adding watchlist cancelled'
     }
+
+
+def test_keyboards_are_shared():
+    from bot.handlers import get_years_keyboard, get_confirm_details_keyboard
+    from bot.keyboards import MODEL_KEYBOARDS
+
+    assert get_years_keyboard() is get_years_keyboard()
+    assert get_confirm_details_keyboard('Find car') is get_confirm_details_keyboard('Find car')
+    assert json.loads(get_years_keyboard().to_json())['inline_keyboard'][-1] == [
+        {'text': '/cancel', 'callback_data': '/cancel'}
+    ]
+    assert MODEL_KEYBOARDS['Toyota'][-1].to_dict()['inline_keyboard'][-1][-1] == {
+        'text': '/cancel',
+        'callback_data': '/cancel'
+    }
+
+
+def test_more_models_without_stored_pages():
+    from bot.keyboards import MODEL_KEYBOARDS, MAKE_KEYS, parse_more_models
+    (mock_bot, update, telegram_user_id) = init_telegram()
+    context = Dispatcher(bot=mock_bot, update_queue=update)
+    make = next(make for (make, pages) in MODEL_KEYBOARDS.items() if len(pages) > 1)
+    more_button = MODEL_KEYBOARDS[make][0].to_dict()['inline_keyboard'][-1][-1]
+
+    update = get_mock_callback_query(mock_bot, update, data=more_button['callback_data'])
+    watchlist_more_models_selected(update, context)
+
+    assert context.user_data['watchlist'] == {'make': make}
+    assert mock_bot.sent_messages[-1]['text'] == 'Select model:'
+    assert mock_bot.sent_messages[-1]['reply_markup'] == MODEL_KEYBOARDS[make][1].to_json()
+    assert parse_more_models('more') is None
+    assert more_button['callback_data'] == f'more:{MAKE_KEYS[make]}:1'
+    assert parse_more_models('more:unknown-make:1') is None
+
+
+def test_make_keys_are_stable_and_short():
+    from bot.keyboards import MAX_MAKE_KEY_BYTES, get_make_keys
+
+    make_keys = get_make_keys(['Mercedes-Benz', 'Mercedes Benz', 'Land Rover ' * 10])
+
+    assert make_keys['Mercedes-Benz'] == 'mercedes-benz'
+    assert make_keys['Mercedes Benz'] != 'mercedes-benz'
+    assert all(len(key.encode()) <= MAX_MAKE_KEY_BYTES for key in make_keys.values())
+    assert get_make_keys(['Land Rover ' * 10]) == {'Land Rover ' * 10: make_keys['Land Rover ' * 10]}
+
+
+def test_inline_car_query():
+    from bot.db import db
+    (mock_bot, update, telegram_user_id) = init_telegram()
+    db.cars.insert_many([
+        {**DEFAULT_CAR_ITEM, 'carInfo': {'year': 2015, 'make': 'Toyota', 'model': model}}
+        for model in ['Prius', 'Prius', 'Aqua']
+    ])
+    model_counts.refresh()
+    update = ptbtest.InlineQueryGenerator(bot=mock_bot).get_inline_query(user=update.effective_user, query='toyota')
+
+    inline_car_query(update, context={})
+
+    results = mock_bot.sent_messages[0]['results']
+    assert [result['title'] for result in results[:3]] == ['Toyota Prius', 'Toyota Aqua', 'Toyota Corolla']
+    assert results[0]['description'] == '2 cars'
+    assert results[0]['input_message_content']['message_text'] == 'Toyota Prius: 2 cars'
+    link = results[0]['reply_markup']['inline_keyboard'][0][0]['url']
+    assert link.startswith(f'https://t.me/{mock_bot.username}?start=')
+    assert parse_find_car_payload(link.split('start=')[1]) == {'make': 'Toyota', 'model': 'Prius'}
+    db.cars.delete_many({})
+
+
+@pytest.mark.parametrize('args', [['Toyota', 'Prius'], [get_find_car_payload('Toyota', 'Prius')]])
+def test_find_car_with_args(args):
+    (mock_bot, update, telegram_user_id) = init_telegram()
+    from bot.db import db
+    db.users.insert({'telegram': {'id': telegram_user_id}})
+    context = Dispatcher(bot=mock_bot, update_queue=update)
+    context.args = args
+
+    find_car(update, context)
+
+    assert context.user_data['watchlist'] == {'make': 'Toyota', 'model': 'Prius'}
+    assert mock_bot.sent_messages[0]['text'] == 'Make: *Toyota*\nModel: *Prius*'
+
+
+def test_start_with_find_car_payload():
+    (mock_bot, update, telegram_user_id) = init_telegram()
+    from bot.db import db
+    db.users.insert({'telegram': {'id': telegram_user_id}})
+    context = Dispatcher(bot=mock_bot, update_queue=update)
+    context.args = [get_find_car_payload('Toyota', 'Prius')]
+
+    start(update, context)
+
+    assert context.user_data['watchlist'] == {'make': 'Toyota', 'model': 'Prius'}
+    assert mock_bot.sent_messages[0]['text'] == 'Make: *Toyota*\nModel: *Prius*'
+
+
+def test_find_car_start_handler():
+    (mock_bot, update, telegram_user_id) = init_telegram()
+    (user, chat, _) = get_user_chat_telegram_message(update)
+
+    def get_command_update(text):
+        # ptbtest drops the entities CommandHandler looks for
+        message = Message(
+            message_id='1',
+            from_user=user,
+            date=datetime.today(),
+            chat=chat,
+            text=text,
+            entities=[MessageEntity(MessageEntity.BOT_COMMAND, 0, len('/start'))],
+            bot=mock_bot,
+        )
+        return Update(1, message=message)
+
+    assert FIND_CAR_START_HANDLER.check_update(get_command_update(f'/start {get_find_car_payload("Toyota", "Prius")}'))
+    assert not FIND_CAR_START_HANDLER.check_update(get_command_update('/start'))
+
+
+def test_model_counts_are_canonical():
+    db = mongomock.MongoClient().db
+    db.cars.insert_many([
+        {'carInfo': {'make': make, 'model': model}}
+        for (make, model) in [('Toyota', 'Prius'), ('toyota', 'PRIUS'), ('Toyota', 'Priuss'), ('Honda', 'Civic')]
+    ])
+    counts = ModelCounts(lambda: db)
+
+    assert counts.get_counts() == {('Toyota', 'Prius'): 2, ('Honda', 'Civic'): 1}
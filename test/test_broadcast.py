@@ -0,0 +1,119 @@
+import mongomock
+import pytest
+from telegram.error import BadRequest, Unauthorized
+from bot.broadcast import RateLimiter, send_broadcast, unblock_chat
+
+
+class FakeBot:
+    def __init__(self, blocked=(), not_found=(), crash_on=None, forbidden=(), invalid_token=False):
+        self.blocked = blocked
+        self.not_found = not_found
+        self.crash_on = crash_on
+        self.forbidden = forbidden
+        self.invalid_token = invalid_token
+        self.sent = []
+
+    def send_message(self, chat_id, text, parse_mode=None):
+        if chat_id == self.crash_on:
+            raise RuntimeError('crash')
+        if self.invalid_token:
+            raise Unauthorized('Unauthorized')
+        if chat_id in self.forbidden:
+            raise Unauthorized("Forbidden: bot can't send messages to bots")
+        if chat_id in self.blocked:
+            raise Unauthorized('Forbidden: bot was blocked by the user')
+        if chat_id in self.not_found:
+            raise BadRequest('Chat not found')
+        self.sent.append(chat_id)
+
+
+def create_db(count):
+    db = mongomock.MongoClient().db
+    db['users'].insert_many([{'telegram': {'id': i}} for i in range(count)])
+    return db
+
+
+def test_broadcast_skips_blocked_chats():
+    db = create_db(10)
+    bot = FakeBot(blocked={3}, not_found={7})
+
+    state = send_broadcast(bot, db, 'release-1', 'New release', batch_size=4, sleep=lambda delay: None)
+
+    assert sorted(bot.sent) == [0, 1, 2, 4, 5, 6, 8, 9]
+    assert (state['status'], state['sent'], state['blocked'], state['failed']) == ('done', 8, 2, 0)
+
+    bot = FakeBot()
+    send_broadcast(bot, db, 'release-2', 'Next release', batch_size=4, sleep=lambda delay: None)
+
+    assert sorted(bot.sent) == [0, 1, 2, 4, 5, 6, 8, 9]
+
+    unblock_chat(db, 3)
+    bot = FakeBot()
+    send_broadcast(bot, db, 'release-3', 'Last release', batch_size=4, sleep=lambda delay: None)
+
+    assert sorted(bot.sent) == [0, 1, 2, 3, 4, 5, 6, 8, 9]
+
+
+def test_broadcast_resumes_after_crash():
+    db = create_db(10)
+    bot = FakeBot(crash_on=5)
+
+    with pytest.raises(RuntimeError):
+        send_broadcast(bot, db, 'release', 'New release', batch_size=4, workers=1, sleep=lambda delay: None)
+    assert db['broadcasts'].find_one({'_id': 'release'})['sent'] == 4
+
+    bot = FakeBot()
+    state = send_broadcast(bot, db, 'release', 'New release', batch_size=4, sleep=lambda delay: None)
+
+    assert sorted(bot.sent) == [4, 5, 6, 7, 8, 9]
+    assert (state['status'], state['sent']) == ('done', 10)
+
+    bot = FakeBot()
+    send_broadcast(bot, db, 'release', 'New release', batch_size=4, sleep=lambda delay: None)
+
+    assert bot.sent == []
+
+
+def test_broadcast_only_blocks_matching_errors():
+    db = create_db(4)
+    bot = FakeBot(forbidden={2})
+
+    state = send_broadcast(bot, db, 'release', 'New release', batch_size=4, sleep=lambda delay: None)
+
+    assert (state['sent'], state['blocked'], state['failed']) == (3, 0, 1)
+    assert db['users'].count_documents({'telegram.blockedAt': {'$exists': True}}) == 0
+
+
+def test_broadcast_aborts_on_invalid_token():
+    db = create_db(10)
+
+    with pytest.raises(Unauthorized):
+        send_broadcast(FakeBot(invalid_token=True), db, 'release', 'New release', batch_size=4, sleep=lambda delay: None)
+
+    state = db['broadcasts'].find_one({'_id': 'release'})
+    assert (state['status'], state['lastUserId'], state['blocked']) == ('aborted', None, 0)
+    assert db['users'].count_documents({'telegram.blockedAt': {'$exists': True}}) == 0
+
+    bot = FakeBot()
+    state = send_broadcast(bot, db, 'release', 'New release', batch_size=4, sleep=lambda delay: None)
+
+    assert sorted(bot.sent) == list(range(10))
+    assert (state['status'], state['sent']) == ('done', 10)
+
+
+def test_pause_holds_every_worker():
+    now = [0]
+    sleeps = []
+
+    def sleep(delay):
+        sleeps.append(delay)
+        now[0] += delay
+
+    limiter = RateLimiter(10, clock=lambda: now[0], sleep=sleep)
+    limiter.acquire()
+    limiter.pause(5)
+    limiter.pause(2)
+    limiter.acquire()
+
+    assert sleeps == [5]
+    assert now[0] == 5
@@ -0,0 +1,76 @@
+import mongomock
+import pytest
+from services.car_queries import fetch_matching_cars_page
+
+np = pytest.importorskip('numpy')
+from bson.decimal128 import Decimal128  # noqa: E402
+from bson.objectid import ObjectId  # noqa: E402
+from services.car_snapshot import MISSING, CarSnapshot, load_car_snapshot, to_column_value  # noqa: E402
+
+
+WATCHLISTS = [
+    {'make': 'Honda', 'model': 'Saber'},
+    {'make': 'Honda', 'model': 'Saber', 'year': {'min': 2010, 'max': 2014}},
+    {'make': 'Honda', 'model': 'Saber', 'mileage': {'max': 100000}, 'price': {'max': 6000}},
+    {'make': 'Toyota', 'model': 'Aqua', 'price': {'max': 9000}},
+    {'make': 'Ford', 'model': 'Focus'},
+]
+
+
+def create_db():
+    db = mongomock.MongoClient().db
+    cars = []
+    for (i, (make, model)) in enumerate([('Honda', 'Saber'), ('Toyota', 'Aqua')] * 10):
+        car = {
+            'carInfo': {'year': 2005 + i, 'make': make, 'model': model},
+            'price': {'amount': 1000 * i, 'currency': 'USD'},
+            'mileage': 20000 * i,
+        }
+        # Missing fields never satisfy a range
+        if i % 7 == 0:
+            del car['carInfo']['year']
+        if i % 5 == 0:
+            del car['mileage']
+        cars.append(car)
+    db['cars'].insert_many(cars)
+    return db
+
+
+@pytest.mark.parametrize('watchlist', WATCHLISTS)
+def test_match_like_mongo(watchlist):
+    db = create_db()
+    snapshot = load_car_snapshot(db, fields='full')
+
+    assert snapshot.match(watchlist, 3) == fetch_matching_cars_page(db, watchlist, 3)
+    assert snapshot.match(watchlist, 2, count_cap=3) == fetch_matching_cars_page(db, watchlist, 2, count_cap=3)
+
+
+def test_match_many_like_match():
+    db = create_db()
+    snapshot = load_car_snapshot(db, fields='full')
+    watchlists = [{**watchlist, '_id': i} for (i, watchlist) in enumerate(WATCHLISTS)]
+
+    assert snapshot.match_many(watchlists, 3, count_cap=3) == {
+        watchlist['_id']: snapshot.match(watchlist, 3, count_cap=3)
+        for watchlist in watchlists
+    }
+
+
+def test_column_values_are_integers():
+    assert to_column_value(Decimal128('2250.50'), 100) == 225050
+    assert to_column_value(0.1, 100) == 10
+    assert to_column_value(1000.5) == 1001
+    assert to_column_value('1000') == MISSING
+    assert to_column_value(True) == MISSING
+    assert to_column_value(float('nan')) == MISSING
+
+    cars = [
+        {'_id': ObjectId(), 'carInfo': {'make': 'Honda', 'model': 'Saber'}, 'price': {'amount': amount}}
+        for amount in (Decimal128('6000.00'), Decimal128('6000.01'), 5999.99)
+    ]
+    snapshot = CarSnapshot(cars)
+
+    assert snapshot.years.dtype == snapshot.prices.dtype == np.int64
+    (matched, count) = snapshot.match({'make': 'Honda', 'model': 'Saber', 'price': {'max': 6000}}, 10)
+    assert count == 2
+    assert [car['price']['amount'] for car in matched] == [Decimal128('6000.00'), 5999.99]
@@ -0,0 +1,84 @@
+import pytest
+from bot.db_cache import (
+    LRUCache,
+    MISSING,
+    get_user,
+    get_watchlists,
+    insert_watchlist,
+    update_watchlist,
+    delete_watchlist,
+    clear_caches,
+    get_cache_stats,
+)
+
+
+TELEGRAM_USER_ID = 'cache-test-user'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def user():
+    from bot.db import db
+    clear_caches()
+    db.users.remove({'telegram.id': TELEGRAM_USER_ID})
+    user_id = db.users.insert({'telegram': {'id': TELEGRAM_USER_ID}})
+    return db.users.find_one({'_id': user_id})
+
+
+def test_lru_cache_eviction_and_ttl():
+    clock = FakeClock()
+    cache = LRUCache(max_size=2, ttl=10, clock=clock)
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('b') is MISSING
+    assert cache.get('a') == 1
+
+    clock.now = 11
+    assert cache.get('a') is MISSING
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'size': 1}
+
+
+def test_lru_cache_returns_copies():
+    cache = LRUCache(max_size=2, ttl=10)
+    value = [{'model': 'Aqua'}]
+
+    cache.set('a', value)
+    value[0]['model'] = 'Prius'
+    cache.get('a').append({'model': 'Corolla'})
+
+    assert cache.get('a') == [{'model': 'Aqua'}]
+
+
+def test_get_user_is_cached(user):
+    assert get_user(TELEGRAM_USER_ID)['_id'] == user['_id']
+    assert get_user(TELEGRAM_USER_ID)['_id'] == user['_id']
+
+    assert get_cache_stats()['users']['hits'] >= 1
+    assert get_user('unknown-user') is None
+
+
+def test_watchlists_invalidated_on_write(user):
+    watchlist = {'userId': user['_id'], 'make': 'Toyota', 'model': 'Aqua'}
+
+    assert get_watchlists(user) == []
+    insert_watchlist(watchlist)
+    watchlists = get_watchlists(user)
+    assert [w['model'] for w in watchlists] == ['Aqua']
+
+    update_watchlist(str(watchlists[0]['_id']), {**watchlist, 'model': 'Prius'})
+    watchlists = get_watchlists(user)
+    assert [w['model'] for w in watchlists] == ['Prius']
+
+    delete_watchlist(str(watchlists[0]['_id']))
+    assert get_watchlists(user) == []
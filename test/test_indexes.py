@@ -0,0 +1,64 @@
+import os
+import pymongo
+import pytest
+from bson.objectid import ObjectId
+from models.indexes import ensure_indexes, uses_collection_scan
+from services.car_queries import build_car_filter, fetch_cars_page
+
+
+REAL_TEST_MONGODB_URI = os.environ['REAL_TEST_MONGODB_URI']
+REAL_TEST_MONGODB_DB = os.environ['REAL_TEST_MONGODB_DB']
+
+FULL_WATCHLIST = {
+    'make': 'Honda',
+    'model': 'Saber',
+    'year': {
+        'min': 2012,
+        'max': 2019
+    },
+    'mileage': {
+        'max': 300000
+    },
+    'price': {
+        'max': 7500
+    }
+}
+MIN_WATCHLIST = {
+    'make': 'Honda',
+    'model': 'Saber',
+}
+
+
+@pytest.fixture
+def db():
+    client = pymongo.MongoClient(REAL_TEST_MONGODB_URI)
+    client.drop_database(REAL_TEST_MONGODB_DB)
+    db = client[REAL_TEST_MONGODB_DB]
+    ensure_indexes(db)
+    db.cars.insert_one({'carInfo': {'make': 'Honda', 'model': 'Saber', 'year': 2015}})
+    db.watchlists.insert_one({**MIN_WATCHLIST, 'userId': ObjectId()})
+    return db
+
+
+def test_ensure_indexes_is_idempotent(db):
+    ensure_indexes(db)
+
+    assert 'make_model_year_price_mileage' in db.cars.index_information()
+    assert 'userId_id' in db.watchlists.index_information()
+
+
+@pytest.mark.parametrize('watchlist', [FULL_WATCHLIST, MIN_WATCHLIST])
+def test_car_queries_use_index(db, watchlist):
+    explain = db.cars.find(build_car_filter(watchlist)).limit(30).explain()
+    assert not uses_collection_scan(explain)
+
+    explain = fetch_cars_page(db, watchlist, 10, after=str(ObjectId())).explain()
+    assert not uses_collection_scan(explain)
+
+
+def test_watchlist_queries_use_index(db):
+    explain = db.watchlists.find({'userId': ObjectId()}).explain()
+    assert not uses_collection_scan(explain)
+
+    explain = db.watchlists.find({'_id': ObjectId(), 'userId': ObjectId()}).explain()
+    assert not uses_collection_scan(explain)
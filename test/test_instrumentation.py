@@ -0,0 +1,98 @@
+import json
+import time
+import pytest
+from app import app
+from helpers import create_authorization_headers
+from utils.instrumentation import instrument_bot, instrument_handler, metrics, track
+import routes.metrics  # noqa: F401
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+
+
+class Request:
+    def post(self, url, data, timeout=None):
+        time.sleep(0.01)
+        return {}
+
+    def get(self, url, timeout=None):
+        return {}
+
+
+class Bot:
+    def __init__(self):
+        self.request = Request()
+
+
+class Context:
+    def __init__(self, bot):
+        self.bot = bot
+
+
+@instrument_handler
+def start(update, context):
+    with track('mongo'):
+        time.sleep(0.02)
+    context.bot.request.post('sendMessage', {})
+    return 'state'
+
+
+@instrument_handler
+def restart(update, context):
+    return start(update, context)
+
+
+def test_instrument_handler():
+    assert start(None, Context(Bot())) == 'state'
+
+    stats = metrics.to_dict()
+    assert sorted(stats) == [f'handler:start:{component}' for component in ('cpu', 'mongo', 'telegram', 'total')]
+    assert stats['handler:start:total']['count'] == 1
+    assert stats['handler:start:mongo']['sum'] >= 0.02
+    assert stats['handler:start:telegram']['sum'] >= 0.01
+    assert stats['handler:start:total']['sum'] >= stats['handler:start:mongo']['sum'] + stats['handler:start:telegram']['sum']
+
+
+def test_nested_handler_is_recorded_once():
+    restart(None, Context(Bot()))
+
+    stats = metrics.to_dict()
+    assert sorted({key.rsplit(':', 1)[0] for key in stats}) == ['handler:restart']
+    assert stats['handler:restart:total']['count'] == 1
+    assert stats['handler:restart:mongo']['sum'] >= 0.02
+
+
+def test_bot_is_instrumented_once():
+    bot = Bot()
+    instrument_bot(bot)
+    instrument_bot(bot)
+
+    start(None, Context(bot))
+
+    assert metrics.to_dict()['handler:start:telegram']['sum'] < 0.02
+
+
+def test_dump(tmp_path):
+    start(None, Context(Bot()))
+    path = tmp_path / 'metrics.json'
+
+    metrics.dump(str(path))
+
+    assert json.loads(path.read_text())['handler:start:total']['count'] == 1
+
+
+def test_metrics_route():
+    client = app.test_client()
+    headers = create_authorization_headers('user_id', 'email')
+    client.get('/metrics.json', headers=headers)
+
+    response = client.get('/metrics', headers=headers)
+
+    assert response.status_code == 200
+    assert b'carbot_latency_seconds_count{kind="route",stage="get_metrics_json",component="total"} 1' in response.data
+
+
+def test_metrics_route_requires_token():
+    assert app.test_client().get('/metrics').status_code == 401
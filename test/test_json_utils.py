@@ -0,0 +1,61 @@
+import json
+import pytest
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from datetime import datetime
+from utils.json_utils import ENCODERS, dumps
+
+
+DOCUMENT = {
+    '_id': ObjectId(),
+    'userId': ObjectId(),
+    'make': 'Subaru',
+    'model': 'Forester',
+    'year': {
+        'min': 2000,
+        'max': 2020
+    },
+    'price': {
+        'amount': Decimal128('2250.50'),
+        'currency': 'USD'
+    },
+    'post': [
+        {
+            'postDate': datetime(2020, 5, 1, 12, 30),
+            'postId': 'postId',
+        }
+    ],
+    'mileage': 20000,
+    'ratio': 0.5,
+    'big': 2 ** 70,
+}
+
+
+def dumps_baseline(obj):
+    return json.dumps(obj, default=str)
+
+
+@pytest.mark.parametrize('name', list(ENCODERS))
+def test_encoders_wire_format(name):
+    encoded = json.loads(ENCODERS[name](DOCUMENT))
+
+    assert encoded['_id'] == str(DOCUMENT['_id'])
+    assert encoded['price']['amount'] == '2250.50'
+    assert encoded['post'][0]['postDate'] == '2020-05-01 12:30:00'
+    assert encoded['big'] == 2 ** 70
+    assert json.loads(ENCODERS[name]([DOCUMENT])) == [encoded]
+
+
+def test_default_encoder_is_byte_compatible():
+    assert dumps(DOCUMENT) == dumps_baseline(DOCUMENT)
+    assert dumps([DOCUMENT, DOCUMENT]) == dumps_baseline([DOCUMENT, DOCUMENT])
+
+
+@pytest.mark.parametrize('name', list(ENCODERS))
+@pytest.mark.parametrize('document', [
+    {'make': 'Škoda', 'model': 'Octavia', 'title': '日本車'},
+    {'ratio': float('nan'), 'max': float('inf')},
+    {'ratio': None},
+])
+def test_non_ascii_and_nan_match_baseline(name, document):
+    assert ENCODERS[name](document) == dumps_baseline(document)
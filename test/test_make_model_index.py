@@ -0,0 +1,53 @@
+from utils.make_model_index import MakeModelIndex
+
+
+INDEX = MakeModelIndex({
+    'Chevrolet': ['Camaro', 'Corvette'],
+    'Volkswagen': ['Golf', 'Jetta'],
+    'Mercedes-Benz': ['E-Class', 'C-Class'],
+    'Land Rover': ['Range Rover', 'Defender'],
+    'Honda': ['Civic', 'Accord'],
+})
+
+
+def test_resolve_exact_and_aliases():
+    assert INDEX.resolve('chevy', 'camaro') == ('Chevrolet', 'Camaro')
+    assert INDEX.resolve('VW', 'GOLF') == ('Volkswagen', 'Golf')
+    assert INDEX.resolve('mercedes benz', 'e class') == ('Mercedes-Benz', 'E-Class')
+    assert INDEX.resolve('Honda', 'Prelude') is None
+    assert INDEX.resolve(None, None) is None
+
+
+def test_resolve_prefix_and_typos():
+    assert INDEX.resolve_make('volksw') == 'Volkswagen'
+    assert INDEX.resolve_make('Chevrolett') == 'Chevrolet'
+    assert INDEX.resolve_model('Chevrolet', 'corvete') == 'Corvette'
+    assert INDEX.resolve_model('Mercedes-Benz', 'c') is None
+    assert INDEX.resolve_exact('VW', 'golf') == ('Volkswagen', 'Golf')
+    assert INDEX.resolve_exact('volksw', 'golf') is None
+    assert INDEX.resolve_exact('Chevrolet', 'corvete') is None
+
+
+def test_resolve_text():
+    assert INDEX.resolve_text('land rover range rover') == ('Land Rover', 'Range Rover')
+    assert INDEX.resolve_text('chevy camaro') == ('Chevrolet', 'Camaro')
+    assert INDEX.resolve_text('camaro') is None
+
+
+def test_complete():
+    assert INDEX.complete('vw') == [('Volkswagen', 'Golf'), ('Volkswagen', 'Jetta')]
+    assert INDEX.complete('chevy cor') == [('Chevrolet', 'Corvette')]
+    assert INDEX.complete('range') == [('Land Rover', 'Range Rover')]
+    assert INDEX.complete('c', limit=2, rank=lambda make_model: make_model[1]) == [('Mercedes-Benz', 'C-Class'), ('Chevrolet', 'Camaro')]
+    assert INDEX.complete('chevrolett camaro') == [('Chevrolet', 'Camaro')]
+    assert INDEX.complete('') == []
+
+
+def test_complete_ranks_every_prefix_match():
+    index = MakeModelIndex({'Toyota': [f'M{i:03}' for i in range(500)]})
+    counts = {('Toyota', 'M499'): 10, ('Toyota', 'M300'): 5}
+
+    assert index.complete('toyota', limit=2, rank=lambda make_model: -counts.get(make_model, 0)) == [
+        ('Toyota', 'M499'),
+        ('Toyota', 'M300'),
+    ]
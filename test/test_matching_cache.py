@@ -0,0 +1,136 @@
+import mongomock
+from services.matching_cache import (
+    ENTRY_OVERHEAD_BYTES,
+    MatchingCarsCache,
+    bump_cars_version,
+    estimate_size,
+    get_cars_version,
+    get_criteria_key,
+)
+
+
+WATCHLIST = {
+    'make': 'Honda',
+    'model': 'Civic',
+    'year': {
+        'min': '2012',
+        'max': 2019
+    },
+}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeFetch:
+    def __init__(self, cars):
+        self.cars = cars
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return (self.cars, len(self.cars))
+
+
+def test_criteria_key_is_normalized():
+    same_watchlist = {
+        'userId': 'someone',
+        'model': 'Civic',
+        'make': 'Honda',
+        'year': {'max': '2019', 'min': 2012},
+        'mileage': {},
+    }
+
+    assert get_criteria_key(WATCHLIST, 30) == get_criteria_key(same_watchlist, 30)
+    assert get_criteria_key(WATCHLIST, 30) != get_criteria_key(WATCHLIST, 10)
+
+
+def test_get_or_fetch_ttl():
+    clock = FakeClock()
+    cache = MatchingCarsCache(ttl=10, clock=clock)
+    fetch = FakeFetch([{'_id': 1}])
+
+    assert cache.get_or_fetch(WATCHLIST, 30, fetch) == ([{'_id': 1}], 1)
+    assert cache.get_or_fetch(WATCHLIST, 30, fetch) == ([{'_id': 1}], 1)
+    assert fetch.calls == 1
+
+    clock.now = 11
+    cache.get_or_fetch(WATCHLIST, 30, fetch)
+    assert fetch.calls == 2
+
+
+def test_version_change_invalidates():
+    cache = MatchingCarsCache()
+    fetch = FakeFetch([{'_id': 1}])
+
+    cache.set_version(1)
+    cache.get_or_fetch(WATCHLIST, 30, fetch)
+    cache.set_version(1)
+    cache.get_or_fetch(WATCHLIST, 30, fetch)
+    assert fetch.calls == 1
+
+    cache.set_version(2)
+    cache.get_or_fetch(WATCHLIST, 30, fetch)
+    assert fetch.calls == 2
+
+
+def test_eviction_is_bounded_by_size():
+    fetch = FakeFetch([{'_id': 1, 'description': 'x' * 1000}, {'_id': 2}])
+    size = estimate_size(fetch())
+    cache = MatchingCarsCache(max_bytes=size + size // 2)
+
+    cache.get_or_fetch(WATCHLIST, 10, fetch)
+    cache.get_or_fetch(WATCHLIST, 20, fetch)
+    cache.get_or_fetch(WATCHLIST, 20, fetch)
+    cache.get_or_fetch(WATCHLIST, 10, fetch)
+
+    assert fetch.calls == 4
+    assert cache.stats()['bytes'] == size
+
+
+def test_empty_results_are_bounded():
+    cache = MatchingCarsCache(max_entries=2)
+    fetch = FakeFetch([])
+
+    for limit in range(5):
+        cache.get_or_fetch(WATCHLIST, limit, fetch)
+
+    assert cache.stats()['entries'] == 2
+    assert cache.stats()['bytes'] == 2 * ENTRY_OVERHEAD_BYTES
+
+
+def test_result_fetched_across_a_version_change_is_not_stored():
+    db = mongomock.MongoClient().db
+    cache = MatchingCarsCache()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        if len(calls) == 1:
+            bump_cars_version(db)
+            # Another request notices the ingest while this one fetches
+            cache.set_version(get_cars_version(db))
+        return ([{'_id': 1}], 1)
+
+    cache.get_or_fetch(WATCHLIST, 30, fetch, db=db)
+    cache.get_or_fetch(WATCHLIST, 30, fetch, db=db)
+    cache.get_or_fetch(WATCHLIST, 30, fetch, db=db)
+
+    assert len(calls) == 2
+
+
+def test_get_or_stream_caches_exhausted_cursor():
+    cache = MatchingCarsCache()
+    cars = [{'_id': 1}, {'_id': 2}]
+    fetch = FakeFetch(cars)
+
+    stream = cache.get_or_stream(WATCHLIST, 30, lambda: iter(fetch()[0]))
+    assert cache.stats()['entries'] == 0
+    assert list(stream) == cars
+    assert cache.get_or_stream(WATCHLIST, 30, lambda: iter(fetch()[0])) == cars
+    assert fetch.calls == 1
@@ -0,0 +1,117 @@
+import mock
+import mongomock
+from bson.objectid import ObjectId
+from services.notification_dedup import NotifiedStore, get_car_identity
+
+
+DEFAULT_CAR = {
+    'post': [
+        {
+            'platform': 'craigslist',
+            'city': 'San Jose',
+            'postId': 'postId1',
+            'postUrl': 'postUrl',
+        },
+    ],
+    'mileage': 96202,
+    'price': {
+        'amount': 5000,
+        'currency': 'USD'
+    },
+    'carInfo': {
+        'year': 2015,
+        'make': 'Honda',
+        'model': 'Saber',
+        'vin': 'SOMEVIN',
+    },
+}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_car_identity():
+    repost = {
+        **DEFAULT_CAR,
+        'post': [{**DEFAULT_CAR['post'][0], 'postId': 'postId2'}],
+        'carInfo': {**DEFAULT_CAR['carInfo'], 'vin': None},
+    }
+    other_repost = {
+        **repost,
+        'post': [{**repost['post'][0], 'postId': 'postId3', 'platform': 'facebook', 'city': 'san jose '}],
+    }
+    elsewhere = {**repost, 'post': [{**repost['post'][0], 'city': 'Oakland'}]}
+    without_price = {**repost, 'price': None}
+
+    assert get_car_identity(DEFAULT_CAR) == get_car_identity({
+        **DEFAULT_CAR,
+        'carInfo': {**DEFAULT_CAR['carInfo'], 'vin': ' somevin '},
+    })
+    assert get_car_identity(repost) == get_car_identity(other_repost)
+    assert get_car_identity(repost) != get_car_identity(elsewhere)
+    assert get_car_identity(without_price) == 'post:craigslist:postid2'
+    assert get_car_identity({'carInfo': {}}) is None
+
+
+def test_check_and_add_expires():
+    clock = FakeClock()
+    notified = NotifiedStore(ttl=100, clock=clock)
+    watchlist_id = ObjectId()
+
+    assert notified.check_and_add(watchlist_id, DEFAULT_CAR)
+    assert not notified.check_and_add(watchlist_id, DEFAULT_CAR)
+    assert notified.check_and_add(ObjectId(), DEFAULT_CAR)
+
+    clock.now = 60
+    assert not notified.check_and_add(watchlist_id, DEFAULT_CAR)
+    clock.now = 200
+    assert notified.check_and_add(watchlist_id, DEFAULT_CAR)
+
+
+def test_filter_new_marks_pending():
+    notified = NotifiedStore()
+    watchlist_id = ObjectId()
+
+    assert notified.filter_new(watchlist_id, [DEFAULT_CAR]) == [DEFAULT_CAR]
+    assert notified.filter_new(watchlist_id, [DEFAULT_CAR]) == []
+    notified.add(watchlist_id, DEFAULT_CAR)
+    assert notified.filter_new(watchlist_id, [DEFAULT_CAR]) == []
+    assert notified.pending == set()
+
+
+def test_save_and_load():
+    db = mongomock.MongoClient().db
+    watchlist_id = ObjectId()
+    notified = NotifiedStore()
+    notified.check_and_add(watchlist_id, DEFAULT_CAR)
+    notified.save(db)
+
+    restored = NotifiedStore()
+    restored.load(db)
+
+    assert len(restored) == 1
+    assert not restored.check_and_add(watchlist_id, DEFAULT_CAR)
+
+
+def test_save_shards_hashes():
+    db = mongomock.MongoClient().db
+    watchlist_ids = [ObjectId() for _ in range(5)]
+    notified = NotifiedStore()
+    for watchlist_id in watchlist_ids:
+        notified.check_and_add(watchlist_id, DEFAULT_CAR)
+
+    with mock.patch('services.notification_dedup.HASHES_PER_SHARD', 2):
+        notified.save(db)
+        notified.save(db)
+
+    restored = NotifiedStore()
+    restored.load(db)
+
+    assert db['notification_dedup_shards'].count_documents({}) == 3
+    assert len(restored) == 5
+    assert not any(restored.is_new(watchlist_id, DEFAULT_CAR) for watchlist_id in watchlist_ids)
@@ -0,0 +1,154 @@
+from telegram.error import NetworkError, RetryAfter
+from services.notification_dispatcher import NotificationDispatcher, merge_car_messages
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeBot:
+    def __init__(self, clock, failures=0, error=None):
+        self.clock = clock
+        self.failures = failures
+        self.error = error or RetryAfter(5)
+        self.sent_messages = []
+
+    def send_message(self, chat_id, text):
+        if self.failures:
+            self.failures -= 1
+            raise self.error
+        self.sent_messages.append((self.clock(), chat_id, text))
+
+
+def create_car(i):
+    return {
+        'post': [{'postUrl': f'postUrl{i}'}],
+        'carInfo': {'year': 2015, 'make': 'Honda', 'model': 'Saber'},
+        'price': {'amount': 5000, 'currency': 'USD'},
+        'mileage': 96202,
+    }
+
+
+def create_dispatcher(failures=0, global_rate=30, chat_rate=1, error=None):
+    clock = FakeClock()
+    bot = FakeBot(clock, failures, error)
+    dispatcher = NotificationDispatcher(
+        bot,
+        global_rate=global_rate,
+        chat_rate=chat_rate,
+        clock=clock,
+        sleep=clock.sleep,
+    )
+    return (dispatcher, bot, clock)
+
+
+def test_merge_car_messages():
+    assert merge_car_messages(['a'] * 25) == [
+        '\n\n'.join(['a'] * 10),
+        '\n\n'.join(['a'] * 10),
+        '\n\n'.join(['a'] * 5),
+    ]
+    assert merge_car_messages(['a' * 3000, 'b' * 3000]) == ['a' * 3000, 'b' * 3000]
+
+
+def test_cars_are_grouped_per_chat():
+    (dispatcher, bot, clock) = create_dispatcher()
+
+    dispatcher.add_matches(1, [create_car(1), create_car(2)])
+    dispatcher.add_matches(1, [create_car(3)])
+    dispatcher.add_matches(2, [create_car(4)])
+
+    assert dispatcher.flush() == 2
+    assert [chat_id for (_, chat_id, _) in bot.sent_messages] == [1, 2]
+    assert bot.sent_messages[0][2].count('postUrl') == 3
+    assert dispatcher.pending_chats() == 0
+
+
+def test_chat_rate_limit():
+    (dispatcher, bot, clock) = create_dispatcher()
+
+    dispatcher.add_matches(1, [create_car(i) for i in range(25)])
+    dispatcher.add_matches(2, [create_car(1)])
+    dispatcher.flush()
+
+    times = [t for (t, chat_id, _) in bot.sent_messages if chat_id == 1]
+    assert len(times) == 3
+    assert times[1] - times[0] >= 1
+    assert times[2] - times[1] >= 1
+    assert bot.sent_messages[1][1] == 2
+
+
+def test_global_rate_limit():
+    (dispatcher, bot, clock) = create_dispatcher(global_rate=2)
+
+    for chat_id in range(4):
+        dispatcher.add_matches(chat_id, [create_car(1)])
+    dispatcher.flush()
+
+    assert [t for (t, _, _) in bot.sent_messages] == [0, 0, 0.5, 1]
+
+
+def test_retry_after_defers_only_the_chat():
+    (dispatcher, bot, clock) = create_dispatcher(failures=1)
+
+    dispatcher.add_matches(1, [create_car(1)])
+    dispatcher.add_matches(2, [create_car(2)])
+
+    assert dispatcher.flush() == 1
+    assert [(t, chat_id) for (t, chat_id, _) in bot.sent_messages] == [(0, 2)]
+    assert (dispatcher.queued, dispatcher.flushed) == (2, 0)
+
+    clock.now = 4
+    assert dispatcher.flush() == 0
+    clock.now = 5
+    assert dispatcher.flush() == 1
+    assert bot.sent_messages[-1][:2] == (5, 1)
+    assert dispatcher.flushed == 2
+
+
+def test_failed_sends_are_retried_then_dropped():
+    (dispatcher, bot, clock) = create_dispatcher(failures=3, error=NetworkError('timeout'))
+    sent_cars = []
+
+    dispatcher.add_matches(1, [create_car(1)], on_sent=sent_cars.append)
+    assert dispatcher.flush() == 0
+    assert dispatcher.pending_chats() == 1
+    clock.now += 1
+    assert dispatcher.flush() == 0
+    clock.now += 2
+    assert dispatcher.flush() == 0
+
+    assert dispatcher.pending_chats() == 0
+    assert dispatcher.flushed == 1
+    assert sent_cars == []
+
+
+def test_idle_chat_buckets_are_evicted():
+    (dispatcher, bot, clock) = create_dispatcher()
+
+    dispatcher.add_matches(1, [create_car(1)])
+    dispatcher.flush()
+    assert 1 in dispatcher.chat_buckets
+
+    clock.now = 1
+    dispatcher.flush()
+    assert dispatcher.chat_buckets == {}
+
+
+def test_flushed_tracks_queued_matches():
+    (dispatcher, bot, clock) = create_dispatcher()
+
+    dispatcher.add_matches('chat1', [create_car(1)])
+    dispatcher.add_matches('chat2', [])
+    assert (dispatcher.queued, dispatcher.flushed) == (2, 0)
+
+    dispatcher.flush()
+    assert (dispatcher.queued, dispatcher.flushed) == (2, 2)
+    assert len(bot.sent_messages) == 1
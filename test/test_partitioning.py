@@ -0,0 +1,81 @@
+import mongomock
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+from services.partitioning import PartitionLeases, PartitionedMatcher, get_partition
+
+
+class Clock:
+    def __init__(self):
+        self.now = datetime(2020, 1, 1)
+
+    def __call__(self):
+        return self.now
+
+
+def test_get_partition_is_stable():
+    user_id = ObjectId('5f0c6e7a1c9d440000a1b2c3')
+
+    assert get_partition(user_id) == get_partition(str(user_id))
+    assert get_partition(user_id, 8) == get_partition(user_id, 8)
+    assert 0 <= get_partition(user_id, 8) < 8
+
+
+def test_workers_share_partitions():
+    db = mongomock.MongoClient().db
+    clock = Clock()
+    first = PartitionLeases(db, 'first', partition_count=8, clock=clock)
+    second = PartitionLeases(db, 'second', partition_count=8, clock=clock)
+
+    assert len(first.rebalance()) == 8
+
+    # A joining worker takes nothing until the first one gives up its surplus
+    second.heartbeat()
+    assert first.rebalance() == first.get_owned()
+    assert len(first.get_owned()) == 4
+    assert len(second.rebalance()) == 4
+    assert first.get_owned().isdisjoint(second.get_owned())
+
+    # The second worker dies, its leases expire and the first takes over
+    clock.now += timedelta(seconds=10)
+    first.rebalance()
+    clock.now += timedelta(seconds=25)
+    assert len(first.rebalance()) == 8
+    assert second.get_owned() == set()
+
+
+def test_matcher_indexes_owned_partitions():
+    db = mongomock.MongoClient().db
+    matcher = PartitionedMatcher(db, lambda watchlist, cars: None, partition_count=2)
+    user_ids = [ObjectId() for _ in range(20)]
+    db['watchlists'].insert_many([{'userId': user_id, 'make': 'Honda', 'model': 'Saber'} for user_id in user_ids])
+
+    matcher.set_partitions({0})
+    assert len(matcher.index) == 0
+
+    # Applied by the matcher thread between changes
+    matcher.apply_updates()
+    assert len(matcher.index) == sum(get_partition(user_id, 2) == 0 for user_id in user_ids)
+
+
+def test_taken_over_partition_catches_up():
+    db = mongomock.MongoClient().db
+    clock = Clock()
+    first = PartitionLeases(db, 'first', partition_count=1, clock=clock)
+    second = PartitionLeases(db, 'second', partition_count=1, clock=clock)
+    db['watchlists'].insert_one({'userId': ObjectId(), 'make': 'Honda', 'model': 'Saber'})
+    car_ids = db['cars'].insert_many([
+        {'carInfo': {'make': 'Honda', 'model': 'Saber'}}
+        for _ in range(3)
+    ]).inserted_ids
+
+    # The first worker notified the first car, then died
+    first.rebalance()
+    first.mark({0}, car_ids[0])
+    clock.now += timedelta(seconds=60)
+
+    notifications = []
+    matcher = PartitionedMatcher(db, lambda watchlist, cars: notifications.append(cars[0]['_id']), partition_count=1, leases=second)
+    matcher.set_partitions(second.rebalance())
+    matcher.apply_updates()
+
+    assert notifications == car_ids[1:]
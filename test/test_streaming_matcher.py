@@ -0,0 +1,179 @@
+import mongomock
+from datetime import timedelta
+from services.notification_dedup import NotifiedStore
+from bson.objectid import ObjectId
+from services.matching_cache import get_cars_version
+from services.streaming_matcher import StreamingMatcher, PollingFeed, create_dispatcher_notifier
+
+
+DEFAULT_CAR = {
+    'carInfo': {
+        'year': 2015,
+        'make': 'Honda',
+        'model': 'Saber',
+    },
+    'price': {
+        'amount': 5000,
+        'currency': 'USD'
+    },
+    'mileage': 96202,
+}
+DEFAULT_WATCHLIST = {
+    'make': 'Honda',
+    'model': 'Saber',
+    'price': {
+        'max': 7500
+    }
+}
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.queued = 0
+        self.flushed = 0
+        self.pending = []
+        self.sent = []
+
+    def add_matches(self, chat_id, cars, on_sent=None):
+        self.pending.append((chat_id, cars, on_sent))
+        self.queued += 1
+
+    def flush(self):
+        for (chat_id, cars, on_sent) in self.pending:
+            self.sent.append((chat_id, cars))
+            for car in cars:
+                if on_sent:
+                    on_sent(car)
+        self.pending = []
+        self.flushed = self.queued
+
+
+def create_matcher():
+    db = mongomock.MongoClient().db
+    notifications = []
+    matcher = StreamingMatcher(db, lambda watchlist, cars: notifications.append((watchlist['_id'], cars)))
+    return (db, matcher, notifications)
+
+
+def get_change(collection, operation, document, **fields):
+    return {
+        'ns': {'coll': collection},
+        'operationType': operation,
+        'documentKey': {'_id': document['_id']},
+        'fullDocument': document,
+        **fields,
+    }
+
+
+def test_handle_changes():
+    (db, matcher, notifications) = create_matcher()
+    watchlist = {**DEFAULT_WATCHLIST, '_id': ObjectId(), 'userId': ObjectId()}
+    car = {**DEFAULT_CAR, '_id': ObjectId()}
+
+    matcher.handle_change(get_change('watchlists', 'insert', watchlist))
+    matcher.handle_change(get_change('cars', 'insert', car))
+    matcher.handle_change(get_change('cars', 'update', car, updateDescription={'updatedFields': {'photos': []}}))
+    matcher.handle_change(get_change('cars', 'update', car, updateDescription={'updatedFields': {'price.amount': 4000}}))
+    matcher.handle_change(get_change('watchlists', 'delete', watchlist, fullDocument=None))
+    matcher.handle_change(get_change('cars', 'insert', car))
+
+    assert notifications == [
+        (watchlist['_id'], [car]),
+        (watchlist['_id'], [car]),
+    ]
+
+
+def test_polling_feed_resumes():
+    (db, matcher, notifications) = create_matcher()
+    db.watchlists.insert_one({**DEFAULT_WATCHLIST, 'userId': ObjectId()})
+    db.cars.insert_one({**DEFAULT_CAR})
+
+    feed = PollingFeed(db, sleep=lambda seconds: matcher.stop())
+    first_car_id = db.cars.insert_one({**DEFAULT_CAR}).inserted_id
+    matcher.run(feed)
+
+    assert len(notifications) == 1
+    assert matcher.load_resume_token() == {'lastCarId': first_car_id}
+    assert get_cars_version(db) == 1
+
+    db.cars.insert_one({**DEFAULT_CAR})
+    feed = PollingFeed(db, matcher.load_resume_token(), sleep=lambda seconds: matcher.stop())
+    matcher.run(feed)
+
+    assert len(notifications) == 2
+
+
+def test_polling_feed_sees_late_inserts_with_older_ids():
+    db = mongomock.MongoClient().db
+    newest_id = db.cars.insert_one({**DEFAULT_CAR}).inserted_id
+    feed = PollingFeed(db, sleep=lambda seconds: None)
+    late_id = ObjectId.from_datetime(newest_id.generation_time - timedelta(seconds=10))
+
+    db.cars.insert_one({**DEFAULT_CAR, '_id': late_id})
+    new_id = db.cars.insert_one({**DEFAULT_CAR}).inserted_id
+    changes = [feed.next_change() for _ in range(3)]
+
+    assert [change['documentKey']['_id'] for change in changes if change] == [late_id, new_id]
+
+
+def test_resume_token_of_another_feed_is_ignored():
+    (db, matcher, notifications) = create_matcher()
+    matcher.feed_name = 'change_stream'
+    matcher.save_resume_token({'_data': 'token'})
+
+    assert matcher.load_resume_token('change_stream') == {'_data': 'token'}
+    assert matcher.load_resume_token('polling') is None
+
+
+def test_resume_token_waits_for_dispatcher():
+    db = mongomock.MongoClient().db
+    dispatcher = FakeDispatcher()
+    user_id = db.users.insert_one({'telegram': {'id': 'chat'}}).inserted_id
+    db.watchlists.insert_one({**DEFAULT_WATCHLIST, 'userId': user_id})
+    matcher = StreamingMatcher(db, create_dispatcher_notifier(db, dispatcher), dispatcher=dispatcher)
+    saved_before_flush = []
+
+    def stop(seconds):
+        saved_before_flush.append(matcher.load_resume_token())
+        matcher.stop()
+
+    feed = PollingFeed(db, sleep=stop)
+    car_id = db.cars.insert_one({**DEFAULT_CAR}).inserted_id
+    matcher.run(feed)
+
+    assert saved_before_flush == [None]
+    assert [chat_id for (chat_id, _) in dispatcher.sent] == ['chat']
+    assert matcher.load_resume_token() == {'lastCarId': car_id}
+
+
+def test_notifier_does_not_cache_missing_users():
+    db = mongomock.MongoClient().db
+    dispatcher = FakeDispatcher()
+    notify = create_dispatcher_notifier(db, dispatcher, max_chat_ids=1)
+    watchlist = {**DEFAULT_WATCHLIST, '_id': ObjectId(), 'userId': ObjectId()}
+
+    notify(watchlist, [DEFAULT_CAR])
+    db.users.insert_one({'_id': watchlist['userId']})
+    notify(watchlist, [DEFAULT_CAR])
+    db.users.update_one({'_id': watchlist['userId']}, {'$set': {'telegram': {'id': 'chat'}}})
+    notify(watchlist, [DEFAULT_CAR])
+
+    assert [(chat_id, cars) for (chat_id, cars, _) in dispatcher.pending] == [('chat', [DEFAULT_CAR])]
+
+
+def test_notified_after_send():
+    db = mongomock.MongoClient().db
+    dispatcher = FakeDispatcher()
+    notified = NotifiedStore()
+    notify = create_dispatcher_notifier(db, dispatcher, notified)
+    user_id = db.users.insert_one({'telegram': {'id': 'chat'}}).inserted_id
+    watchlist = {**DEFAULT_WATCHLIST, '_id': ObjectId(), 'userId': user_id}
+    car = {**DEFAULT_CAR, 'carInfo': {**DEFAULT_CAR['carInfo'], 'vin': 'SOMEVIN'}}
+
+    notify(watchlist, [car])
+    assert notified.is_new(watchlist['_id'], car)
+
+    dispatcher.flush()
+    notify(watchlist, [car])
+    assert not notified.is_new(watchlist['_id'], car)
+    assert dispatcher.pending == []
@@ -1,9 +1,13 @@
+import json
 from bson.objectid import ObjectId
 from models import db
 from app import app
 from helpers import create_authorization_headers
 import pytest
+import mock
 from datetime import datetime
+from services.matching_cache import matching_cars_cache
+from bot.db_cache import MISSING, watchlists_cache
 
 
 DEFAULT_CAR = {
@@ -55,12 +59,21 @@ email = 'admin@mail.com'
 headers = create_authorization_headers(user_id, email)
 
 
+def create_car():
+    return {k: v for (k, v) in DEFAULT_CAR.items() if k != '_id'}
+
+
+def create_watchlist():
+    return {k: v for (k, v) in DEFAULT_WATCHLIST.items() if k != '_id'}
+
+
 @pytest.fixture
 def clear_db():
     db['cars'].drop()
     db['users'].drop()
     db['dealers'].drop()
     db['watchlists'].drop()
+    matching_cars_cache.invalidate()
 
 
 def test_get_watchlists(clear_db):
@@ -245,3 +258,386 @@ def test_get_matching_cars(clear_db):
         'make' : 'Subaru',
         'model' : 'Forester'
     }
+    assert rv.data == json.dumps(list(db['cars'].find()), default=str).encode()
+
+
+def test_get_matching_cars_after_cursor(clear_db):
+    car_ids = [
+        db['cars'].insert_one({**create_car(), 'mileage': mileage}).inserted_id
+        for mileage in [10000, 20000, 30000]
+    ]
+    user_id = db['users'].insert_one(DEFAULT_USER).inserted_id
+    watchlist_id = db['watchlists'].insert_one(
+        {
+            **DEFAULT_WATCHLIST,
+            'userId': user_id,
+        }
+    ).inserted_id
+    headers = create_authorization_headers(str(user_id), email)
+
+    with app.test_client() as c:
+        first_page = c.get(
+            f'/watchlists/{watchlist_id}/cars?limit=2',
+            mimetype="application/json",
+            headers=headers
+        )
+        second_page = c.get(
+            f'/watchlists/{watchlist_id}/cars?limit=2&after={first_page.json[-1]["_id"]}&count=none',
+            mimetype="application/json",
+            headers=headers
+        )
+
+    assert [car['_id'] for car in first_page.json] == [str(car_ids[0]), str(car_ids[1])]
+    assert first_page.headers['X-Total-Count'] == '3'
+    assert [car['_id'] for car in second_page.json] == [str(car_ids[2])]
+    assert 'X-Total-Count' not in second_page.headers
+
+
+def test_watchlist_writes_invalidate_bot_cache(clear_db):
+    user_id = db['users'].insert_one(DEFAULT_USER).inserted_id
+    watchlist_id = db['watchlists'].insert_one({**DEFAULT_WATCHLIST, 'userId': user_id}).inserted_id
+    headers = create_authorization_headers(str(user_id), email)
+
+    with app.test_client() as c:
+        watchlists_cache.set(user_id, [])
+        c.post('/watchlists', json=DEFAULT_WATCHLIST, headers=headers)
+        assert watchlists_cache.get(user_id) is MISSING
+
+        watchlists_cache.set(user_id, [])
+        c.patch(f'/watchlists/{watchlist_id}', json={'mileage': {'max': 187000}}, headers=headers)
+        assert watchlists_cache.get(user_id) is MISSING
+
+        watchlists_cache.set(user_id, [])
+        c.delete(f'/watchlists/{watchlist_id}', headers=headers)
+        assert watchlists_cache.get(user_id) is MISSING
+
+
+def test_update_watchlist_by_id_not_owner(clear_db):
+    user_id = db['users'].insert_one(DEFAULT_USER).inserted_id
+    watchlist_id = db['watchlists'].insert_one(
+        {
+            **DEFAULT_WATCHLIST,
+            'userId': user_id
+        }
+    ).inserted_id
+
+    with app.test_client() as c:
+        rv = c.patch(
+            f'/watchlists/{watchlist_id}',
+            json={'mileage': {'max': 187000}},
+            mimetype="application/json",
+            headers=headers
+        )
+
+    assert rv.status_code == 403
+    assert db['watchlists'].find_one({'_id': watchlist_id})['mileage'] == {'max': 100000}
+
+
+def test_delete_watchlist_by_id_not_found(clear_db):
+    watchlist_id = ObjectId()
+    with app.test_client() as c:
+        rv = c.delete(
+            f'/watchlists/{watchlist_id}',
+            mimetype="application/json",
+            headers=headers
+        )
+
+    assert rv.status_code == 404
+    assert rv.json == {'error': f'Watchlist with id: {watchlist_id} does not exist'}
+
+
+@pytest.mark.parametrize('req,error', [
+    ({'fromYear': -1, 'toYear': 2010}, 'fromYear must be a non-negative integer'),
+    ({'fromYear': 2012, 'toYear': 2010}, 'fromYear must not be greater than toYear'),
+    ({'maxMileage': '1000'}, 'maxMileage must be a non-negative integer'),
+    ({'maxPrice': 10.5}, 'maxPrice must be a non-negative integer'),
+    ({'maxPrice': True}, 'maxPrice must be a non-negative integer'),
+])
+def test_add_watchlist_invalid_numbers(clear_db, req, error):
+    with app.test_client() as c:
+        rv = c.post(
+            f'/watchlists',
+            json={'make': 'Subaru', 'model': 'Forester', **req},
+            mimetype="application/json",
+            headers=headers
+        )
+
+    assert rv.status_code == 400
+    assert rv.json == {'error': error}
+    assert db['watchlists'].count_documents({}) == 0
+
+
+def test_update_watchlist_invalid_numbers(clear_db):
+    user_id = db['users'].insert_one(DEFAULT_USER).inserted_id
+    watchlist_id = db['watchlists'].insert_one({**create_watchlist(), 'userId': user_id}).inserted_id
+    headers = create_authorization_headers(str(user_id), email)
+
+    with app.test_client() as c:
+        responses = [
+            c.patch(f'/watchlists/{watchlist_id}', json=update, mimetype="application/json", headers=headers)
+            for update in (
+                {'year': {'min': 2012, 'max': 2010}},
+                {'mileage': {'max': -5}},
+                {'price': {'min': 100}},
+            )
+        ]
+
+    assert [rv.status_code for rv in responses] == [400, 400, 400]
+    assert [rv.json['error'] for rv in responses] == [
+        'Watchlist year.min must not be greater than year.max',
+        'Watchlist mileage.max must be a non-negative integer',
+        'Watchlist price can only have max',
+    ]
+    assert db['watchlists'].find_one({'_id': watchlist_id})['year'] == DEFAULT_WATCHLIST['year']
+
+
+def test_add_watchlist_canonical_make_model(clear_db):
+    user_id = db['users'].insert_one({'telegram': {'id': 'id'}}).inserted_id
+    headers = create_authorization_headers(str(user_id), email)
+
+    with app.test_client() as c:
+        rv = c.post(
+            f'/watchlists',
+            json={'make': 'toyota', 'model': 'PRIUS'},
+            mimetype="application/json",
+            headers=headers
+        )
+
+    watchlist = db['watchlists'].find_one({'userId': user_id})
+
+    assert rv.status_code == 200
+    assert watchlist['make'] == 'Toyota'
+    assert watchlist['model'] == 'Prius'
+
+
+@pytest.mark.parametrize('make,model,suggestion', [
+    ('Toyota', 'Corolla Cross', {'make': 'Toyota', 'model': 'Corolla'}),
+    ('Honda', 'Civ', {'make': 'Honda', 'model': 'Civic'}),
+])
+def test_add_watchlist_inexact_make_model(clear_db, make, model, suggestion):
+    user_id = db['users'].insert_one({'telegram': {'id': 'id'}}).inserted_id
+    headers = create_authorization_headers(str(user_id), email)
+
+    with app.test_client() as c:
+        rv = c.post(
+            f'/watchlists',
+            json={'make': make, 'model': model},
+            mimetype="application/json",
+            headers=headers
+        )
+
+    assert rv.status_code == 400
+    assert rv.json['suggestions'][0] == suggestion
+    assert not db['watchlists'].count_documents({})
+
+
+def test_add_watchlists_bulk(clear_db):
+    user_id = db['users'].insert_one(DEFAULT_USER).inserted_id
+    headers = create_authorization_headers(str(user_id), email)
+
+    with app.test_client() as c:
+        rv = c.post(
+            f'/watchlists/bulk',
+            json=[
+                {'make': 'Subaru', 'model': 'Forester', 'maxPrice': 20000},
+                {'make': 'Toyota'},
+                {'make': 'Toyota', 'model': 'Prius', 'fromYear': 2004, 'toYear': 2009},
+            ],
+            mimetype="application/json",
+            headers=headers
+        )
+
+    watchlists = list(db['watchlists'].find({'userId': user_id}))
+
+    assert rv.status_code == 200
+    assert [result['status'] for result in rv.json] == [201, 400, 201]
+    assert sorted(str(watchlist['_id']) for watchlist in watchlists) == sorted([rv.json[0]['id'], rv.json[2]['id']])
+    assert db['watchlists'].find_one({'model': 'Prius'})['year'] == {'min': 2004, 'max': 2009}
+
+
+def test_update_watchlist_canonical_make_model(clear_db):
+    user_id = db['users'].insert_one(DEFAULT_USER).inserted_id
+    watchlist_id = db['watchlists'].insert_one({**create_watchlist(), 'userId': user_id}).inserted_id
+    headers = create_authorization_headers(str(user_id), email)
+
+    with app.test_client() as c:
+        patched = c.patch(f'/watchlists/{watchlist_id}', json={'make': 'toyota', 'model': 'PRIUS'}, headers=headers)
+        model_only = c.patch(f'/watchlists/{watchlist_id}', json={'model': 'aqua'}, headers=headers)
+        unknown = c.patch(f'/watchlists/{watchlist_id}', json={'model': 'Corolla Cross'}, headers=headers)
+
+    assert (patched.status_code, model_only.status_code, unknown.status_code) == (200, 200, 400)
+    assert unknown.json['suggestions'][0] == {'make': 'Toyota', 'model': 'Corolla'}
+    watchlist = db['watchlists'].find_one({'_id': watchlist_id})
+    assert (watchlist['make'], watchlist['model']) == ('Toyota', 'Aqua')
+
+
+def test_update_watchlists_bulk_canonical_make_model(clear_db):
+    user_id = db['users'].insert_one(DEFAULT_USER).inserted_id
+    watchlist_ids = db['watchlists'].insert_many([
+        {**create_watchlist(), 'userId': user_id},
+        {**create_watchlist(), 'userId': user_id},
+        {**create_watchlist(), 'userId': user_id},
+    ]).inserted_ids
+    headers = create_authorization_headers(str(user_id), email)
+
+    with app.test_client() as c:
+        patched = c.patch(
+            f'/watchlists/bulk',
+            json=[
+                {'id': str(watchlist_ids[0]), 'make': 'TOYOTA', 'model': 'prius'},
+                {'id': str(watchlist_ids[1]), 'model': 'forester'},
+                {'id': str(watchlist_ids[2]), 'make': 'Toyota'},
+            ],
+            headers=headers
+        )
+
+    assert [result['status'] for result in patched.json] == [200, 200, 400]
+    assert patched.json[2]['error'] == 'Unknown make and model: Toyota Forester'
+    watchlists = [db['watchlists'].find_one({'_id': id}) for id in watchlist_ids]
+    assert [(watchlist['make'], watchlist['model']) for watchlist in watchlists] == [
+        ('Toyota', 'Prius'),
+        ('Subaru', 'Forester'),
+        ('Subaru', 'Forester'),
+    ]
+
+
+def test_update_and_delete_watchlists_bulk(clear_db):
+    user_id = db['users'].insert_one(DEFAULT_USER).inserted_id
+    other_user_id = db['users'].insert_one({'telegram': {'id': 'other'}}).inserted_id
+    watchlist_id = db['watchlists'].insert_one({**create_watchlist(), 'userId': user_id}).inserted_id
+    other_watchlist_id = db['watchlists'].insert_one({**create_watchlist(), 'userId': other_user_id}).inserted_id
+    missing_id = str(ObjectId())
+    headers = create_authorization_headers(str(user_id), email)
+
+    with app.test_client() as c:
+        patched = c.patch(
+            f'/watchlists/bulk',
+            json=[
+                {'id': str(watchlist_id), 'mileage': {'max': 187000}, 'userId': str(other_user_id)},
+                {'id': str(other_watchlist_id), 'mileage': {'max': 187000}},
+                {'id': 'invalid'},
+            ],
+            mimetype="application/json",
+            headers=headers
+        )
+        deleted = c.delete(
+            f'/watchlists/bulk',
+            json={'ids': [str(watchlist_id), str(other_watchlist_id), missing_id]},
+            mimetype="application/json",
+            headers=headers
+        )
+
+    assert [result['status'] for result in patched.json] == [200, 403, 400]
+    assert [result['status'] for result in deleted.json] == [200, 403, 404]
+    assert db['watchlists'].find_one({'_id': watchlist_id}) is None
+    assert db['watchlists'].find_one({'_id': other_watchlist_id})['mileage'] == {'max': 100000}
+
+
+def test_bulk_watchlists_validation(clear_db):
+    user_id = db['users'].insert_one(DEFAULT_USER).inserted_id
+    watchlist_id = db['watchlists'].insert_one({**create_watchlist(), 'userId': user_id}).inserted_id
+    headers = create_authorization_headers(str(user_id), email)
+
+    with app.test_client() as c:
+        patched = c.patch(
+            f'/watchlists/bulk',
+            json=[
+                {'id': str(watchlist_id), 'make': ''},
+                {'id': str(watchlist_id), 'price': 5000},
+            ],
+            mimetype="application/json",
+            headers=headers
+        )
+        deleted = c.delete(
+            f'/watchlists/bulk',
+            json=[str(watchlist_id)],
+            mimetype="application/json",
+            headers=headers
+        )
+
+    assert [result['status'] for result in patched.json] == [400, 400]
+    assert deleted.status_code == 400
+    assert db['watchlists'].find_one({'_id': watchlist_id})['make'] == 'Subaru'
+
+
+def test_bulk_watchlists_concurrently_deleted(clear_db):
+    user_id = db['users'].insert_one(DEFAULT_USER).inserted_id
+    watchlist_id = db['watchlists'].insert_one({**create_watchlist(), 'userId': user_id}).inserted_id
+    deleted_id = str(ObjectId())
+    # The ownership check still sees a watchlist that another request deletes
+    owners = {str(watchlist_id): str(user_id), deleted_id: str(user_id)}
+    headers = create_authorization_headers(str(user_id), email)
+
+    with app.test_client() as c:
+        with mock.patch('routes.watchlist.get_owners', side_effect=[owners, {str(watchlist_id): str(user_id)}]):
+            patched = c.patch(
+                f'/watchlists/bulk',
+                json=[
+                    {'id': str(watchlist_id), 'mileage': {'max': 187000}},
+                    {'id': deleted_id, 'mileage': {'max': 187000}},
+                ],
+                mimetype="application/json",
+                headers=headers
+            )
+        with mock.patch('routes.watchlist.get_owners', return_value=owners):
+            deleted = c.delete(
+                f'/watchlists/bulk',
+                json={'ids': [str(watchlist_id), deleted_id]},
+                mimetype="application/json",
+                headers=headers
+            )
+
+    assert [result['status'] for result in patched.json] == [200, 404]
+    # Deleting is idempotent, a watchlist deleted concurrently is still gone
+    assert [result['status'] for result in deleted.json] == [200, 200]
+    assert db['watchlists'].find_one({'_id': watchlist_id}) is None
+
+
+def test_get_matching_cars_capped_count(clear_db):
+    db['cars'].insert_many([create_car() for _ in range(3)])
+    user_id = db['users'].insert_one(DEFAULT_USER).inserted_id
+    watchlist_id = db['watchlists'].insert_one(
+        {
+            **DEFAULT_WATCHLIST,
+            'userId': user_id,
+        }
+    ).inserted_id
+    headers = create_authorization_headers(str(user_id), email)
+
+    with mock.patch('routes.watchlist.COUNT_CAP', 2):
+        with app.test_client() as c:
+            rv = c.get(
+                f'/watchlists/{watchlist_id}/cars?limit=1&count=capped',
+                mimetype="application/json",
+                headers=headers
+            )
+
+    assert len(rv.json) == 1
+    assert rv.headers['X-Total-Count'] == '2+'
+
+
+def test_get_matching_cars_summary_fields(clear_db):
+    db['cars'].insert_one({
+        **create_car(),
+        'post': [{**DEFAULT_CAR['post'][0], 'postUrl': 'postUrl'}],
+        'photos': ['url1', 'url2'],
+        'description': ['text'],
+    })
+    user_id = db['users'].insert_one(DEFAULT_USER).inserted_id
+    watchlist_id = db['watchlists'].insert_one(
+        {
+            **DEFAULT_WATCHLIST,
+            'userId': user_id,
+        }
+    ).inserted_id
+    headers = create_authorization_headers(str(user_id), email)
+
+    with app.test_client() as c:
+        rv = c.get(
+            f'/watchlists/{watchlist_id}/cars?fields=summary',
+            mimetype="application/json",
+            headers=headers
+        )
+
+    assert set(rv.json[0].keys()) == {'_id', 'post', 'carInfo', 'price', 'mileage'}
+    assert rv.json[0]['post'] == [{'platform': 'platform', 'postUrl': 'postUrl'}]
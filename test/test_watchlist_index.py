@@ -0,0 +1,85 @@
+from bson.objectid import ObjectId
+from services.watchlist_index import WatchlistIndex
+
+
+DEFAULT_CAR = {
+    'carInfo': {
+        'year': 2015,
+        'make': 'Honda',
+        'model': 'Saber',
+    },
+    'price': {
+        'amount': 5000,
+        'currency': 'USD'
+    },
+    'mileage': 96202,
+}
+
+
+def create_watchlist(**fields):
+    return {
+        '_id': ObjectId(),
+        'userId': ObjectId(),
+        'make': 'Honda',
+        'model': 'Saber',
+        **fields,
+    }
+
+
+def test_match_by_make_and_model():
+    watchlist = create_watchlist()
+    other_watchlist = create_watchlist(make='Toyota', model='Aqua')
+    index = WatchlistIndex([watchlist, other_watchlist])
+
+    assert index.match(DEFAULT_CAR) == [watchlist]
+
+
+def test_match_bounds():
+    matching = create_watchlist(
+        year={'min': 2012, 'max': 2019},
+        mileage={'max': 300000},
+        price={'max': 7500},
+    )
+    too_cheap = create_watchlist(price={'max': 4999})
+    too_old = create_watchlist(year={'min': 2016, 'max': 2020})
+    too_far = create_watchlist(mileage={'max': 90000})
+    index = WatchlistIndex([matching, too_cheap, too_old, too_far])
+
+    assert index.match(DEFAULT_CAR) == [matching]
+
+
+def test_match_car_without_price():
+    unbounded = create_watchlist()
+    bounded = create_watchlist(price={'max': 7500})
+    index = WatchlistIndex([unbounded, bounded])
+    car = {**DEFAULT_CAR}
+    car.pop('price')
+
+    assert index.match(car) == [unbounded]
+
+
+def test_remove_and_replace():
+    watchlist = create_watchlist(price={'max': 7500})
+    index = WatchlistIndex([watchlist])
+
+    index.add({**watchlist, 'price': {'max': 1000}})
+    assert index.match(DEFAULT_CAR) == []
+    assert len(index) == 1
+
+    assert index.remove(watchlist['_id'])
+    assert not index.remove(watchlist['_id'])
+    assert len(index) == 0
+
+
+def test_match_cars():
+    watchlist = create_watchlist(year={'min': 2016, 'max': 2020})
+    old_car = DEFAULT_CAR
+    new_car = {
+        **DEFAULT_CAR,
+        'carInfo': {**DEFAULT_CAR['carInfo'], 'year': 2017},
+    }
+    index = WatchlistIndex([watchlist])
+
+    assert index.match_cars([old_car, new_car]) == {
+        watchlist['_id']: (watchlist, [new_car])
+    }
@@ -0,0 +1,80 @@
+import pytest
+from bson.objectid import ObjectId
+from models.watchlist_types import NO_BOUND, CarSummary, Watchlist, parse_watchlists
+from services.watchlists import get_car_message
+
+
+DEFAULT_WATCHLIST = {
+    '_id': ObjectId(),
+    'userId': ObjectId(),
+    'make': 'Honda',
+    'model': 'Saber',
+    'year': {
+        'min': 2010,
+        'max': 2015
+    },
+    'mileage': {
+        'max': 100000
+    },
+    'price': {
+        'max': 7500
+    }
+}
+
+
+def test_watchlist_round_trip():
+    watchlist = Watchlist.from_doc(DEFAULT_WATCHLIST)
+
+    assert watchlist.to_doc() == DEFAULT_WATCHLIST
+    assert watchlist.short_label == 'Honda Saber 2010-2015 100000mi 7500'
+    assert watchlist['price'] == {'max': 7500}
+    assert Watchlist.from_doc({'make': 'Honda', 'model': 'Saber'}).get('year') is None
+
+
+def test_watchlist_validates_numbers():
+    watchlist = Watchlist.from_doc({'make': 'Honda', 'model': 'Saber', 'price': {'max': '7500'}})
+
+    assert watchlist.max_price == 7500
+    with pytest.raises(ValueError):
+        Watchlist.from_doc({'make': 'Honda', 'model': 'Saber', 'price': {'max': 'cheap'}})
+    with pytest.raises(ValueError):
+        Watchlist.from_doc({'model': 'Saber'})
+
+
+def test_missing_bounds_are_open_ended():
+    watchlist = Watchlist.from_doc({'make': 'Honda', 'model': 'Saber', 'year': {'min': 2010}, 'price': {}})
+
+    assert watchlist.bounds == (2010, NO_BOUND, NO_BOUND, NO_BOUND)
+    assert watchlist.to_doc() == {'make': 'Honda', 'model': 'Saber', 'year': {'min': 2010}}
+    assert watchlist.short_label == 'Honda Saber 2010-'
+
+
+def test_parse_watchlists_skips_invalid_docs():
+    docs = [
+        {'_id': 1, 'make': 'Honda'},
+        {'_id': 2, 'make': 'Honda', 'model': 'Saber', 'price': {'max': 'cheap'}},
+        {'_id': 3, 'make': 'Honda', 'model': 'Saber'},
+    ]
+
+    assert [watchlist._id for watchlist in parse_watchlists(docs)] == [3]
+
+
+def test_watchlist_is_hashable():
+    watchlist = Watchlist.from_doc(DEFAULT_WATCHLIST)
+
+    assert {watchlist, Watchlist.from_doc(DEFAULT_WATCHLIST)} == {watchlist}
+
+
+def test_car_summary_renders_like_its_document():
+    car = {
+        '_id': ObjectId(),
+        'carInfo': {'year': 2015, 'make': 'Honda', 'model': 'Saber'},
+        'mileage': 96202,
+        'price': {'amount': 5000.5, 'currency': 'USD'},
+        'post': [{'platform': 'craigslist', 'postUrl': 'postUrl'}],
+    }
+    summary = CarSummary.from_doc(car)
+
+    assert summary.to_doc() == car
+    assert get_car_message(summary) == get_car_message(car)
+    assert CarSummary.from_doc({'_id': 1, 'carInfo': {'make': 'Honda', 'model': 'Saber'}}).get('price') is None
@@ -1,19 +1,61 @@
-from flask import request, Response
+from flask import request
 from flask_cors import CORS
 from bson.objectid import ObjectId
-import json
 from models import db
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from app import app
 from routes.processes import is_not_valid, create_response
 from models.utils import get_filters
-from utils.make_model_utils import MAKE_WITH_MODEL_NAMES
-from flask import jsonify, request
-from services.watchlists import fetch_matching_cars
+from utils.make_model_index import MAKE_MODEL_INDEX
+from flask import jsonify, request, stream_with_context
+from services.car_queries import (
+    COUNT_CAP,
+    CAR_PROJECTIONS,
+    fetch_cars_page,
+    fetch_matching_cars_page,
+    count_matching_cars,
+    format_car_count,
+)
+from services.matching_cache import matching_cars_cache
+from bot.db_cache import invalidate_watchlists
+from utils.json_utils import dumps
 
 
 CORS(app)
+STREAM_CHUNK_SIZE = 50
+COUNT_MODES = ('exact', 'capped', 'cached', 'none')
+MAX_BULK_SIZE = 1000
+MAX_SUGGESTIONS = 5
+PROTECTED_FIELDS = ('id', '_id', 'userId')
+NUMBER_FIELDS = ('fromYear', 'toYear', 'maxMileage', 'maxPrice')
+BOUND_FIELDS = {'year': ('min', 'max'), 'mileage': ('max',), 'price': ('max',)}
+
+
+def stream_json_array(items):
+    yield '['
+    chunk = []
+    separator = ''
+    for item in items:
+        chunk.append(separator + dumps(item))
+        separator = ', '
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+    yield ']'
+
+
+def create_error_response(error, status):
+    return create_response(dumps({'error': error}), status)
+
+
+def get_ownership_error(id, action):
+    if not db['watchlists'].count_documents({'_id': ObjectId(id)}, limit=1):
+        return create_error_response(f'Watchlist with id: {id} does not exist', 404)
+    return create_error_response(f'User not authorized to {action} this watchlist', 403)
 
 
 @app.route('/users/me/watchlists', methods=['GET'])
@@ -24,18 +66,34 @@ def get_watchlists():
     watchlists = list(db['watchlists'].find(
        {'userId': ObjectId(current_user_id)} 
     ))
-    return create_response(json.dumps(watchlists, default=str))
+    return create_response(dumps(watchlists))
 
 
-@app.route('/watchlists', methods=['POST'])
-@jwt_required
-def add_watchlist():
-    current_user_id = get_jwt_identity()
-    req = request.get_json()
+def get_make_model_error(make, model):
+    suggestions = MAKE_MODEL_INDEX.complete(f'{make} {model}', limit=MAX_SUGGESTIONS)
+    return {
+        'error': f'Unknown make and model: {make} {model}',
+        'suggestions': [{'make': name[0], 'model': name[1]} for name in suggestions],
+    }
+
+
+def build_watchlist_doc(current_user_id, req):
+    '''Returns (watchlist, error), error being a JSON object for the response.
+
+    Makes and models are stored by their canonical names and must match one
+    exactly or by alias; otherwise the error lists the closest suggestions.
+    '''
+    error = validate_watchlist_request(req)
+    if error:
+        return (None, {'error': error})
+    make_model = MAKE_MODEL_INDEX.resolve_exact(req['make'], req['model'])
+    if not make_model:
+        return (None, get_make_model_error(req['make'], req['model']))
+    (make, model) = make_model
     watchlist = {
         'userId' : ObjectId(current_user_id),
-        'make' : req.get('make'),
-        'model' : req.get('model'),
+        'make' : make,
+        'model' : model,
     }
     if req.get('fromYear') and req.get('toYear'):
         watchlist['year'] = {
@@ -50,7 +108,154 @@ def add_watchlist():
         watchlist['price'] = {
             'max' : req.get('maxPrice')
         }
+    return (watchlist, None)
+
+
+def resolve_update_make_model(update, current):
+    '''Stores the make and model of an update by their canonical names.
+
+    A make or model updated on its own is resolved together with the
+    current one. Returns the error JSON object when they don't resolve.
+    '''
+    if 'make' not in update and 'model' not in update:
+        return None
+    make = update.get('make', current.get('make'))
+    model = update.get('model', current.get('model'))
+    make_model = MAKE_MODEL_INDEX.resolve_exact(make, model)
+    if not make_model:
+        return get_make_model_error(make, model)
+    (update['make'], update['model']) = make_model
+    return None
+
+
+def needs_current_make_model(update):
+    return ('make' in update) != ('model' in update)
+
+
+def get_make_models(ids):
+    if not ids:
+        return {}
+    found = db['watchlists'].find(
+        {'_id': {'$in': [ObjectId(id) for id in ids]}},
+        {'make': True, 'model': True}
+    )
+    return {str(watchlist['_id']): watchlist for watchlist in found}
+
+
+def is_non_negative_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def validate_watchlist_request(req):
+    if not isinstance(req, dict):
+        return 'Watchlist must be an object'
+    if not req.get('make') or not req.get('model'):
+        return 'Watchlist must have make and model'
+    for field in NUMBER_FIELDS:
+        if req.get(field) is not None and not is_non_negative_int(req[field]):
+            return f'{field} must be a non-negative integer'
+    if req.get('fromYear') is not None and req.get('toYear') is not None and req['fromYear'] > req['toYear']:
+        return 'fromYear must not be greater than toYear'
+    return None
+
+
+def validate_bounds(field, bounds):
+    if not isinstance(bounds, dict):
+        return f'Watchlist {field} must be an object'
+    for (bound, value) in bounds.items():
+        if bound not in BOUND_FIELDS[field]:
+            return f'Watchlist {field} can only have {", ".join(BOUND_FIELDS[field])}'
+        if value is not None and not is_non_negative_int(value):
+            return f'Watchlist {field}.{bound} must be a non-negative integer'
+    if bounds.get('min') is not None and bounds.get('max') is not None and bounds['min'] > bounds['max']:
+        return f'Watchlist {field}.min must not be greater than {field}.max'
+    return None
+
+
+def get_watchlist_update(req):
+    if not isinstance(req, dict):
+        return (None, 'Watchlist update must be an object')
+    update = {k: v for (k, v) in req.items() if k not in PROTECTED_FIELDS}
+    for field in ('make', 'model'):
+        if field in update and not update[field]:
+            return (None, f'Watchlist {field} can not be empty')
+    for field in BOUND_FIELDS:
+        error = update.get(field) is not None and validate_bounds(field, update[field])
+        if error:
+            return (None, error)
+    return (update, None)
+
+
+def get_bulk_items(req):
+    if not isinstance(req, list) or not req:
+        return (None, 'Request body must be a non-empty list')
+    if len(req) > MAX_BULK_SIZE:
+        return (None, f'At most {MAX_BULK_SIZE} items are allowed per request')
+    return (req, None)
+
+
+def get_owners(ids):
+    owned = db['watchlists'].find(
+        {'_id': {'$in': [ObjectId(id) for id in ids]}},
+        {'userId': True}
+    )
+    return {str(watchlist['_id']): str(watchlist['userId']) for watchlist in owned}
+
+
+def get_owned_item_error(id, owners, current_user_id, action):
+    if not isinstance(id, str) or is_not_valid(id):
+        return {'status': 400, 'error': f'Invalid id: {id}'}
+    if id not in owners:
+        return {'status': 404, 'error': f'Watchlist with id: {id} does not exist'}
+    if owners[id] != current_user_id:
+        return {'status': 403, 'error': f'User not authorized to {action} this watchlist'}
+    return None
+
+
+def apply_bulk_operations(operations, results):
+    if not operations:
+        return None
+    try:
+        return db['watchlists'].bulk_write([operation for (_, operation) in operations], ordered=False)
+    except BulkWriteError as e:
+        for write_error in e.details['writeErrors']:
+            (i, _) = operations[write_error['index']]
+            results[i] = {**results[i], 'status': 500, 'error': write_error['errmsg']}
+        return None
+
+
+def delete_owned(ids, current_user_id):
+    '''Deletes the user's watchlists with a single delete_many.
+
+    The ids were checked against get_owners already. If fewer are deleted,
+    a concurrent request deleted the rest, which leaves the same outcome,
+    so every id is still reported as deleted.
+    '''
+    if not ids:
+        return 0
+    result = db['watchlists'].delete_many({
+        '_id': {'$in': [ObjectId(id) for (_, id) in ids]},
+        'userId': ObjectId(current_user_id),
+    })
+    return result.deleted_count
+
+
+def mark_missing(ids, found_ids, results):
+    # Watchlists deleted by a concurrent request after the ownership check
+    for (i, id) in ids:
+        if id not in found_ids and results[i]['status'] == 200:
+            results[i] = {'status': 404, 'error': f'Watchlist with id: {id} does not exist'}
+
+
+@app.route('/watchlists', methods=['POST'])
+@jwt_required
+def add_watchlist():
+    current_user_id = get_jwt_identity()
+    (watchlist, error) = build_watchlist_doc(current_user_id, request.get_json())
+    if error:
+        return create_response(dumps(error), 400)
     db['watchlists'].insert_one(watchlist)
+    invalidate_watchlists(watchlist['userId'])
     return create_response()
 
 
@@ -58,20 +263,31 @@ def add_watchlist():
 @jwt_required
 def update_watchlist_by_id(id):
     if is_not_valid(id):
-        return create_response(is_not_valid(id), 400)
+        return create_error_response(is_not_valid(id), 400)
     current_user_id = get_jwt_identity()
-    watchlist = db['watchlists'].find_one(
-        {'_id': ObjectId(id)}
-    )
-    req = request.get_json()
-    if not watchlist:
-        return create_response(f'Watchlist with id: {id} does not exist', 404)
-    if str(watchlist['userId']) != current_user_id:
-        return create_response(f'User not authorized to update this watchlist', 403)
-    db['watchlists'].update_one(
-        {'_id': ObjectId(id)},
-        {'$set': req}
+    (update, error) = get_watchlist_update(request.get_json())
+    if error:
+        return create_error_response(error, 400)
+    if not update:
+        return create_error_response('Watchlist update must not be empty', 400)
+    current = {}
+    if needs_current_make_model(update):
+        current = db['watchlists'].find_one(
+            {'_id': ObjectId(id), 'userId': ObjectId(current_user_id)},
+            {'make': True, 'model': True}
+        )
+        if not current:
+            return get_ownership_error(id, 'update')
+    error = resolve_update_make_model(update, current)
+    if error:
+        return create_response(dumps(error), 400)
+    result = db['watchlists'].update_one(
+        {'_id': ObjectId(id), 'userId': ObjectId(current_user_id)},
+        {'$set': update}
     )
+    if not result.matched_count:
+        return get_ownership_error(id, 'update')
+    invalidate_watchlists(ObjectId(current_user_id))
     return create_response()
 
 
@@ -79,35 +295,161 @@ def update_watchlist_by_id(id):
 @jwt_required
 def delete_watchlist_by_id(id):
     if is_not_valid(id):
-        return create_response(is_not_valid(id), 400)
+        return create_error_response(is_not_valid(id), 400)
     current_user_id = get_jwt_identity()
-    watchlist = db['watchlists'].find_one(
-        {'_id': ObjectId(id)}
+    result = db['watchlists'].delete_one(
+        {'_id': ObjectId(id), 'userId': ObjectId(current_user_id)}
     )
-    if not watchlist:
-        return create_response(f'Watchlist with id: {id} does not exist', 404)
-    if str(watchlist['userId']) != current_user_id:
-        return create_response(f'User not authorized to delete this watchlist', 403)
-    db['watchlists'].delete_one({'_id': ObjectId(id)})
+    if not result.deleted_count:
+        return get_ownership_error(id, 'delete')
+    invalidate_watchlists(ObjectId(current_user_id))
     return create_response()
 
 
+@app.route('/watchlists/bulk', methods=['POST'])
+@jwt_required
+def add_watchlists_bulk():
+    current_user_id = get_jwt_identity()
+    (items, error) = get_bulk_items(request.get_json())
+    if error:
+        return create_error_response(error, 400)
+
+    results = []
+    operations = []
+    for (i, item) in enumerate(items):
+        (watchlist, error) = build_watchlist_doc(current_user_id, item)
+        if error:
+            results.append({'status': 400, **error})
+            continue
+        watchlist = {'_id': ObjectId(), **watchlist}
+        results.append({'status': 201, 'id': str(watchlist['_id'])})
+        operations.append((i, InsertOne(watchlist)))
+    apply_bulk_operations(operations, results)
+    invalidate_watchlists(ObjectId(current_user_id))
+    return create_response(dumps(results))
+
+
+@app.route('/watchlists/bulk', methods=['PATCH'])
+@jwt_required
+def update_watchlists_bulk():
+    current_user_id = get_jwt_identity()
+    (items, error) = get_bulk_items(request.get_json())
+    if error:
+        return create_error_response(error, 400)
+
+    ids = [item.get('id') for item in items if isinstance(item, dict)]
+    owners = get_owners([id for id in ids if isinstance(id, str) and not is_not_valid(id)])
+    checked = []
+    for item in items:
+        id = item.get('id') if isinstance(item, dict) else None
+        error = get_owned_item_error(id, owners, current_user_id, 'update')
+        if error:
+            checked.append((id, None, error))
+            continue
+        (update, error) = get_watchlist_update(item)
+        checked.append((id, update, error and {'status': 400, 'error': error}))
+    current = get_make_models([
+        id for (id, update, error) in checked
+        if not error and needs_current_make_model(update)
+    ])
+    results = []
+    operations = []
+    for (i, (id, update, error)) in enumerate(checked):
+        if not error and needs_current_make_model(update) and id not in current:
+            error = {'status': 404, 'error': f'Watchlist with id: {id} does not exist'}
+        if not error:
+            make_model_error = resolve_update_make_model(update, current.get(id, {}))
+            error = make_model_error and {'status': 400, **make_model_error}
+        if error:
+            results.append(error)
+            continue
+        results.append({'status': 200, 'id': id})
+        if update:
+            operations.append((i, id, UpdateOne(
+                {'_id': ObjectId(id), 'userId': ObjectId(current_user_id)},
+                {'$set': update}
+            )))
+    result = apply_bulk_operations([(i, operation) for (i, _, operation) in operations], results)
+    if result and result.matched_count < len(operations):
+        updated = [(i, id) for (i, id, _) in operations]
+        mark_missing(updated, get_owners([id for (_, id) in updated]), results)
+    invalidate_watchlists(ObjectId(current_user_id))
+    return create_response(dumps(results))
+
+
+@app.route('/watchlists/bulk', methods=['DELETE'])
+@jwt_required
+def delete_watchlists_bulk():
+    current_user_id = get_jwt_identity()
+    req = request.get_json()
+    if not isinstance(req, dict):
+        return create_error_response('Request body must be an object with ids', 400)
+    (ids, error) = get_bulk_items(req.get('ids'))
+    if error:
+        return create_error_response(error, 400)
+
+    owners = get_owners([id for id in ids if isinstance(id, str) and not is_not_valid(id)])
+    results = []
+    deleting = []
+    for (i, id) in enumerate(ids):
+        error = get_owned_item_error(id, owners, current_user_id, 'delete')
+        if error:
+            results.append(error)
+            continue
+        results.append({'status': 200, 'id': id})
+        deleting.append((i, id))
+    delete_owned(deleting, current_user_id)
+    invalidate_watchlists(ObjectId(current_user_id))
+    return create_response(dumps(results))
+
+
 @app.route('/watchlists/<id>/cars', methods=['GET'])
 @jwt_required
 def get_matching_cars(id):
     if is_not_valid(id):
-        return create_response(is_not_valid(id), 400)
+        return create_error_response(is_not_valid(id), 400)
     current_user_id = get_jwt_identity()
     watchlist = db['watchlists'].find_one(
-        {'_id': ObjectId(id)}
+        {'_id': ObjectId(id), 'userId': ObjectId(current_user_id)}
     )
     if not watchlist:
-        return create_response(f'Watchlist with id: {id} does not exist', 404)
-    if str(watchlist['userId']) != current_user_id:
-        return create_response(f'User not authorized to view this watchlist', 403)
-    
+        return get_ownership_error(id, 'view')
+
     limit = int(request.args.get('limit', 10))
-    (cars, count) = fetch_matching_cars(db, watchlist, limit=limit)
-    resp = create_response(json.dumps(cars, default=str))
-    resp.headers['X-Total-Count'] = str(count)
+    after = request.args.get('after')
+    if after and is_not_valid(after):
+        return create_error_response(is_not_valid(after), 400)
+    count_mode = request.args.get('count', 'exact')
+    if count_mode not in COUNT_MODES:
+        return create_error_response(f'count must be one of: {", ".join(COUNT_MODES)}', 400)
+    fields = request.args.get('fields', 'full')
+    if fields not in CAR_PROJECTIONS:
+        return create_error_response(f'fields must be one of: {", ".join(CAR_PROJECTIONS)}', 400)
+
+    if not after and count_mode in ('exact', 'capped'):
+        # The first page and its count come from one aggregation
+        count_cap = COUNT_CAP if count_mode == 'capped' else None
+        (cars, count) = matching_cars_cache.get_or_fetch(
+            watchlist,
+            limit,
+            lambda: fetch_matching_cars_page(db, watchlist, limit, count_cap=count_cap, fields=fields),
+            db=db,
+            extra=('facet', count_cap, fields),
+        )
+        resp = create_response(stream_with_context(stream_json_array(cars)))
+        resp.headers['X-Total-Count'] = format_car_count(count, count_cap)
+        return resp
+
+    cars = matching_cars_cache.get_or_stream(
+        watchlist,
+        limit,
+        lambda: fetch_cars_page(db, watchlist, limit, after=after, fields=fields),
+        db=db,
+        extra=('page', after, fields),
+    )
+    resp = create_response(stream_with_context(stream_json_array(cars)))
+    if count_mode != 'none':
+        count_cap = COUNT_CAP if count_mode == 'capped' else None
+        count = count_matching_cars(db, watchlist, count_cap=count_cap, cached=count_mode == 'cached')
+        resp.headers['X-Total-Count'] = format_car_count(count, count_cap)
     return resp
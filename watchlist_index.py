@@ -0,0 +1,146 @@
+from bisect import bisect_left
+from models.watchlist_types import NO_BOUND, Watchlist, parse_watchlists
+
+
+def get_watchlist_bounds(watchlist):
+    if isinstance(watchlist, Watchlist):
+        return watchlist.bounds
+    min_year = -NO_BOUND
+    max_year = NO_BOUND
+    max_mileage = NO_BOUND
+    max_price = NO_BOUND
+    year = watchlist.get('year') or {}
+    if year.get('min') is not None:
+        min_year = int(year['min'])
+    if year.get('max') is not None:
+        max_year = int(year['max'])
+    if (watchlist.get('mileage') or {}).get('max') is not None:
+        max_mileage = int(watchlist['mileage']['max'])
+    if (watchlist.get('price') or {}).get('max') is not None:
+        max_price = int(watchlist['price']['max'])
+    return (min_year, max_year, max_mileage, max_price)
+
+
+def get_car_key(car):
+    car_info = car.get('carInfo') or {}
+    return (car_info.get('make'), car_info.get('model'))
+
+
+def get_car_values(car):
+    car_info = car.get('carInfo') or {}
+    price = car.get('price') or {}
+    year = car_info.get('year')
+    mileage = car.get('mileage')
+    amount = price.get('amount')
+    return (
+        year,
+        NO_BOUND if mileage is None else mileage,
+        NO_BOUND if amount is None else amount,
+    )
+
+
+class WatchlistBucket:
+    '''Watchlists of a single (make, model) kept sorted by max price.'''
+
+    def __init__(self):
+        self.prices = []
+        self.entries = []
+
+    def add(self, seq, watchlist):
+        (min_year, max_year, max_mileage, max_price) = get_watchlist_bounds(watchlist)
+        entry = (max_price, seq, min_year, max_year, max_mileage, watchlist)
+        i = bisect_left(self.entries, (max_price, seq))
+        self.entries.insert(i, entry)
+        self.prices.insert(i, max_price)
+
+    def remove(self, seq, max_price):
+        i = bisect_left(self.entries, (max_price, seq))
+        if i < len(self.entries) and self.entries[i][1] == seq:
+            del self.entries[i]
+            del self.prices[i]
+
+    def match(self, year, mileage, price):
+        # Mongo range operators never match a missing field, so a car without
+        # a year can only satisfy watchlists without a year range.
+        if year is None:
+            year = NO_BOUND
+        matched = []
+        for i in range(bisect_left(self.prices, price), len(self.entries)):
+            (_, _, min_year, max_year, max_mileage, watchlist) = self.entries[i]
+            if year == NO_BOUND and (min_year != -NO_BOUND or max_year != NO_BOUND):
+                continue
+            if year != NO_BOUND and not min_year <= year <= max_year:
+                continue
+            if mileage > max_mileage:
+                continue
+            matched.append(watchlist)
+        return matched
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class WatchlistIndex:
+    '''In-memory inverted index of watchlists keyed by (make, model).
+
+    Matches a car against every stored watchlist with the same criteria as
+    fetch_matching_cars, without querying Mongo per watchlist.
+    '''
+
+    def __init__(self, watchlists=()):
+        self._buckets = {}
+        self._locations = {}
+        self._seq = 0
+        for watchlist in watchlists:
+            self.add(watchlist)
+
+    def add(self, watchlist):
+        watchlist_id = watchlist['_id']
+        if watchlist_id in self._locations:
+            self.remove(watchlist_id)
+        key = (watchlist['make'], watchlist['model'])
+        self._seq += 1
+        bucket = self._buckets.setdefault(key, WatchlistBucket())
+        bucket.add(self._seq, watchlist)
+        max_price = get_watchlist_bounds(watchlist)[3]
+        self._locations[watchlist_id] = (key, self._seq, max_price)
+
+    def remove(self, watchlist_id):
+        location = self._locations.pop(watchlist_id, None)
+        if not location:
+            return False
+        (key, seq, max_price) = location
+        bucket = self._buckets[key]
+        bucket.remove(seq, max_price)
+        if not bucket:
+            del self._buckets[key]
+        return True
+
+    def match(self, car):
+        return self.match_values(get_car_key(car), get_car_values(car))
+
+    def match_values(self, key, values):
+        bucket = self._buckets.get(key)
+        if not bucket:
+            return []
+        return bucket.match(*values)
+
+    def match_cars(self, cars):
+        matches = {}
+        for car in cars:
+            for watchlist in self.match(car):
+                watchlist_id = watchlist['_id']
+                if watchlist_id not in matches:
+                    matches[watchlist_id] = (watchlist, [])
+                matches[watchlist_id][1].append(car)
+        return matches
+
+    def __contains__(self, watchlist_id):
+        return watchlist_id in self._locations
+
+    def __len__(self):
+        return len(self._locations)
+
+
+def load_watchlist_index(db, query=None):
+    return WatchlistIndex(parse_watchlists(db['watchlists'].find(query or {})))
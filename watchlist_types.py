@@ -0,0 +1,245 @@
+import logging
+from bson.decimal128 import Decimal128
+
+
+NO_BOUND = float('inf')
+
+
+def to_int(value, name):
+    if value is None:
+        return None
+    if isinstance(value, Decimal128):
+        value = value.to_decimal()
+    if isinstance(value, bool):
+        raise ValueError(f'{name} must be a number')
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} must be a number')
+
+
+def get_short_label(make, model, min_year=None, max_year=None, max_mileage=None, max_price=None):
+    label = f'{make} {model}'
+    if min_year is not None or max_year is not None:
+        years = ['' if year is None else str(year) for year in (min_year, max_year)]
+        label += f' {"-".join(years)}'
+    if max_mileage is not None:
+        label += f' {max_mileage}mi'
+    if max_price is not None:
+        label += f' {max_price}'
+    return label
+
+
+class Watchlist:
+    '''Compact watchlist with validated integer criteria.
+
+    Supports read access with the watchlist document keys (watchlist['make'],
+    watchlist.get('year')), so it can stand in for a watchlist dict in code
+    that only reads it. A missing bound is open-ended, so a year range may
+    have only a min or only a max.
+    '''
+
+    __slots__ = ('_id', 'user_id', 'make', 'model', 'min_year', 'max_year', 'max_mileage', 'max_price', 'short_label')
+
+    def __init__(self, make, model, user_id=None, min_year=None, max_year=None, max_mileage=None, max_price=None, _id=None):
+        if not make or not model:
+            raise ValueError('Watchlist must have make and model')
+        self._id = _id
+        self.user_id = user_id
+        self.make = make
+        self.model = model
+        self.min_year = to_int(min_year, 'year.min')
+        self.max_year = to_int(max_year, 'year.max')
+        self.max_mileage = to_int(max_mileage, 'mileage.max')
+        self.max_price = to_int(max_price, 'price.max')
+        self.short_label = get_short_label(make, model, self.min_year, self.max_year, self.max_mileage, self.max_price)
+
+    @classmethod
+    def from_doc(cls, doc):
+        '''Raises ValueError when make or model is missing or a bound isn't a number.'''
+        year = doc.get('year') or {}
+        return cls(
+            doc.get('make'),
+            doc.get('model'),
+            user_id=doc.get('userId'),
+            min_year=year.get('min'),
+            max_year=year.get('max'),
+            max_mileage=(doc.get('mileage') or {}).get('max'),
+            max_price=(doc.get('price') or {}).get('max'),
+            _id=doc.get('_id'),
+        )
+
+    def to_doc(self):
+        doc = {}
+        if self._id is not None:
+            doc['_id'] = self._id
+        if self.user_id is not None:
+            doc['userId'] = self.user_id
+        doc['make'] = self.make
+        doc['model'] = self.model
+        for key in ('year', 'mileage', 'price'):
+            value = self.get(key)
+            if value:
+                doc[key] = value
+        return doc
+
+    @property
+    def bounds(self):
+        return (
+            -NO_BOUND if self.min_year is None else self.min_year,
+            NO_BOUND if self.max_year is None else self.max_year,
+            NO_BOUND if self.max_mileage is None else self.max_mileage,
+            NO_BOUND if self.max_price is None else self.max_price,
+        )
+
+    def get(self, key, default=None):
+        if key == '_id':
+            value = self._id
+        elif key == 'userId':
+            value = self.user_id
+        elif key == 'make':
+            value = self.make
+        elif key == 'model':
+            value = self.model
+        elif key == 'year':
+            value = {
+                bound: value
+                for (bound, value) in (('min', self.min_year), ('max', self.max_year))
+                if value is not None
+            } or None
+        elif key == 'mileage':
+            value = {'max': self.max_mileage} if self.max_mileage is not None else None
+        elif key == 'price':
+            value = {'max': self.max_price} if self.max_price is not None else None
+        else:
+            value = None
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __eq__(self, other):
+        if not isinstance(other, Watchlist):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, slot) for slot in self.__slots__))
+
+    def __repr__(self):
+        return f'Watchlist({self._id}, {self.short_label!r})'
+
+
+class CarSummary:
+    '''Compact car with the fields of the 'summary' car projection.
+
+    Like Watchlist, it answers reads with the car document keys
+    (car['carInfo']['year'], car['post'][0]['postUrl']), so it can be
+    rendered by get_car_message. Values are kept as stored, so the rendered
+    price is the same as for the document.
+    '''
+
+    __slots__ = ('_id', 'year', 'make', 'model', 'mileage', 'price', 'currency', 'platform', 'post_url')
+
+    PROJECTION = {
+        'carInfo.year': True,
+        'carInfo.make': True,
+        'carInfo.model': True,
+        'mileage': True,
+        'price': True,
+        'post.platform': True,
+        'post.postUrl': True,
+    }
+
+    def __init__(self, _id, make, model, year=None, mileage=None, price=None, currency=None, platform=None, post_url=None):
+        self._id = _id
+        self.make = make
+        self.model = model
+        self.year = year
+        self.mileage = mileage
+        self.price = price
+        self.currency = currency
+        self.platform = platform
+        self.post_url = post_url
+
+    @classmethod
+    def from_doc(cls, doc):
+        car_info = doc.get('carInfo') or {}
+        price = doc.get('price') or {}
+        posts = doc.get('post') or [{}]
+        return cls(
+            doc.get('_id'),
+            car_info.get('make'),
+            car_info.get('model'),
+            year=car_info.get('year'),
+            mileage=doc.get('mileage'),
+            price=price.get('amount'),
+            currency=price.get('currency'),
+            platform=posts[0].get('platform'),
+            post_url=posts[0].get('postUrl'),
+        )
+
+    def to_doc(self):
+        doc = {}
+        for key in ('_id', 'carInfo', 'mileage', 'price', 'post'):
+            value = self.get(key)
+            if value is not None:
+                doc[key] = value
+        return doc
+
+    def get(self, key, default=None):
+        if key == '_id':
+            value = self._id
+        elif key == 'carInfo':
+            value = {
+                field: value
+                for (field, value) in (('year', self.year), ('make', self.make), ('model', self.model))
+                if value is not None
+            }
+        elif key == 'mileage':
+            value = self.mileage
+        elif key == 'price':
+            value = {
+                field: value
+                for (field, value) in (('amount', self.price), ('currency', self.currency))
+                if value is not None
+            } or None
+        elif key == 'post':
+            post = {
+                field: value
+                for (field, value) in (('platform', self.platform), ('postUrl', self.post_url))
+                if value is not None
+            }
+            value = [post] if post else None
+        else:
+            value = None
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __eq__(self, other):
+        if not isinstance(other, CarSummary):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, slot) for slot in self.__slots__))
+
+    def __repr__(self):
+        return f'CarSummary({self._id}, {self.year} {self.make} {self.model})'
+
+
+def parse_watchlists(docs):
+    '''Yields a Watchlist for every valid doc, logging and skipping the rest.'''
+    for doc in docs:
+        try:
+            yield Watchlist.from_doc(doc)
+        except ValueError as e:
+            logging.getLogger().warning(f'Skipping watchlist {doc.get("_id")}: {e}')